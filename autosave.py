@@ -0,0 +1,415 @@
+"""Incremental autosave to an append-only recovery file.
+
+Each checkpoint appends only the layer tiles changed since the previous
+one, plus any new journal operations, so autosaving costs time
+proportional to the edit rather than to the image. Once the appended
+data outgrows the last full snapshot several times over, the file is
+compacted: a fresh snapshot is written to a temporary file and renamed
+into place.
+
+The file is a magic line followed by records, each a fixed header
+(kind, five integers, payload length) and a payload:
+
+    L  -                         payload: JSON list of layer properties;
+                                 after the snapshot's, each has the
+                                 layer's previous index as "from", or
+                                 none for a new, blank layer
+    S  width, height             payload: document format (the
+                                 background layer's mode)
+    T  layer, x, y, width, height  payload: zlib-compressed tile pixels
+    J  -                         payload: zlib-compressed JSON ops
+    C  selected layer            end of a checkpoint
+
+Adding, removing, reordering or restyling layers appends an ``L``
+record; only replacing the document or changing its pixel format writes
+a new snapshot. Restoring applies records only up to the last complete
+checkpoint, so a crash in the middle of an append loses at most that
+checkpoint.
+
+Each running instance claims the recovery file with a lock (``claim``);
+an instance started while another one runs keeps its own file, so it
+neither mistakes the live file for a crashed session nor overwrites it.
+The files of such instances that crashed are found by ``orphans``.
+"""
+import glob
+import itertools
+import json
+import os
+import struct
+import zlib
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+from PIL import Image
+
+import formats
+from layers import LayerStack
+from tiles import TiledImage, uniform
+
+MAGIC = b"SDRECOVER2\n"
+HEADER = struct.Struct("<c5iI")
+
+
+def _format(layers):
+    return layers.layers[0].image.mode.encode()
+
+
+def _copies(layers):
+    # (image, fill) of each layer, for a checkpoint written later; tiled
+    # images share their tiles until the document changes them
+    return [(layer.image.copy(), layer.fill) for layer in layers.layers]
+
+
+def _record(kind, payload=b"", *fields):
+    fields += (0,) * (5 - len(fields))
+    return HEADER.pack(kind, *fields, len(payload)) + payload
+
+
+def _lock(f):
+    # An exclusive lock the system drops when the process ends, however
+    # it ends; raises OSError if another process holds it
+    if fcntl is not None:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    else:
+        msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+
+
+class RecoveryStore:
+    """Tracks changed layer tiles and appends them to a recovery file."""
+
+    def __init__(self, path, tile_size=256, compact_ratio=4):
+        self.path = path
+        self.tile_size = tile_size
+        self.compact_ratio = compact_ratio
+        self.dirty = set()  # (Layer, tx, ty) changed since the checkpoint
+        self.needs_snapshot = True
+        self.lock_file = None
+        self.shared = True  # Any instance may claim the file
+        self.written_layers = []  # Layers in the file, in order
+        self.written_props = []
+        self.written_size = None  # Document size in the file
+        self.written_active = None  # Selected layer in the file
+        self.written_ops = 0  # Journal operations in the file
+        self.snapshot_bytes = 0
+
+    def claim(self):
+        """Lock the recovery file for this process. If another running
+        instance holds it, switch to a file of this process's own and
+        return False."""
+        if self._lock():
+            return True
+        self.shared = False
+        base = self.path
+        for n in itertools.count():
+            # A file left by a crashed process of the same id is not this
+            # one's to overwrite; it stays for ``orphans``
+            self.path = f"{base}-{os.getpid()}" + (f".{n}" if n else "")
+            if self._lock() and not self.has_session():
+                return False
+            self.release()
+
+    def release(self):
+        """Unlock the file so that another instance can claim it."""
+        if self.lock_file is None:
+            return
+        if not self.shared:
+            # Removed while still held, so that no instance can lock the
+            # old file after; the shared one stays for the next instance
+            try:
+                os.remove(self.path + ".lock")
+            except OSError:
+                pass
+        self.lock_file.close()
+        self.lock_file = None
+
+    def _lock(self):
+        lock_file = open(self.path + ".lock", "a")
+        try:
+            _lock(lock_file)
+        except OSError:
+            lock_file.close()
+            return False
+        self.lock_file = lock_file
+        return True
+
+    def has_session(self):
+        try:
+            return os.path.getsize(self.path) > len(MAGIC)
+        except OSError:
+            return False
+
+    def reset(self):
+        # The document was replaced or all of its pixels changed (a new
+        # pixel format); write a snapshot next time
+        self.dirty.clear()
+        self.needs_snapshot = True
+
+    def invalidate(self, bbox, layer):
+        x0, y0, x1, y1 = bbox
+        step = self.tile_size
+        for ty in range(max(0, int(y0)) // step, -(-int(y1) // step)):
+            for tx in range(max(0, int(x0)) // step, -(-int(x1) // step)):
+                self.dirty.add((layer, tx, ty))
+
+    def pending(self, layers, size, ops):
+        return bool(self.needs_snapshot or self.dirty
+                    or self._restructured(layers)
+                    or size != self.written_size
+                    or layers.active != self.written_active
+                    or len(ops) != self.written_ops)
+
+    def checkpoint(self, layers, size, ops):
+        """Write the changes since the last checkpoint; returns bytes."""
+        write = self.prepare(layers, size, ops)
+        return write() if write is not None else 0
+
+    def prepare(self, layers, size, ops):
+        """Take the changes since the last checkpoint, or None if there
+        are none. Returns a function that writes them and returns the
+        bytes written; it works from copies, so it can run on another
+        thread while the document changes, but not alongside another
+        checkpoint."""
+        if not self.pending(layers, size, ops):
+            return None
+        if self.needs_snapshot or len(ops) < self.written_ops:
+            return self._prepare_compact(layers, size, ops)
+        try:
+            appended = os.path.getsize(self.path) - self.snapshot_bytes
+        except OSError:
+            return self._prepare_compact(layers, size, ops)
+        if appended > self.compact_ratio * self.snapshot_bytes:
+            return self._prepare_compact(layers, size, ops)
+
+        records = []
+        if self._restructured(layers):
+            # Existing layers keep the tiles already written for them
+            props = []
+            for layer in layers.layers:
+                layer_props = layer.props()
+                if layer in self.written_layers:
+                    layer_props["from"] = self.written_layers.index(layer)
+                props.append(layer_props)
+            records.append(_record(b"L", json.dumps(props).encode()))
+        if size != self.written_size:
+            # Area that became part of the document may hold pixels kept
+            # off-screen by the backing store, so it counts as changed
+            old_width, old_height = self.written_size
+            for layer in layers.layers:
+                self.invalidate((old_width, 0) + size, layer)
+                self.invalidate((0, old_height) + size, layer)
+            records.append(_record(b"S", _format(layers), *size))
+        # Tiles of layers removed since they changed are not needed
+        indices = {layer: index for index, layer in enumerate(layers.layers)}
+        dirty = sorted((indices[layer], tx, ty)
+                       for layer, tx, ty in self.dirty if layer in indices)
+        images = _copies(layers)
+        new_ops = ops[self.written_ops:]
+        active = layers.active
+        self._written(layers, size, ops)
+
+        def write():
+            data = b"".join([
+                *records, *self._tiles(images, size, dirty),
+                *self._ops(new_ops), _record(b"C", b"", active),
+            ])
+            with open(self.path, "ab") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            return len(data)
+        return self._checked(write)
+
+    def compact(self, layers, size, ops):
+        """Replace the file with a snapshot of the whole document."""
+        return self._prepare_compact(layers, size, ops)()
+
+    def _prepare_compact(self, layers, size, ops):
+        step = self.tile_size
+        tiles = [(index, tx, ty) for index in range(len(layers.layers))
+                 for ty in range(-(-size[1] // step))
+                 for tx in range(-(-size[0] // step))]
+        props = [layer.props() for layer in layers.layers]
+        head = [MAGIC, _record(b"L", json.dumps(props).encode()),
+                _record(b"S", _format(layers), *size)]
+        images = _copies(layers)
+        ops = list(ops)
+        active = layers.active
+        self.needs_snapshot = False
+        self._written(layers, size, ops)
+
+        def write():
+            data = b"".join([
+                *head, *self._tiles(images, size, tiles, skip_blank=True),
+                *self._ops(ops), _record(b"C", b"", active),
+            ])
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+            self.snapshot_bytes = len(data)
+            return len(data)
+        return self._checked(write)
+
+    def _checked(self, write):
+        # The changes were taken off the books when prepared; if they
+        # never reach the file, the next checkpoint rewrites it whole
+        def checked():
+            try:
+                return write()
+            except Exception:
+                self.needs_snapshot = True
+                raise
+        return checked
+
+    def discard(self):
+        # Called on a clean exit, or once a crashed instance's session was
+        # restored or declined: there is nothing to recover
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+        self.release()
+
+    def _restructured(self, layers):
+        # Layers were added, removed, moved or had their properties changed
+        return (layers.layers != self.written_layers
+                or [layer.props() for layer in layers.layers]
+                != self.written_props)
+
+    def _written(self, layers, size, ops):
+        self.dirty.clear()
+        self.written_layers = list(layers.layers)
+        self.written_props = [layer.props() for layer in layers.layers]
+        self.written_size = size
+        self.written_active = layers.active
+        self.written_ops = len(ops)
+
+    def _tiles(self, images, size, tiles, skip_blank=False):
+        step = self.tile_size
+        width, height = size
+        for index, tx, ty in tiles:
+            box = (tx * step, ty * step,
+                   min(width, (tx + 1) * step), min(height, (ty + 1) * step))
+            if box[0] >= box[2] or box[1] >= box[3]:
+                continue
+            image, fill = images[index]
+            if skip_blank and uniform(image, box) == \
+                    formats.pixel(fill, image.mode):
+                continue  # A snapshot restores onto the layer's fill
+            pixels = zlib.compress(image.crop(box).tobytes(), 1)
+            yield _record(b"T", pixels, index, box[0], box[1],
+                          box[2] - box[0], box[3] - box[1])
+
+    def _ops(self, ops):
+        if ops:
+            payload = json.dumps(ops, separators=(",", ":")).encode()
+            yield _record(b"J", zlib.compress(payload, 1))
+
+
+def orphans(path):
+    """Claim the files that instances which could not claim ``path`` left
+    when they crashed; returns a RecoveryStore for each holding a session,
+    oldest first. Empty ones are removed."""
+    stores = []
+    for orphan in glob.glob(glob.escape(path) + "-*"):
+        if orphan.endswith((".lock", ".tmp")):
+            continue
+        store = RecoveryStore(orphan)
+        store.shared = False
+        if not store._lock():
+            continue  # Its instance is still running
+        if store.has_session():
+            stores.append(store)
+        else:
+            store.discard()
+    return sorted(stores, key=lambda store: os.path.getmtime(store.path))
+
+
+def restore(path):
+    """Rebuild (layers, size, journal ops) from a recovery file.
+
+    Returns (None, None, None) if the file holds no complete checkpoint.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        return None, None, None
+
+    props = None
+    images = []
+    size = None
+    mode = None
+    active = 0
+    ops = []
+    pending = []  # Records of the checkpoint being read
+    offset = len(MAGIC)
+    while offset + HEADER.size <= len(data):
+        kind, *fields, length = HEADER.unpack_from(data, offset)
+        offset += HEADER.size
+        if offset + length > len(data):
+            break  # Torn write at the end of the file
+        payload = data[offset:offset + length]
+        offset += length
+        if kind != b"C":
+            pending.append((kind, fields, payload))
+            continue
+        active = fields[0]
+        for kind, fields, payload in pending:
+            if kind == b"L":
+                old_images = images
+                props = json.loads(payload)
+                images = []
+                for index, layer in enumerate(props):
+                    if "from" in layer:
+                        images.append(old_images[layer["from"]])
+                    elif size is not None:
+                        images.append(TiledImage(
+                            mode if index == 0 else formats.layer_mode(mode),
+                            size, layer["fill"]
+                        ))
+                    else:
+                        images.append(None)  # Created by the next S
+            elif kind == b"S":
+                size = tuple(fields[:2])
+                mode = payload.decode()
+                for index, layer in enumerate(props):
+                    if images[index] is None:
+                        images[index] = TiledImage(
+                            mode if index == 0 else formats.layer_mode(mode),
+                            size, layer["fill"]
+                        )
+                    else:
+                        images[index] = images[index].resized(size)
+            elif kind == b"T":
+                index, x, y, width, height = fields
+                image = images[index]
+                tile = Image.frombytes(image.mode, (width, height),
+                                       zlib.decompress(payload))
+                image.paste(tile, (x, y))
+            elif kind == b"J":
+                ops.extend(json.loads(zlib.decompress(payload)))
+        pending = []
+    if not images:
+        return None, None, None
+
+    layers = LayerStack(images[0])
+    for image in images[1:]:
+        layers.add()
+        layers.active_layer.image = image
+    for layer, layer_props in zip(layers.layers, props):
+        layer.name = layer_props["name"]
+        layer.fill = layer_props["fill"]
+        if isinstance(layer.fill, list):
+            layer.fill = tuple(layer.fill)
+        layer.visible = layer_props["visible"]
+        layer.opacity = layer_props["opacity"]
+        layer.blend = layer_props["blend"]
+    layers.select(active)
+    layers.composite()
+    return layers, size, ops
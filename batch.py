@@ -0,0 +1,174 @@
+"""Apply a journal or operation script to a directory of images.
+
+Each image is loaded, replayed through the same headless ``Replayer`` the
+application uses for journals, and saved under the output directory with
+its original name. Images are processed by a pool of worker processes,
+one per core by default. Nothing here imports Tkinter.
+
+The script is either a journal saved from the application (``.sdj``) or
+a plain JSON file holding a list of operation records (or one record per
+line). Records that replace or resize the document (``new``, ``open``,
+``resize``) are skipped, so a journal recorded on a blank canvas applies
+its edits to each input image instead.
+
+Finished images are appended to a done-log in the output directory;
+``--resume`` skips them, so an interrupted batch picks up where it
+stopped.
+
+Usage:
+    python batch.py edits.sdj photos/ out/
+    python batch.py stamp.json photos/ out/ --jobs 4 --format webp --resume
+"""
+import argparse
+import fnmatch
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import export
+import raster
+from journal import Journal, Replayer
+
+DONE_LOG = ".batch-done"
+SKIPPED_OPS = ("new", "open", "resize")
+DEFAULT_PATTERNS = "*.png,*.jpg,*.jpeg,*.bmp,*.webp"
+
+
+def load_ops(path):
+    """Operation records from a journal or a JSON script."""
+    with open(path, "rb") as f:
+        gzipped = f.read(2) == b"\x1f\x8b"
+    if gzipped:
+        ops = Journal.load(path).ops
+    else:
+        with open(path, encoding="utf-8") as f:
+            text = f.read()
+        if text.lstrip().startswith("["):
+            ops = json.loads(text)
+        else:
+            ops = [json.loads(line) for line in text.splitlines()
+                   if line.strip()]
+    return [op for op in ops if op["op"] not in SKIPPED_OPS]
+
+
+def list_images(directory, patterns):
+    return sorted(
+        name for name in os.listdir(directory)
+        if any(fnmatch.fnmatch(name.lower(), p) for p in patterns)
+        and os.path.isfile(os.path.join(directory, name))
+    )
+
+
+def read_done(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return {line.rstrip("\n") for line in f if line.strip()}
+    except FileNotFoundError:
+        return set()
+
+
+# Per-process state, set once by the pool initializer rather than
+# pickled with every task
+_ops = None
+_options = None
+
+
+def _init_worker(ops, options):
+    global _ops, _options
+    _ops, _options = ops, options
+
+
+def process(task):
+    """Replay the script on one image; returns (name, pixels, seconds,
+    error)."""
+    name, source, target = task
+    start = time.perf_counter()
+    try:
+        replayer = Replayer(raster.load_image(source))
+        for op in _ops:
+            replayer.apply(op)
+        result = replayer.result()
+        export.save(result, target, **_options)
+    except Exception as e:
+        return name, 0, time.perf_counter() - start, f"{type(e).__name__}: {e}"
+    return (name, result.width * result.height,
+            time.perf_counter() - start, None)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("script", help="journal (.sdj) or JSON operations")
+    parser.add_argument("input", help="directory of images to edit")
+    parser.add_argument("output", help="directory for the edited images")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(),
+                        help="worker processes (default: one per core)")
+    parser.add_argument("--pattern", default=DEFAULT_PATTERNS,
+                        help="comma-separated file name patterns")
+    parser.add_argument("--format", choices=["png", "webp", "jpg", "bmp"],
+                        help="output format (default: keep the input's)")
+    parser.add_argument("--resume", action="store_true",
+                        help="skip images finished by an earlier run")
+    parser.add_argument("--png-compress-level", type=int, default=6)
+    parser.add_argument("--jpeg-quality", type=int, default=90)
+    args = parser.parse_args(argv)
+
+    ops = load_ops(args.script)
+    os.makedirs(args.output, exist_ok=True)
+    done_path = os.path.join(args.output, DONE_LOG)
+    done = read_done(done_path) if args.resume else set()
+    names = [name for name in list_images(args.input, args.pattern.split(","))
+             if name not in done]
+    tasks = []
+    for name in names:
+        target = name
+        if args.format:
+            target = os.path.splitext(name)[0] + "." + args.format
+        tasks.append((name, os.path.join(args.input, name),
+                      os.path.join(args.output, target)))
+    options = {"png_compress_level": args.png_compress_level,
+               "jpeg_quality": args.jpeg_quality}
+
+    print(f"{len(tasks)} images, {len(done)} already done, "
+          f"{len(ops)} operations, {args.jobs} workers", file=sys.stderr)
+    failed = []
+    pixels = 0
+    busy = 0.0
+    start = time.perf_counter()
+    with open(done_path, "a" if args.resume else "w",
+              encoding="utf-8") as log, \
+            multiprocessing.Pool(args.jobs, _init_worker,
+                                 (ops, options)) as pool:
+        for count, (name, size, seconds, error) in enumerate(
+                pool.imap_unordered(process, tasks), 1):
+            busy += seconds
+            if error:
+                failed.append(name)
+                print(f"{name}: {error}", file=sys.stderr)
+                continue
+            pixels += size
+            # Logged as soon as it is saved, so a crash loses nothing
+            log.write(name + "\n")
+            log.flush()
+            if count % 100 == 0:
+                elapsed = time.perf_counter() - start
+                print(f"{count}/{len(tasks)} ({count / elapsed:.1f} images/s)",
+                      file=sys.stderr)
+
+    elapsed = time.perf_counter() - start
+    finished = len(tasks) - len(failed)
+    print(f"{finished} images in {elapsed:.2f} s: "
+          f"{finished / elapsed if elapsed else 0:.1f} images/s, "
+          f"{pixels / 1e6 / elapsed if elapsed else 0:.1f} Mpixel/s, "
+          f"{busy / max(1, len(tasks)) * 1000:.0f} ms per image per worker",
+          file=sys.stderr)
+    if failed:
+        print(f"{len(failed)} failed; rerun with --resume to retry them",
+              file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
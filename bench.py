@@ -0,0 +1,418 @@
+"""Headless benchmarks for the raster core.
+
+Runs the hot paths of the drawing application (fill, stroke rasterization,
+undo history, layer compositing, canvas resizing, saving and opening) on
+synthetic canvases and writes the timings as JSON. Cases ending in
+``_tiled`` work on the sparse ``TiledImage`` documents the application
+uses. No display is needed.
+
+Usage:
+    python bench.py
+    python bench.py --sizes 1400x1000,3840x2160 --repeat 5 --output bench.json
+"""
+import argparse
+import ctypes
+import gc
+import io
+import json
+import platform
+import statistics
+import sys
+import time
+
+import numpy as np
+import PIL
+from PIL import Image, ImageDraw
+
+import brush
+import export
+import raster
+import tiles
+from history import TileHistory
+from layers import LayerStack
+from regions import RegionIndex
+
+DEFAULT_SIZES = "1400x1000,1920x1080,3840x2160,7680x4320"
+
+
+def blank(width, height):
+    return Image.new("RGBA", (width, height), "white")
+
+
+def blank_tiled(width, height):
+    return tiles.TiledImage("RGBA", (width, height), "white")
+
+
+def maze(width, height, spacing=8):
+    # Vertical walls with alternating gaps: one long serpentine corridor
+    image = blank(width, height)
+    draw = ImageDraw.Draw(image)
+    for i, x in enumerate(range(spacing, width, spacing)):
+        if i % 2:
+            draw.line([x, spacing, x, height - 1], fill="black")
+        else:
+            draw.line([x, 0, x, height - 1 - spacing], fill="black")
+    return image
+
+
+def zigzag(width, height, segments=500):
+    # Polyline sweeping across the whole canvas
+    points = []
+    for i in range(segments + 1):
+        x = width * i // segments
+        y = height // 4 if i % 2 else height * 3 // 4
+        points.extend((x, y))
+    return points
+
+
+def scribble(image):
+    # Give encoders something more realistic than a flat white image
+    draw = ImageDraw.Draw(image)
+    width, height = image.size
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        x0, x1 = sorted(rng.integers(0, width, 2))
+        y0, y1 = sorted(rng.integers(0, height, 2))
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        draw.rectangle([x0, y0, x1, y1], outline=color, width=5)
+    return image
+
+
+# Each case returns (setup, run): setup builds fresh state outside the
+# timed region and run performs the measured operation on it.
+
+def case_fill_open(width, height):
+    def run(image):
+        raster.flood_fill(image, width // 2, height // 2, (255, 0, 0, 255))
+    return lambda: blank(width, height), run
+
+
+def case_fill_maze(width, height):
+    template = maze(width, height)
+
+    def run(image):
+        raster.flood_fill(image, 1, 1, (255, 0, 0, 255))
+    return template.copy, run
+
+
+def case_fill_open_tiled(width, height):
+    def run(image):
+        raster.flood_fill(image, width // 2, height // 2, (255, 0, 0, 255))
+    return lambda: blank_tiled(width, height), run
+
+
+def case_fill_maze_tiled(width, height):
+    # Copies share the template's tiles until the fill writes to them
+    template = tiles.TiledImage.from_image(maze(width, height), "white")
+
+    def run(image):
+        raster.flood_fill(image, 1, 1, (255, 0, 0, 255))
+    return template.copy, run
+
+
+def case_fill_tolerance_tiled(width, height):
+    template = tiles.TiledImage.from_image(maze(width, height), "white")
+
+    def run(image):
+        raster.flood_fill(image, 1, 1, (255, 0, 0, 255), tolerance=16)
+    return template.copy, run
+
+
+def _cells(width, height, spacing=64):
+    # Line art with many small closed areas, like a comic page
+    image = blank(width, height)
+    draw = ImageDraw.Draw(image)
+    for x in range(0, width, spacing):
+        draw.line([x, 0, x, height - 1], fill="black")
+    for y in range(0, height, spacing):
+        draw.line([0, y, width - 1, y], fill="black")
+    seeds = [(x + spacing // 2, y + spacing // 2)
+             for y in range(0, height - spacing, spacing)
+             for x in range(0, width - spacing, spacing)]
+    return image, seeds[::max(1, len(seeds) // 50)]
+
+
+def case_fill_cells(width, height):
+    template, seeds = _cells(width, height)
+
+    def run(image):
+        for x, y in seeds:
+            raster.flood_fill(image, x, y, (255, 0, 0, 255))
+    return template.copy, run
+
+
+def case_fill_cells_indexed(width, height):
+    template, seeds = _cells(width, height)
+
+    def setup():
+        index = RegionIndex()
+        index.reset(template.copy())
+        return index
+
+    def run(index):
+        for x, y in seeds:
+            index.fill(x, y, (255, 0, 0, 255))
+    return setup, run
+
+
+def case_stroke(width, height):
+    points = zigzag(width, height)
+
+    def setup():
+        image = blank(width, height)
+        return ImageDraw.Draw(image)
+
+    def run(draw):
+        for i in range(0, len(points) - 2, 2):
+            raster.draw_segment(draw, *points[i:i + 4], "black", 10)
+    return setup, run
+
+
+def _dab_case(size, hardness):
+    def case(width, height):
+        points = zigzag(width, height)
+
+        def run(image):
+            stroke = brush.Stroke(size, hardness)
+            for i in range(0, len(points), 2):
+                stroke.to(image, "#000000", *points[i:i + 2])
+        return lambda: blank(width, height), run
+    return case
+
+
+case_stroke_dabs = _dab_case(10, 1.0)
+case_stroke_soft = _dab_case(100, 0.2)
+
+
+def _history_with_action(width, height):
+    image = blank(width, height)
+    history = TileHistory()
+    history.reset(image)
+    bbox = (width // 4, height // 4, width * 3 // 4, height * 3 // 4)
+    ImageDraw.Draw(image).rectangle(bbox, fill="red")
+    return image, history, bbox
+
+
+def case_history_push(width, height):
+    def run(state):
+        image, history, bbox = state
+        history.commit(image, bbox)
+    return lambda: _history_with_action(width, height), run
+
+
+def case_history_undo(width, height):
+    def setup():
+        image, history, bbox = _history_with_action(width, height)
+        history.commit(image, bbox)
+        return image, history
+
+    def run(state):
+        image, history = state
+        history.undo(image)
+    return setup, run
+
+
+def case_history_redo(width, height):
+    def setup():
+        image, history, bbox = _history_with_action(width, height)
+        history.commit(image, bbox)
+        history.undo(image)
+        return image, history
+
+    def run(state):
+        image, history = state
+        history.redo(image)
+    return setup, run
+
+
+def case_layers_stroke(width, height, count=10):
+    # Stroke on the middle layer of a ten-layer document and recomposite
+    points = zigzag(width, height, 50)
+
+    def setup():
+        stack = LayerStack(blank(width, height))
+        for _ in range(count - 1):
+            stack.add()
+        stack.select(count // 2)
+        stack.composite()
+        return stack
+
+    def run(stack):
+        stroke = brush.Stroke(10)
+        for i in range(0, len(points), 2):
+            stack.invalidate(stroke.to(
+                stack.active_layer.image, "#000000", *points[i:i + 2]
+            ))
+            stack.composite()
+    return setup, run
+
+
+def case_resize_canvas(width, height):
+    def run(image):
+        raster.grow_canvas(image, width + 100, height + 100)
+    return lambda: blank(width, height), run
+
+
+def _save_case(fmt, **options):
+    def case(width, height):
+        template = scribble(blank(width, height))
+
+        def run(image):
+            export.encode(image, io.BytesIO(), fmt, **options)
+        return lambda: template, run
+    return case
+
+
+def case_write_png(width, height):
+    template = scribble(blank(width, height))
+
+    def run(image):
+        export.write_png(image, io.BytesIO())
+    return lambda: template, run
+
+
+def case_write_png_tiled(width, height):
+    template = tiles.TiledImage.from_image(scribble(blank(width, height)),
+                                           "white")
+
+    def run(image):
+        export.write_png(image, io.BytesIO())
+    return lambda: template, run
+
+
+case_save_png = _save_case("PNG")
+case_save_png_fast = _save_case("PNG", png_compress_level=1)
+case_save_webp = _save_case("WEBP")
+case_save_jpeg = _save_case("JPEG")
+
+
+def case_open_png(width, height):
+    encoded = io.BytesIO()
+    scribble(blank(width, height)).save(encoded, "PNG")
+    data = encoded.getvalue()
+
+    def run(data):
+        Image.open(io.BytesIO(data)).convert("RGBA").load()
+    return lambda: data, run
+
+
+CASES = {
+    "fill_open": case_fill_open,
+    "fill_maze": case_fill_maze,
+    "fill_cells": case_fill_cells,
+    "fill_cells_indexed": case_fill_cells_indexed,
+    "fill_open_tiled": case_fill_open_tiled,
+    "fill_maze_tiled": case_fill_maze_tiled,
+    "fill_tolerance_tiled": case_fill_tolerance_tiled,
+    "stroke": case_stroke,
+    "stroke_dabs": case_stroke_dabs,
+    "stroke_soft": case_stroke_soft,
+    "history_push": case_history_push,
+    "history_undo": case_history_undo,
+    "history_redo": case_history_redo,
+    "layers_stroke": case_layers_stroke,
+    "resize_canvas": case_resize_canvas,
+    "save_png": case_save_png,
+    "save_png_fast": case_save_png_fast,
+    "save_webp": case_save_webp,
+    "save_jpeg": case_save_jpeg,
+    "write_png": case_write_png,
+    "write_png_tiled": case_write_png_tiled,
+    "open_png": case_open_png,
+}
+
+
+def _status_bytes(field):
+    # A memory figure of this process from /proc/self/status, in bytes
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) * 1024
+    return None
+
+
+def _reset_peak_rss():
+    # Linux can reset the process's peak RSS to its current RSS; returns
+    # that RSS, or None where this is not supported. Memory freed by
+    # earlier runs is handed back to the system first, or the run would
+    # reuse it unseen
+    gc.collect()
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return _status_bytes("VmRSS")
+    except OSError:
+        return None
+
+
+def measure(case, width, height, repeat):
+    setup, run = case(width, height)
+    times = []
+    for _ in range(repeat):
+        state = setup()
+        start = time.perf_counter()
+        run(state)
+        times.append(time.perf_counter() - start)
+        del state
+    # Memory is measured in a pass of its own, so the timings are not
+    # slowed down by it. RSS counts Pillow's buffers too, which
+    # tracemalloc cannot see
+    state = setup()
+    base = _reset_peak_rss()
+    run(state)
+    peak = _status_bytes("VmHWM") - base if base is not None else None
+    return {
+        "times": times,
+        "min": min(times),
+        "median": statistics.median(times),
+        # Growth of the resident set over the run; None off Linux
+        "peak_rss_bytes": peak,
+    }
+
+
+def parse_size(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default=DEFAULT_SIZES,
+                        help="comma-separated WIDTHxHEIGHT canvas sizes")
+    parser.add_argument("--cases", default=",".join(CASES),
+                        help="comma-separated cases to run")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    args = parser.parse_args(argv)
+
+    results = []
+    for size in args.sizes.split(","):
+        width, height = parse_size(size)
+        for name in args.cases.split(","):
+            result = measure(CASES[name], width, height, args.repeat)
+            result.update(case=name, size=[width, height])
+            results.append(result)
+            print(f"{name:>14} {width}x{height}: "
+                  f"{result['median'] * 1000:9.2f} ms", file=sys.stderr)
+
+    report = {
+        "python": platform.python_version(),
+        "pillow": PIL.__version__,
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+"""Image export with tunable encoders and background saving.
+
+``encode`` writes an image with the encoder settings for its format and
+``SaveJob`` runs a save on a worker thread so a slow encode (a large PNG
+at a high compression level, say) never blocks the UI. Nothing in here
+imports Tkinter.
+
+A sparse ``tiles.TiledImage`` is written as PNG by ``write_png``, which
+streams it a band of rows at a time, so saving a huge canvas never
+assembles the whole image in memory.
+"""
+import os
+import stat
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+import numpy as np
+from PIL import Image
+
+from tiles import TiledImage
+
+FORMATS = {
+    ".png": "PNG",
+    ".webp": "WEBP",
+    ".jpg": "JPEG",
+    ".jpeg": "JPEG",
+    ".bmp": "BMP",
+}
+
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_COLOR_TYPES = {"L": 0, "RGB": 2, "P": 3, "LA": 4, "RGBA": 6}
+PNG_BAND_ROWS = 64  # Rows filtered and compressed per step of write_png
+
+
+def format_for(path):
+    """Pillow format name for a file path, PNG if the suffix is unknown."""
+    return FORMATS.get(os.path.splitext(path)[1].lower(), "PNG")
+
+
+def encode(image, fp, fmt, png_compress_level=6, png_optimize=False,
+           webp_lossless=True, jpeg_quality=90):
+    """Write ``image`` to a path or file object as ``fmt``.
+
+    PNG trades save time for size through ``png_compress_level`` (0-9) and
+    ``png_optimize``; WebP is lossless by default; JPEG has no alpha
+    channel, so the image is flattened onto white first.
+    """
+    if isinstance(image, TiledImage):
+        if fmt == "PNG" and not png_optimize and \
+                image.mode in PNG_COLOR_TYPES:
+            write_png(image, fp, png_compress_level)
+            return
+        # The other encoders need the whole image at once
+        image = image.crop((0, 0) + image.size)
+    if fmt == "PNG":
+        params = {"compress_level": png_compress_level,
+                  "optimize": png_optimize}
+    elif fmt == "WEBP":
+        params = {"lossless": webp_lossless}
+        if not webp_lossless:
+            params["quality"] = jpeg_quality
+    elif fmt == "JPEG":
+        params = {"quality": jpeg_quality}
+        if image.mode in ("RGBA", "LA", "P"):
+            image = image.convert("RGBA")
+            flat = Image.new("RGB", image.size, "white")
+            flat.paste(image, mask=image.getchannel("A"))
+            image = flat
+    else:
+        params = {}
+        if fmt == "BMP" and image.mode == "RGBA":
+            image = image.convert("RGB")
+    image.save(fp, fmt, **params)
+
+
+def _png_chunk(fp, kind, data):
+    fp.write(struct.pack(">I", len(data)))
+    fp.write(kind)
+    fp.write(data)
+    fp.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(kind))))
+
+
+def write_png(image, fp, compress_level=6, band=PNG_BAND_ROWS):
+    """Write ``image`` (anything with ``crop``) as PNG, ``band`` rows at
+    a time.
+
+    Each row gets whichever of the None, Sub and Up filters leaves the
+    smallest sum of absolute byte values, the usual libpng heuristic,
+    judged on every 16th byte to keep it cheap on wide images.
+    """
+    width, height = image.size
+    channels = len(image.mode)
+    fp.write(PNG_SIGNATURE)
+    _png_chunk(fp, b"IHDR", struct.pack(
+        ">IIBBBBB", width, height, 8, PNG_COLOR_TYPES[image.mode], 0, 0, 0
+    ))
+    if image.mode == "P":
+        palette = image.crop((0, 0, 1, 1)).getpalette()
+        _png_chunk(fp, b"PLTE", bytes(palette[:768]))
+    compressor = zlib.compressobj(compress_level)
+    previous = np.zeros((1, width * channels), dtype=np.uint8)
+    for top in range(0, height, band):
+        rows = np.asarray(
+            image.crop((0, top, width, min(height, top + band)))
+        ).reshape(-1, width * channels)
+        sub = rows.copy()
+        sub[:, channels:] -= rows[:, :-channels]
+        up = rows - np.vstack([previous, rows[:-1]])
+        candidates = np.stack([rows, sub, up])  # Filter types 0, 1, 2
+        sample = candidates[:, :, ::16].view(np.int8).astype(np.int16)
+        costs = np.abs(sample).sum(axis=2)
+        choice = costs.argmin(axis=0)
+        filtered = candidates[choice, np.arange(len(rows))]
+        data = compressor.compress(np.hstack(
+            [choice[:, None].astype(np.uint8), filtered]
+        ).tobytes())
+        if data:
+            _png_chunk(fp, b"IDAT", data)
+        previous = rows[-1:]
+    _png_chunk(fp, b"IDAT", compressor.flush())
+    _png_chunk(fp, b"IEND", b"")
+
+
+def _umask():
+    # The umask can only be read by setting it, which is not thread-safe;
+    # read it once, before any save thread exists
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+_UMASK = _umask()
+
+
+def save(image, path, **options):
+    """Save to ``path`` atomically: a failed save leaves any old file.
+
+    A file that is replaced keeps its permissions, and a new one gets the
+    usual ``0o666`` less the umask. When ``path`` is a symlink, the file
+    it points to is replaced and the link is kept.
+    """
+    target = os.path.realpath(path)
+    try:
+        mode = stat.S_IMODE(os.stat(target).st_mode)
+    except FileNotFoundError:
+        mode = 0o666 & ~_UMASK
+    fd, temp_path = tempfile.mkstemp(
+        prefix=".saving-", suffix=os.path.splitext(target)[1],
+        dir=os.path.dirname(target)
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            encode(image, f, format_for(path), **options)
+        # mkstemp creates the file readable by its owner only
+        os.chmod(temp_path, mode)
+        os.replace(temp_path, target)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+class SaveJob:
+    """Saves an image snapshot on a worker thread.
+
+    The caller hands over an image nobody else will modify (a copy of the
+    document) and polls ``done()``. The thread is not a daemon, so the
+    interpreter finishes the save before exiting.
+    """
+
+    def __init__(self, image, path, **options):
+        self.path = path
+        self.error = None
+        self.seconds = None
+        self._thread = threading.Thread(
+            target=self._run, args=(image, options), name="save"
+        )
+        self._thread.start()
+
+    def _run(self, image, options):
+        start = time.perf_counter()
+        try:
+            save(image, self.path, **options)
+        except Exception as e:
+            self.error = e
+        self.seconds = time.perf_counter() - start
+
+    def done(self):
+        return not self._thread.is_alive()
+
+    def wait(self):
+        self._thread.join()
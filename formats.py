@@ -0,0 +1,108 @@
+"""Document pixel formats.
+
+A document's background layer is stored in one of four Pillow modes:
+
+    RGBA  4 bytes a pixel
+    RGB   3 bytes, no transparency
+    P     1 byte, an index into the fixed 256-colour ``PALETTE``
+    L     1 byte of grey
+
+Layers above the background need transparency, so they are RGBA, or LA
+in a greyscale document (``layer_mode``). Tools paint in RGBA and
+``convert`` their result back into the layer's mode; colours are turned
+into the mode's own pixel values with ``pixel``.
+
+Every palette image the application creates uses the same palette, so an
+index means the same colour in every tile, layer and undo patch, and
+pixels can be compared and copied without looking at the palette.
+Nothing in here imports Tkinter.
+"""
+from functools import lru_cache
+
+from PIL import Image, ImageColor
+
+# Document formats and their menu labels
+FORMATS = {
+    "RGBA": "RGBA (32-bit)",
+    "RGB": "RGB (24-bit)",
+    "P": "Indexed (256 colours)",
+    "L": "Greyscale",
+}
+LAYER_MODES = {"RGBA": "RGBA", "RGB": "RGBA", "P": "RGBA",
+               "L": "LA", "LA": "LA"}
+
+
+def _palette():
+    # A 6x6x6 colour cube (with black, white and the primaries exact)
+    # and 40 more greys for line art and shading
+    levels = (0, 51, 102, 153, 204, 255)
+    colors = [(r, g, b) for r in levels for g in levels for b in levels]
+    colors += [(round(255 * i / 41),) * 3 for i in range(1, 41)]
+    return [value for color in colors for value in color]
+
+
+PALETTE = _palette()
+_PALETTE_IMAGE = Image.new("P", (1, 1))
+_PALETTE_IMAGE.putpalette(PALETTE)
+
+
+def layer_mode(mode):
+    """The mode of layers added above a background of ``mode``."""
+    return LAYER_MODES[mode]
+
+
+def new(mode, size, color=0):
+    """``Image.new``, with the document palette for mode P."""
+    image = Image.new(mode, size, pixel(color, mode))
+    if mode == "P":
+        image.putpalette(PALETTE)
+    return image
+
+
+def convert(image, mode):
+    """A Pillow image in ``mode``; palette images get the nearest colour
+    of the document palette, undithered."""
+    if image.mode == mode:
+        return image
+    if mode == "P":
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        return image.quantize(palette=_PALETTE_IMAGE,
+                              dither=Image.Dither.NONE)
+    return image.convert(mode)
+
+
+def to_rgba(image):
+    return convert(image, "RGBA")
+
+
+@lru_cache(maxsize=256)
+def _from_rgba(rgba, mode):
+    return convert(Image.new("RGBA", (1, 1), rgba), mode).getpixel((0, 0))
+
+
+def pixel(value, mode):
+    """The pixel value of a colour in ``mode``, as ``getpixel`` gives it.
+
+    ``value`` is a colour name or "#rrggbb", an RGB(A) tuple, or already
+    a pixel of ``mode`` (a tuple of as many bands, or a single number).
+    """
+    if isinstance(value, list):
+        value = tuple(value)
+    bands = Image.getmodebands(mode)
+    if isinstance(value, str):
+        value = ImageColor.getcolor(value, "RGBA")
+    elif isinstance(value, tuple) and len(value) == bands:
+        return value[0] if bands == 1 else value
+    elif not isinstance(value, tuple):
+        return value
+    if len(value) == 3:
+        value += (255,)
+    return value if mode == "RGBA" else _from_rgba(value, mode)
+
+
+def convert_pixel(value, source_mode, mode):
+    """A pixel of ``source_mode`` as a pixel of ``mode``."""
+    if source_mode == mode:
+        return value
+    return convert(new(source_mode, (1, 1), value), mode).getpixel((0, 0))
@@ -0,0 +1,318 @@
+"""Tile-based undo/redo history.
+
+Instead of copying the whole image for every action, the history keeps a
+single copy of the last committed state (the base) and records only the
+tiles an action changed, as compressed before/after patches.
+
+A document with several layers tracks each layer's image under its own
+key; every action remembers the key it was committed for, so undo and
+redo go back and forth across layers in the order things were drawn.
+
+Only the actions nearest the current state keep their patches in
+memory. Older ones are spilled to a temporary file and read back when
+undo or redo reaches them, so the depth of the history is bounded by a
+byte budget rather than by RAM.
+"""
+import struct
+import tempfile
+import zlib
+from collections import deque
+
+from PIL import Image
+
+from tiles import TiledImage
+
+PATCH_HEADER = struct.Struct("<6I")  # x, y, width, height, before, after
+
+
+class _Entry:
+    """One action: its tile patches and where they live."""
+
+    __slots__ = ("mode", "patches", "nbytes", "key", "spill")
+
+    def __init__(self, mode, patches, nbytes, key):
+        self.mode = mode
+        self.patches = patches  # None while only on disk
+        self.nbytes = nbytes
+        self.key = key
+        self.spill = None  # (offset, length) in the spill file, once written
+
+
+class TileHistory:
+    """Undo/redo stacks of tile patches, bounded by a byte budget."""
+
+    def __init__(self, tile_size=64, budget=64 * 1024 * 1024,
+                 memory_entries=32, spill_dir=None):
+        self.tile_size = tile_size
+        self.budget = budget  # Max bytes of compressed patches to keep
+        self.memory_entries = memory_entries  # Actions kept in RAM
+        self.spill_dir = spill_dir  # None means the system temp dir
+        self.undo_stack = deque()
+        self.redo_stack = deque()
+        self.nbytes = 0
+        self.memory_bytes = 0  # Part of nbytes held in RAM
+        self.in_memory = 0  # Entries whose patches are in RAM
+        self.spill_file = None
+        self.spill_garbage = 0  # Bytes of the file no entry refers to
+        self.images = {}  # key -> tracked image
+        self.bases = {}  # key -> copy of its last committed state
+        self.last_key = None  # Key changed by the latest undo or redo
+
+    def reset(self, image, key=None):
+        # Start a fresh history for a new or reopened document
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+        self.nbytes = 0
+        self.memory_bytes = 0
+        self.in_memory = 0
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+        self.spill_garbage = 0
+        self.images.clear()
+        self.bases.clear()
+        self.rebase(image, key)
+
+    def rebase(self, image, key=None):
+        # Keep the recorded actions but track a new or resized image
+        self.images[key] = image
+        self.bases[key] = image.copy()
+
+    def forget(self, key):
+        # Stop tracking a removed layer and drop its actions
+        del self.images[key], self.bases[key]
+        for stack in (self.undo_stack, self.redo_stack):
+            kept = []
+            for entry in stack:
+                if entry.key == key:
+                    self._drop(entry)
+                else:
+                    kept.append(entry)
+            stack.clear()
+            stack.extend(kept)
+
+    def can_undo(self):
+        return bool(self.undo_stack)
+
+    def can_redo(self):
+        return bool(self.redo_stack)
+
+    def _tile_box(self, bbox, size):
+        # Clip bbox to the image and snap it outwards to the tile grid
+        width, height = size
+        step = self.tile_size
+        x0, y0, x1, y1 = bbox if bbox else (0, 0, width, height)
+        x0 = max(0, int(x0)) // step * step
+        y0 = max(0, int(y0)) // step * step
+        x1 = min(width, -(-int(x1) // step) * step)
+        y1 = min(height, -(-int(y1) // step) * step)
+        if x0 >= x1 or y0 >= y1:
+            return None
+        return (x0, y0, x1, y1)
+
+    def commit(self, image, bbox=None, key=None):
+        """Record the tiles changed inside ``bbox`` since the last commit.
+
+        Returns True if anything changed.
+        """
+        # Imported on first use, after the window is up
+        import numpy as np
+        box = self._tile_box(bbox, image.size)
+        if box is None:
+            return False
+        base = self.bases[key]
+        self.images[key] = image
+        x0, y0, x1, y1 = box
+        step = self.tile_size
+        patches = []
+        nbytes = 0
+        # One row of tiles at a time, so a commit over a huge image never
+        # holds more than a strip of it
+        for top in range(y0, y1, step):
+            strip = (x0, top, x1, min(y1, top + step))
+            after = np.asarray(image.crop(strip))
+            before = np.asarray(base.crop(strip))
+            # Changed columns of the strip, reduced over rows first since
+            # that runs along memory
+            changed = (after != before).reshape(len(after), -1).any(axis=0)
+            changed = changed.reshape(x1 - x0, -1).any(axis=1)
+            for tx in range(0, x1 - x0, step):
+                cols = slice(tx, tx + step)
+                if not changed[cols].any():
+                    continue
+                tile_before = before[:, cols]
+                tile_height, tile_width = tile_before.shape[:2]
+                patch = (
+                    x0 + tx, top, tile_width, tile_height,
+                    zlib.compress(tile_before.tobytes(), 1),
+                    zlib.compress(after[:, cols].tobytes(), 1)
+                )
+                nbytes += len(patch[4]) + len(patch[5])
+                patches.append(patch)
+        if not patches:
+            return False
+
+        if isinstance(base, TiledImage):
+            base.copy_from(image, box)
+        else:
+            base.paste(image.crop(box), box)
+        for entry in self.redo_stack:
+            self._drop(entry)
+        self.redo_stack.clear()
+        self.undo_stack.append(_Entry(image.mode, patches, nbytes, key))
+        self.nbytes += nbytes
+        self.memory_bytes += nbytes
+        self.in_memory += 1
+        self._trim()
+        self._spill()
+        return True
+
+    def undo(self, image=None):
+        """Revert the last action in place; returns the changed box.
+
+        ``image`` overrides the tracked image; ``last_key`` tells which
+        key the action belonged to.
+        """
+        if not self.undo_stack:
+            return None
+        entry = self.undo_stack.pop()
+        self.redo_stack.append(entry)
+        bbox = self._apply(image, entry, 4)
+        self._spill()
+        return bbox
+
+    def redo(self, image=None):
+        """Reapply the last undone action; returns the changed box."""
+        if not self.redo_stack:
+            return None
+        entry = self.redo_stack.pop()
+        self.undo_stack.append(entry)
+        bbox = self._apply(image, entry, 5)
+        self._spill()
+        return bbox
+
+    def _apply(self, image, entry, field):
+        from raster import union_bbox
+        self.last_key = entry.key
+        if image is None:
+            image = self.images[entry.key]
+        base = self.bases[entry.key]
+        width, height = image.size
+        bbox = None
+        # Patches come a row at a time; a tiled image is compacted behind
+        # them, so undoing a huge fill does not leave every tile painted
+        tiled = isinstance(image, TiledImage) and isinstance(base, TiledImage)
+        row, pending = None, None
+        for patch in self._load(entry):
+            x, y, tile_width, tile_height = patch[:4]
+            if x >= width or y >= height:
+                continue  # Tile lies outside a since-shrunk image
+            if tiled and y // image.tile_size != row:
+                if pending:
+                    image.compact(pending)
+                    base.compact(pending)
+                row, pending = y // image.tile_size, None
+            tile = Image.frombytes(
+                entry.mode, (tile_width, tile_height),
+                zlib.decompress(patch[field])
+            )
+            tile = tile.crop((0, 0, min(tile_width, width - x),
+                              min(tile_height, height - y)))
+            image.paste(tile, (x, y))
+            base.paste(tile, (x, y))
+            box = (x, y, x + tile.width, y + tile.height)
+            bbox = union_bbox(bbox, box)
+            pending = union_bbox(pending, box)
+        if tiled and pending:
+            image.compact(pending)
+            base.compact(pending)
+        return bbox
+
+    def _trim(self):
+        # Drop the oldest actions once the byte budget is exceeded,
+        # always keeping the most recent one undoable
+        while self.nbytes > self.budget and len(self.undo_stack) > 1:
+            self._drop(self.undo_stack.popleft())
+
+    def _drop(self, entry):
+        self.nbytes -= entry.nbytes
+        if entry.patches is not None:
+            self.memory_bytes -= entry.nbytes
+            self.in_memory -= 1
+        if entry.spill is not None:
+            self.spill_garbage += entry.spill[1]
+
+    def _spill(self):
+        # Keep the patches of the actions nearest the current state (the
+        # tops of both stacks) in memory and move the rest to disk
+        if self.in_memory <= self.memory_entries:
+            return
+        undo, redo = self.undo_stack, self.redo_stack
+        nearest = []
+        for depth in range(1, max(len(undo), len(redo)) + 1):
+            for stack in (undo, redo):
+                if depth <= len(stack):
+                    nearest.append(stack[-depth])
+        for entry in nearest[self.memory_entries:]:
+            if entry.patches is not None:
+                self._write(entry)
+        if self.spill_garbage > self.spill_file.seek(0, 2) // 2:
+            self._compact()
+
+    def _write(self, entry):
+        if entry.spill is None:
+            if self.spill_file is None:
+                self.spill_file = tempfile.TemporaryFile(
+                    prefix="sda-history-", dir=self.spill_dir
+                )
+            offset = self.spill_file.seek(0, 2)
+            for patch in entry.patches:
+                self.spill_file.write(PATCH_HEADER.pack(
+                    *patch[:4], len(patch[4]), len(patch[5])
+                ))
+                self.spill_file.write(patch[4])
+                self.spill_file.write(patch[5])
+            entry.spill = (offset, self.spill_file.tell() - offset)
+        # An entry read back earlier is still on disk and is just dropped
+        entry.patches = None
+        self.memory_bytes -= entry.nbytes
+        self.in_memory -= 1
+
+    def _load(self, entry):
+        # Read a spilled action back; it stays in memory until it is
+        # far enough from the current state to be spilled again
+        if entry.patches is not None:
+            return entry.patches
+        offset, length = entry.spill
+        self.spill_file.seek(offset)
+        data = self.spill_file.read(length)
+        patches = []
+        position = 0
+        while position < length:
+            *geometry, before, after = PATCH_HEADER.unpack_from(data, position)
+            position += PATCH_HEADER.size
+            patches.append((
+                *geometry, data[position:position + before],
+                data[position + before:position + before + after]
+            ))
+            position += before + after
+        entry.patches = patches
+        self.memory_bytes += entry.nbytes
+        self.in_memory += 1
+        return patches
+
+    def _compact(self):
+        # Rewrite the spill file without the space of dropped actions
+        spilled = [entry for stack in (self.undo_stack, self.redo_stack)
+                   for entry in stack if entry.spill is not None]
+        old_file = self.spill_file
+        self.spill_file = tempfile.TemporaryFile(
+            prefix="sda-history-", dir=self.spill_dir
+        )
+        for entry in spilled:
+            offset, length = entry.spill
+            old_file.seek(offset)
+            entry.spill = (self.spill_file.tell(), length)
+            self.spill_file.write(old_file.read(length))
+        old_file.close()
+        self.spill_garbage = 0
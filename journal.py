@@ -0,0 +1,240 @@
+"""Append-only journal of drawing operations, with headless replay.
+
+Every tool action is recorded as a small dict (an operation record), e.g.::
+
+    {"op": "stroke", "tool": "brush", "color": "#000000", "size": 10,
+     "hardness": 1.0, "shape": "round", "spacing": 0.1,
+     "points": [x0, y0, x1, y1, ...], "curve": true}
+
+Strokes with ``curve`` hold the pointer samples the application kept
+(``strokes.Simplifier``) and are stamped along the smooth curve through
+them (``strokes.curve``), as the application stamped them while drawing;
+older strokes are stamped along the points as given.
+Layer changes are records too, e.g. ``{"op": "layer", "action": "add"}``
+or ``{"op": "layer", "action": "opacity", "index": 1, "value": 0.5}``;
+drawing records apply to whichever layer is selected. Selection edits
+carry the selection they act on, e.g.
+``{"op": "move", "selection": {"shape": "rectangle", "box": [...]},
+"by": [dx, dy]}``; ``paste`` drops what the last ``copy`` or ``cut``
+took, so replay needs no clipboard of its own. ``{"op": "composite",
+"path": "logo.png", "at": [x, y]}`` draws an image file over the
+selected layer; the application never records it, but batch scripts can
+use it to stamp overlays. ``new`` and ``open`` records may carry the
+document's pixel ``format`` (see ``formats``; RGBA if missing), and
+``{"op": "format", "format": "L"}`` converts the document and starts a
+fresh undo history. Drawing records only change pixels inside the
+document size set by the last ``new``, ``open`` or ``resize``; the
+layers' backing store never shrinks, so it may be larger.
+
+A journal file is gzip-compressed JSON, one record per line. Replaying it
+with ``replay`` rebuilds the image with Pillow alone, using the same raster
+functions and the same sparse tiled layers (``tiles``) as the application,
+so the backing store grows the same way and the result is identical.
+"""
+import gzip
+import json
+from functools import lru_cache
+
+import formats
+import tiles
+from history import TileHistory
+from layers import LayerStack
+
+
+class Journal:
+    def __init__(self):
+        self.ops = []
+
+    def record(self, op, **fields):
+        fields["op"] = op
+        self.ops.append(fields)
+
+    def reset(self, op, **fields):
+        # Start over from an operation that replaces the whole image
+        self.ops = []
+        self.record(op, **fields)
+
+    def save(self, path):
+        with gzip.open(path, "wt", encoding="utf-8") as f:
+            for op in self.ops:
+                f.write(json.dumps(op, separators=(",", ":")))
+                f.write("\n")
+
+    @classmethod
+    def load(cls, path):
+        journal = cls()
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            journal.ops = [json.loads(line) for line in f if line.strip()]
+        return journal
+
+
+@lru_cache(maxsize=8)
+def _overlay(path):
+    # Overlays are read-only, so one copy serves every replay
+    import raster
+    return raster.load_image(path)
+
+
+class Replayer:
+    """Applies operation records to an image without any Tk involvement."""
+
+    def __init__(self, image=None, tile_size=tiles.TILE_SIZE):
+        self.history = TileHistory()
+        self.tile_size = tile_size
+        self.layers = None
+        self.image = None  # The selected layer's image
+        self.size = None  # Document size; the images may be larger
+        self.clipboard = None  # (RGBA image, x, y) of the last copy or cut
+        if image is not None:
+            self._set_image(image)
+
+    def result(self):
+        """The flattened document, cropped out of the backing store."""
+        return self.layers.flatten(self.size)
+
+    def _set_image(self, image):
+        image = tiles.tiled(image, "white", self.tile_size)
+        self.layers = LayerStack(image)
+        self.size = image.size
+        self.history.reset(image, self.layers.active_layer)
+        self._select()
+
+    def _select(self):
+        self.image = self.layers.active_layer.image
+
+    def _apply_layer(self, op):
+        layers = self.layers
+        action = op["action"]
+        index = op.get("index", layers.active)
+        if action == "add":
+            layer = layers.add(op.get("name"))
+            self.history.rebase(layer.image, layer)
+        elif action == "remove":
+            self.history.forget(layers.remove(index))
+        elif action == "move":
+            layers.move(index, op["to"])
+        elif action == "select":
+            layers.select(index)
+        elif action == "visible":
+            layers.set_visible(index, op["value"])
+        elif action == "opacity":
+            layers.set_opacity(index, op["value"])
+        elif action == "blend":
+            layers.set_blend(index, op["value"])
+        else:
+            raise ValueError(f"Unknown layer action: {action}")
+        self._select()
+        return (0, 0) + self.size
+
+    def apply(self, op):
+        """Apply one record; returns the changed bounding box or None."""
+        # The tools load NumPy, which the application only wants after its
+        # first frame; recording doesn't need them
+        import brush
+        import raster
+        import selection
+        import strokes
+        kind = op["op"]
+        if kind == "new":
+            self._set_image(tiles.TiledImage(
+                op.get("format", "RGBA"), op["size"], "white", self.tile_size
+            ))
+            return (0, 0) + self.image.size
+        if kind == "open":
+            self._set_image(formats.convert(
+                raster.load_image(op["path"]), op.get("format", "RGBA")
+            ))
+            return (0, 0) + self.image.size
+        if kind == "format":
+            self.layers.convert(op["format"])
+            self.history.reset(self.layers.layers[0].image,
+                               self.layers.layers[0])
+            for layer in self.layers.layers[1:]:
+                self.history.rebase(layer.image, layer)
+            self._select()
+            return (0, 0) + self.size
+        if kind == "resize":
+            # Same grow-only backing store as the application
+            width, height = op["size"]
+            if self.layers.grow(width, height):
+                for layer in self.layers.layers:
+                    self.history.rebase(layer.image, layer)
+                self._select()
+            self.size = (width, height)
+            return (0, 0, width, height)
+        if kind == "layer":
+            return self._apply_layer(op)
+        if kind in ("undo", "redo"):
+            history = self.history
+            bbox = history.undo() if kind == "undo" else history.redo()
+            if bbox:
+                self.layers.invalidate(bbox, history.last_key)
+            return bbox
+
+        layer = self.layers.active_layer
+        if kind == "stroke":
+            # The eraser paints the layer's own background: white on the
+            # background layer, transparency elsewhere
+            color = op["color"] if op["tool"] == "brush" else layer.fill
+            points = op["points"]
+            if op.get("curve"):
+                points = strokes.curve(points)
+            bbox = None
+            if "spacing" in op:
+                stroke = brush.Stroke(op["size"], op["hardness"],
+                                      op["shape"], op["spacing"])
+                for i in range(0, len(points), 2):
+                    bbox = raster.union_bbox(bbox, stroke.to(
+                        self.image, color, *points[i:i + 2], self.size
+                    ))
+            else:
+                # Journals from before the dab engine drew line segments
+                for i in range(0, len(points) - 2, 2):
+                    bbox = raster.union_bbox(bbox, raster.draw_segment_on(
+                        self.image, *points[i:i + 4], color, op["size"]
+                    ))
+        elif kind == "shape":
+            bbox = raster.draw_shape_on(
+                self.image, op["shape"], *op["box"], op["color"], op["size"],
+                self.size
+            )
+        elif kind in ("copy", "cut", "delete", "move"):
+            region = selection.Selection.from_spec(op["selection"], self.size)
+            if region is None:
+                return None
+            if kind in ("copy", "cut"):
+                self.clipboard = (selection.extract(self.image, region),
+                                  *region.bbox[:2])
+            if kind == "copy":
+                return None
+            if kind == "move":
+                bbox = selection.move(self.image, region, *op["by"],
+                                      layer.fill, self.size)
+            else:
+                bbox = selection.clear(self.image, region, layer.fill)
+        elif kind == "paste":
+            bbox = selection.paste(self.image, self.clipboard[0], *op["at"],
+                                   self.size)
+        elif kind == "composite":
+            bbox = selection.paste(self.image, _overlay(op["path"]), *op["at"],
+                                   self.size)
+        elif kind == "fill":
+            bbox = raster.flood_fill(
+                self.image, *op["at"], raster.hex_to_rgba(op["color"]),
+                tolerance=op.get("tolerance", 0),
+                connectivity=op.get("connectivity", 4), size=self.size
+            )
+        else:
+            raise ValueError(f"Unknown journal operation: {kind}")
+        if bbox:
+            self.history.commit(self.image, bbox, layer)
+            self.layers.invalidate(bbox)
+        return bbox
+
+
+def replay(ops, image=None):
+    """Rebuild an image from a sequence of operation records."""
+    replayer = Replayer(image)
+    for op in ops:
+        replayer.apply(op)
+    return replayer.result()
@@ -0,0 +1,332 @@
+"""Layer stack with a cached, tile-by-tile composite.
+
+Tools draw into the active layer's image and report the changed box with
+``invalidate``; ``composite`` then recomputes only the dirty tiles. The
+layers below the active one and (when they all blend normally) the
+layers above it are kept flattened per tile, so redrawing a tile costs
+two blends however many layers the document has.
+
+Layer images may be Pillow images or sparse ``tiles.TiledImage``s. With
+tiled layers the composite is tiled too, and a tile where every layer is
+a single colour is composited on one pixel and stored as a colour.
+
+The background layer's mode is the document's pixel format (see
+``formats``); the layers above it have ``formats.layer_mode`` of it.
+Blending is done in RGBA, and ``flatten`` hands the result back in the
+document's format.
+"""
+from PIL import Image
+
+import formats
+import tiles
+
+TRANSPARENT = (0, 0, 0, 0)
+BLEND_MODES = ("normal", "multiply", "screen", "darken", "lighten", "add")
+
+
+class Layer:
+    def __init__(self, image, name, fill=TRANSPARENT):
+        self.image = image
+        self.name = name
+        self.fill = fill  # Colour of new area when the document grows
+        self.visible = True
+        self.opacity = 1.0
+        self.blend = "normal"
+
+    def props(self):
+        return {"name": self.name, "fill": self.fill, "visible": self.visible,
+                "opacity": self.opacity, "blend": self.blend}
+
+
+def _blend_channels(mode, below, above):
+    # Separable blend functions on colours scaled to 0..1
+    import numpy as np
+    if mode == "multiply":
+        return below * above
+    if mode == "screen":
+        return below + above - below * above
+    if mode == "darken":
+        return np.minimum(below, above)
+    if mode == "lighten":
+        return np.maximum(below, above)
+    if mode == "add":
+        return np.minimum(1.0, below + above)
+    raise ValueError(f"Unknown blend mode: {mode}")
+
+
+def blend(dst, src, mode="normal", opacity=1.0):
+    """Composite the RGBA tile ``src`` over ``dst``; returns a new tile."""
+    if mode == "normal":
+        if opacity < 1:
+            src = src.copy()
+            src.putalpha(src.getchannel("A").point(
+                lambda a: round(a * opacity)
+            ))
+        return Image.alpha_composite(dst, src)
+
+    # NumPy is imported here so that opening a window doesn't wait for it
+    import numpy as np
+    below = np.asarray(dst, dtype=np.float32) / 255
+    above = np.asarray(src, dtype=np.float32) / 255
+    below_rgb, below_alpha = below[..., :3], below[..., 3:]
+    above_rgb, above_alpha = above[..., :3], above[..., 3:] * opacity
+    # Where the backdrop is transparent the layer shows its own colour
+    mixed = ((1 - below_alpha) * above_rgb
+             + below_alpha * _blend_channels(mode, below_rgb, above_rgb))
+    alpha = above_alpha + below_alpha * (1 - above_alpha)
+    rgb = (above_alpha * mixed + below_alpha * below_rgb * (1 - above_alpha))
+    rgb = np.divide(rgb, alpha, out=np.zeros_like(rgb), where=alpha > 0)
+    out = np.concatenate([rgb, alpha], axis=2) * 255 + 0.5
+    return Image.fromarray(out.astype(np.uint8), "RGBA")
+
+
+class LayerStack:
+    """Ordered layers (bottom first) and their composite."""
+
+    def __init__(self, image, tile_size=256):
+        self.tile_size = tile_size
+        self.layers = [Layer(image, "Background", fill="white")]
+        self.active = 0
+        self.composite_image = None
+        self.below = None  # Flattened layers under the active one
+        self.above = None  # Flattened layers over it, if all are normal
+        self.dirty = set()  # Composite tiles needing recomputation
+        self.below_valid = set()
+        self.above_valid = set()
+        self._restructure()
+
+    @property
+    def size(self):
+        return self.layers[0].image.size
+
+    @property
+    def mode(self):
+        # The document's pixel format
+        return self.layers[0].image.mode
+
+    @property
+    def active_layer(self):
+        return self.layers[self.active]
+
+    def add(self, name=None):
+        """Insert an empty layer above the active one and select it."""
+        background = self.layers[0].image
+        image = tiles.new_like(background, TRANSPARENT,
+                               formats.layer_mode(background.mode))
+        layer = Layer(image, name or f"Layer {len(self.layers)}")
+        self.active += 1
+        self.layers.insert(self.active, layer)
+        self._restructure()
+        return layer
+
+    def remove(self, index):
+        if len(self.layers) == 1:
+            raise ValueError("cannot remove the only layer")
+        if index == 0:
+            # The background sets the document's mode and opacity
+            raise ValueError("cannot remove the background layer")
+        layer = self.layers.pop(index)
+        if self.active >= index and self.active > 0:
+            self.active -= 1
+        self._restructure()
+        return layer
+
+    def move(self, index, to):
+        if 0 in (index, to):
+            raise ValueError("the background layer stays at the bottom")
+        active_layer = self.active_layer
+        self.layers.insert(to, self.layers.pop(index))
+        self.active = self.layers.index(active_layer)
+        self._restructure()
+
+    def select(self, index):
+        self.active = index
+        self._restructure(dirty=False)
+
+    def set_visible(self, index, visible):
+        self.layers[index].visible = visible
+        self._restructure()
+
+    def set_opacity(self, index, opacity):
+        self.layers[index].opacity = min(1.0, max(0.0, opacity))
+        self._restructure()
+
+    def set_blend(self, index, mode):
+        if mode not in BLEND_MODES:
+            raise ValueError(f"Unknown blend mode: {mode}")
+        self.layers[index].blend = mode
+        self._restructure()
+
+    def grow(self, width, height):
+        """Grow every layer's backing store; returns True if reallocated."""
+        if width <= self.size[0] and height <= self.size[1]:
+            return False
+        for layer in self.layers:
+            layer.image = tiles.grown(layer.image, width, height, layer.fill)
+        self._restructure()
+        return True
+
+    def map_images(self, function):
+        # Replace each layer's image with function(layer), e.g. to store
+        # a replayed document as tiles; the composite is rebuilt
+        for layer in self.layers:
+            layer.image = function(layer)
+        self.composite_image = None
+        self._restructure()
+
+    def converted_images(self, mode):
+        """Each layer's image as it would be in a document of ``mode``;
+        the layers themselves are left alone."""
+        return [
+            tiles.converted(layer.image, mode if layer is self.layers[0]
+                            else formats.layer_mode(mode))
+            for layer in self.layers
+        ]
+
+    def convert(self, mode):
+        """Change the document's pixel format to ``mode``; the layers
+        above the background get ``formats.layer_mode`` of it."""
+        images = iter(self.converted_images(mode))
+        self.map_images(lambda layer: next(images))
+
+    def invalidate(self, bbox, layer=None):
+        """Mark a box of ``layer`` (the active one if None) as changed."""
+        tiles = self._tiles(bbox)
+        self.dirty.update(tiles)
+        if layer is not None and layer is not self.active_layer:
+            self.below_valid.difference_update(tiles)
+            self.above_valid.difference_update(tiles)
+
+    def composite(self):
+        """Bring the composite up to date and return it.
+
+        A lone, plainly blended layer is its own composite, so
+        single-layer documents pay nothing for the layer model.
+        """
+        if self._trivial():
+            self.dirty.clear()
+            return self.active_layer.image
+        if self.composite_image is None or \
+                self.composite_image.size != self.size:
+            image = self.layers[0].image
+            self.composite_image = tiles.new_like(image, TRANSPARENT, "RGBA")
+            self.below = tiles.new_like(image, TRANSPARENT, "RGBA")
+            self.above = tiles.new_like(image, TRANSPARENT, "RGBA")
+        for tile in self.dirty:
+            box = self._tile_box(tile)
+            if box:
+                color = self._plain(box)
+                if color is not None:
+                    self.composite_image.paste(color, box)
+                else:
+                    self.composite_image.paste(self._compose(tile, box), box)
+        self.dirty.clear()
+        return self.composite_image
+
+    def flatten(self, size=None):
+        """A standalone copy of the composite, cropped to ``size``, in the
+        document's format."""
+        flat = self.composite().crop((0, 0) + (size or self.size))
+        return formats.convert(flat, self.mode)
+
+    def snapshot(self, size=None):
+        """Like ``flatten``, but a tiled composite is copied lazily: its
+        tiles are only duplicated once the document changes them."""
+        composite = self.composite()
+        if isinstance(composite, tiles.TiledImage):
+            return tiles.converted(composite.resized(size or self.size),
+                                   self.mode)
+        return self.flatten(size)
+
+    def _trivial(self):
+        layer = self.layers[0]
+        return (len(self.layers) == 1 and layer.visible
+                and layer.opacity == 1 and layer.blend == "normal")
+
+    def _restructure(self, dirty=True):
+        # Layer order, selection or properties changed: the cached
+        # partial composites no longer apply
+        self.below_valid.clear()
+        self.above_valid.clear()
+        if dirty:
+            self.dirty = set(self._tiles((0, 0) + self.size))
+
+    def _tiles(self, bbox):
+        x0, y0, x1, y1 = bbox
+        step = self.tile_size
+        return {(tx, ty)
+                for ty in range(max(0, int(y0)) // step, -(-int(y1) // step))
+                for tx in range(max(0, int(x0)) // step, -(-int(x1) // step))}
+
+    def _tile_box(self, tile):
+        step = self.tile_size
+        width, height = self.size
+        box = (tile[0] * step, tile[1] * step,
+               min(width, (tile[0] + 1) * step),
+               min(height, (tile[1] + 1) * step))
+        if box[0] >= box[2] or box[1] >= box[3]:
+            return None
+        return box
+
+    def _stack(self, layers, box):
+        tile = Image.new("RGBA", (box[2] - box[0], box[3] - box[1]),
+                         TRANSPARENT)
+        for layer in layers:
+            if layer.visible and layer.opacity > 0:
+                tile = blend(tile, formats.to_rgba(layer.image.crop(box)),
+                             layer.blend, layer.opacity)
+        return tile
+
+    def _plain(self, box):
+        # The composite colour of box if every visible layer is a single
+        # colour there: the blends of _compose, done on one pixel
+        colors = {}
+        for index, layer in enumerate(self.layers):
+            if layer.visible and layer.opacity > 0:
+                colors[index] = tiles.uniform(layer.image, box)
+                if colors[index] is None:
+                    return None
+
+        def stack(indices, pixel):
+            for index in indices:
+                if index in colors:
+                    layer = self.layers[index]
+                    color = formats.convert_pixel(
+                        colors[index], layer.image.mode, "RGBA"
+                    )
+                    pixel = blend(pixel, Image.new("RGBA", (1, 1), color),
+                                  layer.blend, layer.opacity)
+            return pixel
+
+        transparent = Image.new("RGBA", (1, 1), TRANSPARENT)
+        result = stack([self.active], stack(range(self.active), transparent))
+        above = range(self.active + 1, len(self.layers))
+        if all(self.layers[index].blend == "normal" for index in above):
+            result = Image.alpha_composite(result, stack(above, transparent))
+        else:
+            result = stack(above, result)
+        return result.getpixel((0, 0))
+
+    def _compose(self, tile, box):
+        if tile not in self.below_valid:
+            self.below.paste(self._stack(self.layers[:self.active], box), box)
+            self.below_valid.add(tile)
+        result = self.below.crop(box)
+        layer = self.active_layer
+        if layer.visible and layer.opacity > 0:
+            result = blend(result, formats.to_rgba(layer.image.crop(box)),
+                           layer.blend, layer.opacity)
+
+        above = self.layers[self.active + 1:]
+        if all(layer.blend == "normal" for layer in above):
+            # "Over" is associative, so the layers above can be
+            # flattened once and reused while the active layer changes
+            if tile not in self.above_valid:
+                self.above.paste(self._stack(above, box), box)
+                self.above_valid.add(tile)
+            return Image.alpha_composite(result, self.above.crop(box))
+        for layer in above:
+            if layer.visible and layer.opacity > 0:
+                result = blend(result, formats.to_rgba(layer.image.crop(box)),
+                               layer.blend, layer.opacity)
+        return result
@@ -0,0 +1,99 @@
+"""Lightweight latency instrumentation.
+
+Functions wrapped with ``timed`` record how long each call takes into a
+ring-buffer histogram, so percentiles always describe recent activity.
+The histograms are not locked: record from one thread only (the Tk
+thread in the application).
+"""
+import functools
+import json
+import os
+import time
+from collections import deque
+
+
+class LatencyHistogram:
+    """Keeps the most recent durations and answers percentile queries."""
+
+    def __init__(self, size=1024):
+        self.samples = deque(maxlen=size)
+        self.count = 0  # Calls seen in total, not just those still kept
+        self.total = 0.0
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+        self.total += seconds
+
+    def percentile(self, percent):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        index = round(percent / 100 * (len(ordered) - 1))
+        return ordered[index]
+
+    def summary(self):
+        # Durations in milliseconds
+        return {
+            "count": self.count,
+            "mean_ms": self.total / self.count * 1000 if self.count else 0.0,
+            "p50_ms": self.percentile(50) * 1000,
+            "p90_ms": self.percentile(90) * 1000,
+            "p99_ms": self.percentile(99) * 1000,
+            "max_ms": max(self.samples, default=0.0) * 1000,
+        }
+
+
+histograms = {}
+
+
+def record(name, seconds):
+    if name not in histograms:
+        histograms[name] = LatencyHistogram()
+    histograms[name].add(seconds)
+
+
+def timed(name):
+    """Decorator recording the duration of every call under ``name``."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def process_uptime():
+    """Seconds since this process was started, or None if unknown.
+
+    Read from /proc, so it is only available on Linux; it includes the
+    interpreter's own start-up, which in-process timers miss.
+    """
+    try:
+        with open("/proc/self/stat") as f:
+            # Fields after the parenthesised command name; starttime is
+            # field 22 of the whole line
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def snapshot():
+    return {name: hist.summary() for name, hist in sorted(histograms.items())}
+
+
+def dump(path, extra=None):
+    """Write all histogram summaries (plus ``extra`` fields) as JSON."""
+    report = {"timings": snapshot()}
+    if extra:
+        report.update(extra)
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+        f.write("\n")
@@ -0,0 +1,84 @@
+"""Retained-mode preview overlays on a Tk canvas.
+
+Previews (shape outlines, selection marquees, the fill-region tint) are
+drawn with canvas items that are created once and then moved with
+``coords`` and restyled with ``itemconfig``, never deleted while the
+pointer moves. Hidden items stay in the pool for the next preview.
+"""
+import tkinter as tk
+
+HANDLE_SIZE = 7  # Side of a marquee handle, in window pixels
+
+class Overlay:
+    """A pool of canvas items keyed by name."""
+
+    def __init__(self, canvas, tag="overlay"):
+        self.canvas = canvas
+        self.tag = tag
+        self.items = {}  # name -> (item id, kind)
+        self.options = {}  # name -> last options given to itemconfig
+        self.visible = set()
+        self.created = 0  # Items created so far, for instrumentation
+
+    def show(self, name, kind, coords, **options):
+        """Show item ``name`` of ``kind`` ("rectangle", "oval", "line"
+        or "polygon") at ``coords`` (window pixels)."""
+        entry = self.items.get(name)
+        if entry is None or entry[1] != kind:
+            if entry is not None:
+                self.canvas.delete(entry[0])
+            create = getattr(self.canvas, f"create_{kind}")
+            item = create(*coords, tags=self.tag, **options)
+            self.items[name] = (item, kind)
+            self.options[name] = options
+            self.visible.add(name)
+            self.created += 1
+            return item
+
+        item = entry[0]
+        self.canvas.coords(item, *coords)
+        if name not in self.visible:
+            options = dict(options, state=tk.NORMAL)
+            self.visible.add(name)
+            self.canvas.tag_raise(item)
+        if options != self.options[name]:
+            self.canvas.itemconfig(item, **options)
+            options.pop("state", None)
+            self.options[name] = options
+        return item
+
+    def hide(self, *names):
+        for name in names:
+            if name in self.visible:
+                self.canvas.itemconfig(self.items[name][0], state=tk.HIDDEN)
+                self.visible.discard(name)
+
+    def hide_group(self, prefix):
+        # Hide every item whose name starts with ``prefix``
+        self.hide(*[name for name in self.visible if name.startswith(prefix)])
+
+    def hide_all(self):
+        self.hide(*list(self.visible))
+
+    def show_marquee(self, prefix, box, handles=True):
+        """Marching-ants rectangle, optionally with handles at its corners
+        and the middles of its sides."""
+        x0, y0, x1, y1 = box
+        x0, x1 = min(x0, x1), max(x0, x1)
+        y0, y1 = min(y0, y1), max(y0, y1)
+        # A white dashed line over a black one reads on any background
+        self.show(f"{prefix}:under", "rectangle", (x0, y0, x1, y1),
+                  outline="black", width=1)
+        self.show(f"{prefix}:over", "rectangle", (x0, y0, x1, y1),
+                  outline="white", width=1, dash=(4, 4))
+        if not handles:
+            self.hide_group(f"{prefix}:handle")
+            return
+        half = HANDLE_SIZE / 2
+        mid_x, mid_y = (x0 + x1) / 2, (y0 + y1) / 2
+        points = ((x0, y0), (mid_x, y0), (x1, y0), (x1, mid_y),
+                  (x1, y1), (mid_x, y1), (x0, y1), (x0, mid_y))
+        for i, (x, y) in enumerate(points):
+            self.show(f"{prefix}:handle{i}", "rectangle",
+                      (x - half, y - half, x + half, y + half),
+                      outline="black", fill="white", width=1)
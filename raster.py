@@ -0,0 +1,448 @@
+"""Headless raster helpers shared by the drawing application.
+
+Nothing in here imports Tkinter, so the functions can be used (and timed)
+without opening a window.
+"""
+import numpy as np
+from PIL import Image, ImageDraw
+
+import formats
+
+
+def union_bbox(a, b):
+    """Smallest box covering both boxes; either may be None."""
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return (min(a[0], b[0]), min(a[1], b[1]),
+            max(a[2], b[2]), max(a[3], b[3]))
+
+
+def _pixel_array(image, colors=False):
+    # Always hand back a (height, width, channels) view of the pixel data
+    # of a Pillow image. With ``colors``, palette indices are looked up,
+    # so pixels can be compared by colour
+    if colors and image.mode == "P":
+        image = image.convert("RGB")
+    pixels = np.asarray(image)
+    if pixels.ndim == 2:
+        pixels = pixels[:, :, None]
+    return pixels
+
+
+def _row_runs(match):
+    # Find every horizontal run of matching pixels in one vectorised pass.
+    # Runs come back in row-major order, so they are sorted by row and
+    # then by start column.
+    height, width = match.shape
+    padded = np.zeros((height, width + 2), dtype=np.int8)
+    padded[:, 1:-1] = match
+    edges = np.diff(padded, axis=1)
+    run_rows, starts = np.nonzero(edges == 1)
+    _, ends = np.nonzero(edges == -1)
+    return run_rows, starts, ends
+
+
+def _run_links(run_rows, starts, ends, width, reach):
+    # Pair up every run with the runs it touches in the row below. Keys
+    # encode (row, column) as one sorted integer so a single searchsorted
+    # call finds the overlapping range for all runs at once.
+    stride = width + 4
+    start_keys = run_rows * stride + starts + 1
+    end_keys = run_rows * stride + ends + 1
+    below = (run_rows + 1) * stride + 1
+    lo = np.searchsorted(end_keys, below + starts - reach, side="right")
+    hi = np.searchsorted(start_keys, below + ends + reach, side="left")
+    counts = np.maximum(hi - lo, 0)
+    upper = np.repeat(np.arange(len(starts)), counts)
+    first = np.repeat(lo - np.cumsum(counts) + counts, counts)
+    lower = first + np.arange(len(upper))
+    return upper, lower
+
+
+def _components(count, upper, lower):
+    # Connected components of the run graph by hooking and pointer
+    # jumping; each pass is vectorised and only a handful are needed
+    parent = np.arange(count)
+    while True:
+        a = parent[upper]
+        b = parent[lower]
+        if (a == b).all():
+            return parent
+        np.minimum.at(parent, np.maximum(a, b), np.minimum(a, b))
+        while True:
+            jumped = parent[parent]
+            if (jumped == parent).all():
+                break
+            parent = jumped
+
+
+def _matches(pixels, target, tolerance):
+    # Pixels whose channels all differ from ``target`` by at most
+    # ``tolerance``, as a boolean (height, width) array
+    if tolerance:
+        diff = np.abs(pixels.astype(np.int16) - target.astype(np.int16))
+        return (diff <= tolerance).all(axis=2)
+    if pixels.shape[2] == 4:
+        # Compare whole RGBA pixels as single 32-bit words
+        packed = pixels.view(np.uint32)[:, :, 0]
+        return packed == np.ascontiguousarray(target).view(np.uint32)[0]
+    return (pixels == target).all(axis=2)
+
+
+def _runs_mask(rows, starts, ends):
+    # Paint spans into a mask covering their bounding box with a
+    # cumulative-sum trick. Spans in one row never overlap, but one may
+    # end where the next starts (in neighbouring tiles), so ends are
+    # subtracted rather than written. Returns (mask, bbox)
+    x0 = int(starts.min())
+    y0 = int(rows.min())
+    x1 = int(ends.max())
+    y1 = int(rows.max()) + 1
+    edges = np.zeros((y1 - y0, x1 - x0 + 1), dtype=np.int8)
+    edges[rows - y0, starts - x0] = 1
+    edges[rows - y0, ends - x0] -= 1
+    mask = np.cumsum(edges[:, :-1], axis=1, dtype=np.int8) > 0
+    return mask, (x0, y0, x1, y1)
+
+
+def _span_points(starts, ends):
+    # The columns covered by the spans [start, end), concatenated
+    counts = ends - starts
+    first = np.repeat(starts - np.cumsum(counts) + counts, counts)
+    return first + np.arange(counts.sum())
+
+
+# Borders between a tile and its neighbour at (dx, dy): the tile's edge
+# and the neighbour's facing edge; corners are the pixel at an end of one
+_SIDES = {(1, 0): ("right", "left"), (-1, 0): ("left", "right"),
+          (0, 1): ("bottom", "top"), (0, -1): ("top", "bottom")}
+_CORNERS = {(1, 1): (("right", -1), ("left", 0)),
+            (1, -1): (("right", 0), ("left", -1)),
+            (-1, 1): (("left", -1), ("right", 0)),
+            (-1, -1): (("left", 0), ("right", -1))}
+
+
+class _FillTile:
+    # The pixels of one tile of a TiledImage that match a fill's seed, as
+    # runs in document coordinates grouped into components numbered from
+    # 0, with the component of every pixel along each edge (-1 where it
+    # does not match). A plain tile is one component or none, without
+    # looking at its pixels
+
+    def __init__(self, image, area, target, colors, tolerance, reach):
+        width, height = area[2] - area[0], area[3] - area[1]
+        color = image.uniform(area)
+        if color is not None:
+            pixel = _pixel_array(formats.new(image.mode, (1, 1), color),
+                                 colors)
+            count = height if _matches(pixel, target, tolerance)[0, 0] else 0
+            rows = np.arange(count)
+            starts = np.zeros(count, dtype=rows.dtype)
+            ends = np.full(count, width, dtype=rows.dtype)
+            components = np.zeros(count, dtype=rows.dtype)
+        else:
+            match = _matches(_pixel_array(image.crop(area), colors), target,
+                             tolerance)
+            rows, starts, ends = _row_runs(match)
+            upper, lower = _run_links(rows, starts, ends, width, reach)
+            labels = _components(len(starts), upper, lower)
+            components = np.unique(labels, return_inverse=True)[1]
+
+        self.edges = {}
+        for side, runs in (("left", starts == 0), ("right", ends == width)):
+            edge = np.full(height, -1)
+            edge[rows[runs]] = components[runs]
+            self.edges[side] = edge
+        for side, runs in (("top", rows == 0),
+                           ("bottom", rows == height - 1)):
+            edge = np.full(width, -1)
+            edge[_span_points(starts[runs], ends[runs])] = np.repeat(
+                components[runs], ends[runs] - starts[runs]
+            )
+            self.edges[side] = edge
+        self.rows = rows + area[1]
+        self.starts = starts + area[0]
+        self.ends = ends + area[0]
+        self.components = components
+        self.area = area
+        self.filled = np.zeros(len(np.unique(components)), dtype=bool)
+
+    def component_at(self, x, y):
+        first = np.searchsorted(self.rows, y)
+        last = np.searchsorted(self.rows, y, side="right")
+        run = first + np.searchsorted(self.starts[first:last], x,
+                                      side="right") - 1
+        return int(self.components[run])
+
+    def touches(self, component, offset):
+        # Whether ``component`` has pixels on the border towards offset
+        if offset in _SIDES:
+            return bool((self.edges[_SIDES[offset][0]] == component).any())
+        side, index = _CORNERS[offset][0]
+        return self.edges[side][index] == component
+
+    def links(self, other, offset, reach):
+        # {component: components of ``other``} touching across the
+        # border with the neighbouring tile at ``offset``
+        if offset in _SIDES:
+            side, facing = _SIDES[offset]
+            mine, theirs = self.edges[side], other.edges[facing]
+            count = len(mine)
+            pairs = [(mine[max(0, -d):count - max(0, d)],
+                      theirs[max(0, d):count - max(0, -d)])
+                     for d in range(-reach, reach + 1)]
+            mine = np.concatenate([pair[0] for pair in pairs])
+            theirs = np.concatenate([pair[1] for pair in pairs])
+        else:
+            (side, index), (facing, other_index) = _CORNERS[offset]
+            mine = self.edges[side][index:][:1]
+            theirs = other.edges[facing][other_index:][:1]
+        both = (mine >= 0) & (theirs >= 0)
+        links = {}
+        for a, b in set(zip(mine[both].tolist(), theirs[both].tolist())):
+            links.setdefault(a, []).append(b)
+        return links
+
+
+def _tiled_region(image, x, y, tolerance, reach, width, height):
+    # Flood fill over a TiledImage one tile at a time, so only tiles the
+    # region reaches (and their neighbours) are looked at and no
+    # full-size array is made. Each tile is labelled once; the search
+    # then walks from component to component across tile borders.
+    # Returns {tile area: (rows, starts, ends)} of the filled runs
+    step = image.tile_size
+    colors = bool(tolerance)
+    target = _pixel_array(image.crop((x, y, x + 1, y + 1)), colors)[0, 0]
+    columns, tile_rows = -(-width // step), -(-height // step)
+    offsets = list(_SIDES) + (list(_CORNERS) if reach else [])
+    labelled = {}
+    links = {}
+
+    def tile(key):
+        if key not in labelled:
+            ox, oy = key[0] * step, key[1] * step
+            area = (ox, oy, min(width, ox + step), min(height, oy + step))
+            labelled[key] = _FillTile(image, area, target, colors,
+                                      tolerance, reach)
+        return labelled[key]
+
+    key = (x // step, y // step)
+    component = tile(key).component_at(x, y)
+    labelled[key].filled[component] = True
+    stack = [(key, component)]
+    while stack:
+        key, component = stack.pop()
+        here = labelled[key]
+        for offset in offsets:
+            other_key = (key[0] + offset[0], key[1] + offset[1])
+            if not (0 <= other_key[0] < columns
+                    and 0 <= other_key[1] < tile_rows
+                    and here.touches(component, offset)):
+                continue
+            other = tile(other_key)
+            if (key, offset) not in links:
+                links[key, offset] = here.links(other, offset, reach)
+            for linked in links[key, offset].get(component, ()):
+                if not other.filled[linked]:
+                    other.filled[linked] = True
+                    stack.append((other_key, linked))
+
+    region = {}
+    for labels in labelled.values():
+        runs = labels.filled[labels.components]
+        if runs.any():
+            region[labels.area] = (labels.rows[runs], labels.starts[runs],
+                                   labels.ends[runs])
+    return region
+
+
+def flood_fill_mask(image, x, y, tolerance=0, connectivity=4, size=None):
+    """Return (mask, bbox) of the region connected to (x, y).
+
+    The region is made of pixels whose channels all differ from the seed
+    pixel by at most ``tolerance`` (for palette images, the channels of
+    their colours). ``connectivity`` is 4 or 8. ``size`` limits the
+    search to the document in the top-left corner of a larger backing
+    store. ``mask`` is a boolean array covering ``bbox`` only. Returns
+    (None, None) when the seed lies outside the image. A TiledImage is
+    searched tile by tile (see ``flood_fill``).
+    """
+    width, height = size or image.size
+    if not (0 <= x < width and 0 <= y < height):
+        return None, None
+    if connectivity not in (4, 8):
+        raise ValueError("connectivity must be 4 or 8")
+    # Diagonal neighbours reach one pixel further on each side
+    reach = 1 if connectivity == 8 else 0
+
+    if not isinstance(image, Image.Image):
+        region = _tiled_region(image, x, y, tolerance, reach, width, height)
+        return _runs_mask(*(np.concatenate(runs)
+                            for runs in zip(*region.values())))
+
+    if (width, height) != image.size:
+        image = image.crop((0, 0, width, height))
+    pixels = _pixel_array(image, colors=bool(tolerance))
+    match = _matches(pixels, pixels[y, x], tolerance)
+
+    # Work on horizontal spans rather than individual pixels
+    run_rows, starts, ends = _row_runs(match)
+    upper, lower = _run_links(run_rows, starts, ends, width, reach)
+    labels = _components(len(starts), upper, lower)
+
+    row_first = np.searchsorted(run_rows, y)
+    row_starts = starts[row_first:np.searchsorted(run_rows, y + 1)]
+    seed = row_first + np.searchsorted(row_starts, x, side="right") - 1
+    filled = np.nonzero(labels == labels[seed])[0]
+    return _runs_mask(run_rows[filled], starts[filled], ends[filled])
+
+
+def flood_fill(image, x, y, fill_color, tolerance=0, connectivity=4,
+               size=None):
+    """Fill the region connected to (x, y) in place, within ``size``
+    (the whole image if None).
+
+    A TiledImage is filled tile by tile: only tiles the region reaches
+    are read, and tiles it covers entirely stay plain colours, so a fill
+    never needs memory for the whole document. Returns the bounding box
+    of the changed pixels, or None if nothing was filled.
+    """
+    width, height = size or image.size
+    if not (0 <= x < width and 0 <= y < height):
+        return None
+    fill_color = formats.pixel(fill_color, image.mode)
+    if not tolerance and image.getpixel((x, y)) == fill_color:
+        return None
+    if isinstance(image, Image.Image):
+        mask, bbox = flood_fill_mask(image, x, y, tolerance, connectivity,
+                                     size)
+        stencil = Image.fromarray(mask.astype(np.uint8) * 255, "L")
+        image.paste(fill_color, bbox, stencil)
+        return bbox
+
+    if connectivity not in (4, 8):
+        raise ValueError("connectivity must be 4 or 8")
+    reach = 1 if connectivity == 8 else 0
+    bbox = None
+    region = _tiled_region(image, x, y, tolerance, reach, width, height)
+    for area, (rows, starts, ends) in region.items():
+        bbox = union_bbox(bbox, (int(starts.min()), int(rows.min()),
+                                 int(ends.max()), int(rows.max()) + 1))
+        if (len(rows) == area[3] - area[1] and (starts == area[0]).all()
+                and (ends == area[2]).all()):
+            image.paste(fill_color, area)  # Stays a plain tile
+            continue
+        mask, box = _runs_mask(rows, starts, ends)
+        stencil = Image.fromarray(mask.astype(np.uint8) * 255, "L")
+        image.paste(fill_color, box, stencil)
+    return bbox
+
+
+def draw_segment(draw, x0, y0, x1, y1, fill, width):
+    """Draw one round-capped stroke segment and return its bounding box."""
+    radius = width / 2
+    draw.line([x0, y0, x1, y1], fill=fill, width=width)
+    # ImageDraw lines have square ends; stamp discs to round them off
+    for x, y in ((x0, y0), (x1, y1)):
+        draw.ellipse(
+            [x - radius, y - radius, x + radius, y + radius], fill=fill
+        )
+    return _segment_box(x0, y0, x1, y1, width)
+
+
+def _segment_box(x0, y0, x1, y1, width):
+    pad = int(width / 2) + 1
+    return (
+        min(x0, x1) - pad, min(y0, y1) - pad,
+        max(x0, x1) + pad + 1, max(y0, y1) + pad + 1
+    )
+
+
+def draw_segment_on(image, x0, y0, x1, y1, fill, width):
+    """``draw_segment`` on any image with ``crop`` and ``paste``, like
+    ``draw_shape_on``."""
+    bbox = tuple(int(v) for v in _segment_box(x0, y0, x1, y1, width))
+    left, top = bbox[:2]
+    region = image.crop(bbox)
+    draw_segment(ImageDraw.Draw(region), x0 - left, y0 - top,
+                 x1 - left, y1 - top, formats.pixel(fill, region.mode), width)
+    image.paste(region, (left, top))
+    return bbox
+
+
+def draw_shape(draw, shape, x0, y0, x1, y1, color, width):
+    """Draw a rectangle, circle or line and return its bounding box."""
+    # ImageDraw wants the corners ordered for rectangles and ellipses
+    box = [min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)]
+    if shape == "rectangle":
+        draw.rectangle(box, outline=color, width=width)
+    elif shape == "circle":
+        draw.ellipse(box, outline=color, width=width)
+    elif shape == "line":
+        draw.line([x0, y0, x1, y1], fill=color, width=width)
+    else:
+        raise ValueError(f"Unknown shape: {shape}")
+    return _shape_box(box, width)
+
+
+def _shape_box(box, width):
+    pad = width // 2 + 1
+    return (box[0] - pad, box[1] - pad, box[2] + pad + 1, box[3] + pad + 1)
+
+
+def draw_shape_on(image, shape, x0, y0, x1, y1, color, width, size=None):
+    """``draw_shape`` on any image with ``crop`` and ``paste``.
+
+    Only the shape's box, clipped to ``size`` (the image's if None), is
+    drawn into, so this also works on a ``tiles.TiledImage``, which
+    ImageDraw cannot draw on. The pixels are the same as drawing on the
+    whole image. Returns None if the shape lies outside.
+    """
+    bbox = _shape_box(
+        [min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)], width
+    )
+    limit_x, limit_y = size or image.size
+    bbox = (max(0, bbox[0]), max(0, bbox[1]),
+            min(limit_x, bbox[2]), min(limit_y, bbox[3]))
+    if bbox[0] >= bbox[2] or bbox[1] >= bbox[3]:
+        return None
+    left, top = bbox[:2]
+    region = image.crop(bbox)
+    draw_shape(ImageDraw.Draw(region), shape, x0 - left, y0 - top,
+               x1 - left, y1 - top, formats.pixel(color, region.mode), width)
+    image.paste(region, (left, top))
+    return bbox
+
+
+def hex_to_rgba(color):
+    """Convert "#rrggbb" to an opaque RGBA tuple."""
+    value = color.lstrip('#')
+    return tuple(int(value[i:i + 2], 16) for i in (0, 2, 4)) + (255,)
+
+
+def grow_canvas(image, width, height, fill="white"):
+    """Return a backing image of at least width x height.
+
+    The image is returned unchanged if it is already big enough; otherwise
+    its capacity doubles until it fits, so content is never cropped and a
+    window drag causes only a few reallocations. New area is ``fill``.
+    """
+    capacity_width, capacity_height = image.size
+    if width <= capacity_width and height <= capacity_height:
+        return image
+    capacity_width = max(1, capacity_width)
+    capacity_height = max(1, capacity_height)
+    while capacity_width < width:
+        capacity_width *= 2
+    while capacity_height < height:
+        capacity_height *= 2
+    grown = formats.new(image.mode, (capacity_width, capacity_height), fill)
+    grown.paste(image, (0, 0))
+    return grown
+
+
+def load_image(path):
+    """Open an image file as RGBA at its native resolution."""
+    return Image.open(path).convert("RGBA")
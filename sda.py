@@ -1,39 +1,143 @@
+import time
+startup_clock = time.perf_counter()  # Fallback origin for the startup time
+
+import argparse
+import functools
+import importlib
+import importlib.util
+import sys
 import tkinter as tk
-from tkinter import colorchooser
-from tkinter import ttk, filedialog, messagebox, simpledialog
-from PIL import Image, ImageDraw, ImageTk
-from PIL import ImageGrab
-import threading
-from collections import deque
-from functools import lru_cache
+from tkinter import ttk
+from PIL import Image
+import os
 import platform
+from history import TileHistory
+from journal import Journal, Replayer
+import metrics
+import autosave
+from viewport import TilePyramid, Viewport
+from layers import BLEND_MODES, LayerStack
+from overlay import Overlay
+import tiles
+import formats
+from worker import RenderWorker
+
+def defer_import(name):
+    # Module ``name``, executed when one of its attributes is first used
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+# The tools import NumPy, which is most of the start-up time and isn't
+# needed for the first frame; finish_startup loads them right after it
+DEFERRED_MODULES = ("raster", "brush", "strokes", "selection", "export",
+                    "regions")
+raster = defer_import("raster")
+brush = defer_import("brush")
+strokes = defer_import("strokes")
+selection = defer_import("selection")
+export = defer_import("export")
 
 # Add this after your imports and before other code
 class Config:
-    BATCH_SIZE = 5  # Smaller batch size for more frequent updates
-    MAX_ACTIONS = 50
+    HISTORY_TILE_SIZE = 64  # Undo history records changes in 64x64 tiles
+    HISTORY_BUDGET = 512 * 1024 * 1024  # Bytes of compressed undo data to keep
+    HISTORY_MEMORY_ENTRIES = 32  # Recent actions kept in RAM; older ones go to disk
+    HISTORY_SPILL_DIR = None  # Directory for the undo spill file; None = temp dir
     CANVAS_UPDATE_DELAY = 16
     BRUSH_OPTIMIZE = True  # Enable brush optimizations
+    BRUSH_HARDNESS = 1.0  # 1 is a crisp tip, lower values fade towards the edge
+    BRUSH_SHAPE = "round"  # "round" or "square"
+    BRUSH_SPACING = 0.1  # Distance between brush dabs, relative to the size
+    STROKE_MIN_DISTANCE = 1.0  # Pointer moves shorter than this (px) are dropped
+    STROKE_TOLERANCE = 1.0  # Max distance (px) a simplified stroke may stray
+    STROKE_WINDOW = 32  # Max samples held back before one is kept anyway
+    FILL_TOLERANCE = 0  # Max per-channel difference still treated as the same colour
+    FILL_CONNECTIVITY = 4  # 4 or 8 (include diagonal neighbours)
+    FILL_INDEX_TILE_SIZE = 256  # Tile size of the region index for exact fills
+    FILL_PREVIEW_ALPHA = 96  # Opacity (0-255) of the fill tool's hover tint
+    VIEW_TILE_SIZE = 256  # Tile size of the zoom pyramid
+    VIEW_CACHE_TILES = 256  # Downsampled tiles kept in memory
+    ZOOM_STEP = 1.25
+    RESIZE_DEBOUNCE = 100  # ms of quiet before a window resize is applied
+    PNG_COMPRESS_LEVEL = 6  # 0-9; lower saves faster, higher saves smaller
+    PNG_OPTIMIZE = False  # Extra PNG pass for smaller files, much slower
+    WEBP_LOSSLESS = True
+    JPEG_QUALITY = 90
+    SAVE_POLL_INTERVAL = 50  # ms between checks on a background save
+    AUTOSAVE_INTERVAL = 5000  # ms between recovery checkpoints
+    AUTOSAVE_PATH = os.path.join(os.path.expanduser("~"), ".sda-recovery")
+    AUTOSAVE_TILE_SIZE = 256
+    AUTOSAVE_COMPACT_RATIO = 4  # Compact once appends reach 4x the snapshot
+    LAYER_TILE_SIZE = 256  # Tile size of the cached layer composite
+    DOCUMENT_TILE_SIZE = 256  # Layers are stored as sparse tiles of this size
+    PIXEL_FORMAT = "RGBA"  # New documents: "RGBA", "RGB", "P" (indexed) or "L"
+    WORKER_POLL_INTERVAL = 15  # ms between checks on a background operation
 
 # Global variables
-current_batch = []
-last_update_time = 0
+last_update_time = 0  # perf_counter() time of the last processed frame
+
+# Pointer samples waiting for the next frame
+pending_samples = []
+pointer_position = None
+frame_job = None
 
 # Default settings
 current_color = "#000000"
 current_tool = "brush"  # Default tool is brush
 brush_size = 10  # Default brush size set to 10
+brush_hardness = Config.BRUSH_HARDNESS
+brush_shape = Config.BRUSH_SHAPE
+pixel_format = Config.PIXEL_FORMAT  # Of the document, and of new ones
+
+# Undo/redo history of changed tiles
+history = TileHistory(
+    Config.HISTORY_TILE_SIZE, Config.HISTORY_BUDGET,
+    Config.HISTORY_MEMORY_ENTRIES, Config.HISTORY_SPILL_DIR
+)
 
-# Lists to track actions for undo/redo
-actions_stack = deque(maxlen=50)  # Limit memory usage
-redo_stack = deque(maxlen=50)
+# Operation journal for the current document
+journal = Journal()
+
+# Bounding box, points and dab stamper of the stroke being drawn; a
+# brush stroke's points are the ones its simplifier has kept
+stroke_bbox = None
+stroke_points = []
+stroke_path = None
+brush_stroke = None
+
+# Current selection, the points of a lasso being drawn, the selected
+# pixels while they are dragged, and the internal clipboard
+current_selection = None
+lasso_points = []
+floating = None  # RGBA pixels lifted out of the layer
+floating_offset = (0, 0)  # How far they have been dragged
+floating_photo = None
+floating_item = None  # Canvas image item, moved with coords while dragging
+clipboard = None  # (RGBA pixels, selection) of the last copy or cut
+selection_view = None  # View transform the outline was last drawn for
+
+# Background save in progress, if any
+save_job = None
+
+perf_job = None  # Next refresh of the performance overlay
+
+# Crash-recovery file, checkpointed with the tiles changed since last time
+recovery = autosave.RecoveryStore(
+    Config.AUTOSAVE_PATH, Config.AUTOSAVE_TILE_SIZE,
+    Config.AUTOSAVE_COMPACT_RATIO
+)
 
 # Dictionary to hold references to tool buttons
 tool_buttons = {}
 
 # Add variables to track drawing positions
 start_x, start_y = None, None
-prev_x, prev_y = None, None
 
 # Try to enable GPU acceleration
 def enable_gpu_acceleration():
@@ -65,17 +169,23 @@ def enable_gpu_acceleration():
         except Exception as e:
             print(f"Could not enable Linux GPU acceleration: {e}")
 
-# Call this before creating the root window
-enable_gpu_acceleration()
+# Main window, the drawing canvas and its preview overlay; create_app
+# builds them, so importing this module opens no window
+root = None
+canvas = None
+previews = None
 
-# Then create your root window
-root = tk.Tk()
-root.title("Simple Drawing Application")
-root.geometry("1400x1000")
+# Thread that runs long operations (fill, opening files) and owns the
+# document while one is in flight; created by create_app
+render_worker = None
+gesture_ignored = False  # The current mouse press came while it was busy
+
+# Set by the first rendered frame; --startup-time quits once it is shown
+first_frame_shown = False
+measure_startup = False
 
 # Set default font
 default_font = ("San Francisco", 12)
-root.option_add("*Font", default_font)
 
 # Tooltip class with delay and visible text
 class CreateToolTip(object):
@@ -120,46 +230,273 @@ class CreateToolTip(object):
             self.tip_window.destroy()
             self.tip_window = None
 
-# Initialize the drawing surface (will be updated later)
+# Layers of the document; tools draw into the selected layer's image
+# (will be updated later). Layer images are sparse tiles.TiledImages, so
+# blank area costs no memory however large the document is
+layers = None
 image = None
-draw = None
 
-# Function to update the canvas image
-def update_canvas():
-    global photo_image
-    photo_image = ImageTk.PhotoImage(image)
-    canvas.create_image(0, 0, image=photo_image, anchor=tk.NW)
-    canvas.config(scrollregion=canvas.bbox(tk.ALL))
+# The document is shown through a zoomable viewport rendered from a
+# cached tile pyramid; new documents grow with the window, opened
+# images keep their own size
+pyramid = TilePyramid(Config.VIEW_TILE_SIZE, Config.VIEW_CACHE_TILES)
+view = Viewport(pyramid)
+doc_follows_window = True
+
+# Size of the document; the backing image may be larger
+doc_size = (0, 0)
+
+# Persistent Tk image holding the rendered view, and its canvas item
+photo_image = None
+canvas_image_item = None
+
+# View regions waiting to be rendered, and the scheduled refresh
+pending_boxes = []
+refresh_job = None
+
+# Window size waiting to be applied once Configure events settle
+pending_size = None
+resize_job = None
+
+# Single-colour regions of the selected layer, labelled tile by tile as
+# fills and the fill preview need them; edits forget only their tiles.
+# Built by fill_regions on first use, since it needs NumPy
+regions = None
+fill_preview_region = None  # Region under the pointer, until the next edit
+fill_preview_shown = None  # (zoom, x, y, colour) the tint was drawn for
+fill_preview_photo = None
+
+# Handlers that change or read the document are refused while the
+# render worker owns it
+def document_action(handler):
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        if render_worker is not None and render_worker.busy():
+            root.bell()
+            return None
+        return handler(*args, **kwargs)
+    return wrapper
+
+def run_in_worker(name, job, done, owns_document=True):
+    # Hand a job to the render worker; done(result, error) runs on this
+    # thread once it has finished. Until then, one that owns the document
+    # has document actions refused
+    if not render_worker.pending:
+        root.after(Config.WORKER_POLL_INTERVAL, poll_worker)
+    render_worker.submit(job, done, name, owns_document)
+    if owns_document:
+        work_status.config(text="Working...")
+        root.config(cursor="watch")
+
+def poll_worker():
+    try:
+        for name, seconds in render_worker.poll():
+            metrics.record(f"worker:{name}", seconds)
+    finally:
+        # Even if a callback failed, keep polling or clear the status
+        if render_worker.pending:
+            root.after(Config.WORKER_POLL_INTERVAL, poll_worker)
+        if not render_worker.busy():
+            work_status.config(text="")
+            root.config(cursor="")
 
-# Function to handle canvas resizing
-def resize_canvas(event):
-    global image, draw
-    # Get the new canvas size
-    canvas_width = event.width
-    canvas_height = event.height
+# Function to update the canvas image
+def update_canvas(bbox=None, layer=None):
+    # bbox is the changed part of layer (the selected one if None); no
+    # bbox means the whole document or its layer structure changed.
+    # Several updates within one frame are merged into a single render
+    clear_fill_preview()
+    if bbox is None:
+        if regions is not None:
+            regions.reset(image, doc_size)
+        pyramid.set_source(layers.composite())
+        view.clamp()
+        refresh_view()
+        return
+    layer = layer or layers.active_layer
+    if layer is layers.active_layer and regions is not None:
+        regions.invalidate(bbox)
+    layers.invalidate(bbox, layer)
+    pyramid.invalidate(bbox)
+    recovery.invalidate(bbox, layer)
+    view_box = view.doc_box_to_view(bbox)
+    if view_box:
+        refresh_view(view_box)
+
+def refresh_view(box=None):
+    # Queue a region of the view (all of it if None) for re-rendering
+    global pending_boxes, refresh_job
+    if root is None:
+        return  # No window to draw in, as in the tests
+    if box is None:
+        box = (0, 0, view.width, view.height)
+    pending_boxes.append(box)
+    if len(pending_boxes) > 8:
+        # Too many scattered regions: render their bounding box instead
+        merged = None
+        for pending in pending_boxes:
+            merged = raster.union_bbox(merged, pending)
+        pending_boxes = [merged]
+    if refresh_job is None:
+        refresh_job = root.after(
+            Config.CANVAS_UPDATE_DELAY, flush_canvas_update
+        )
 
-    if image is not None:
-        # Resize the image
-        old_image = image
-        image = Image.new("RGBA", (canvas_width, canvas_height), "white")
-        old_width, old_height = old_image.size
+@metrics.timed("update_canvas")
+def flush_canvas_update():
+    # Render the pending regions of the view into the Tk image
+    from PIL import ImageTk
+    global photo_image, canvas_image_item, pending_boxes, refresh_job
+    global first_frame_shown
+    if refresh_job is not None:
+        root.after_cancel(refresh_job)
+        refresh_job = None
+    if render_worker.busy():
+        # The document is the worker's; render once it hands it back
+        refresh_job = root.after(
+            Config.CANVAS_UPDATE_DELAY, flush_canvas_update
+        )
+        return
+    boxes, pending_boxes = pending_boxes, []
+    if image is None or not boxes:
+        return
+    # Recompose the layers' dirty tiles before the pyramid reads them
+    source = layers.composite()
+    if source is not pyramid.source:
+        pyramid.set_source(source)
+
+    width, height = view.width, view.height
+    if photo_image is None:
+        photo_image = tk.PhotoImage(width=width, height=height)
+        canvas_image_item = canvas.create_image(
+            0, 0, image=photo_image, anchor=tk.NW
+        )
+        canvas.tag_lower(canvas_image_item)
+        boxes = [(0, 0, width, height)]
+    elif width > photo_image.width() or height > photo_image.height():
+        # Grow the Tk image in place; Tk keeps the existing pixels, so
+        # only the pending (newly exposed) regions need rendering
+        photo_image.configure(
+            width=max(width, photo_image.width()),
+            height=max(height, photo_image.height())
+        )
 
-        # Calculate the overlapping region
-        paste_width = min(canvas_width, old_width)
-        paste_height = min(canvas_height, old_height)
-        box = (0, 0, paste_width, paste_height)
+    for box in boxes:
+        x0, y0 = max(0, int(box[0])), max(0, int(box[1]))
+        x1, y1 = min(width, int(box[2])), min(height, int(box[3]))
+        if x0 >= x1 or y0 >= y1:
+            continue
+        patch = ImageTk.PhotoImage(view.render((x0, y0, x1, y1)))
+        photo_image.tk.call(photo_image, "copy", patch, "-to", x0, y0)
+    if selection_view != (view.zoom, view.x, view.y):
+        show_selection_outline()
+    if fill_preview_shown and pointer_position:
+        preview_fill(*pointer_position)  # Redrawn only if the view moved
+    update_zoom_status()
+    if not first_frame_shown:
+        first_frame_shown = True
+        root.after_idle(finish_startup)
 
-        # Crop the old image to the overlapping region
-        region = old_image.crop(box)
+# Function to handle canvas resizing
+def resize_canvas(event):
+    # Configure events arrive in bursts while the window is dragged;
+    # only act once they settle
+    global pending_size, resize_job
+    pending_size = (event.width, event.height)
+    if resize_job is not None:
+        root.after_cancel(resize_job)
+    resize_job = root.after(Config.RESIZE_DEBOUNCE, apply_resize)
+
+def apply_resize():
+    global resize_job
+    if render_worker.busy() or brush_stroke is not None:
+        # Growing the layers would race with the worker, and a stroke
+        # is journaled whole, so it must see one document size; try
+        # again later
+        resize_job = root.after(Config.RESIZE_DEBOUNCE, apply_resize)
+        return
+    resize_job = None
+    settle_selection()
+    canvas_width, canvas_height = pending_size
+    old_view = (view.width, view.height)
+    view.width, view.height = canvas_width, canvas_height
+    if image is None:
+        return
 
-        # Paste the cropped region into the new image
-        image.paste(region, (0, 0))
+    old_doc = doc_size
+    if doc_follows_window and doc_size != (canvas_width, canvas_height):
+        resize_document(canvas_width, canvas_height)
 
-        draw = ImageDraw.Draw(image)
-        update_canvas()
+    old_pan = (view.x, view.y)
+    view.clamp()
+    if (view.x, view.y) != old_pan:
+        refresh_view()
+        return
+    # Render only what changed: strips of the window that were not
+    # visible before, and document area that appeared or disappeared
+    if canvas_width > old_view[0]:
+        refresh_view((old_view[0], 0, canvas_width, canvas_height))
+    if canvas_height > old_view[1]:
+        refresh_view((0, old_view[1], canvas_width, canvas_height))
+    if doc_size != old_doc:
+        far_x = max(doc_size[0], old_doc[0])
+        far_y = max(doc_size[1], old_doc[1])
+        for box in ((min(doc_size[0], old_doc[0]), 0, far_x, far_y),
+                    (0, min(doc_size[1], old_doc[1]), far_x, far_y)):
+            view_box = view.doc_box_to_view(box)
+            if view_box:
+                refresh_view(view_box)
+
+# Zoom and pan the view
+def zoom_view(factor, vx=None, vy=None):
+    # Zoom around (vx, vy) in window pixels, the view centre by default
+    if vx is None:
+        vx, vy = view.width / 2, view.height / 2
+    view.zoom_at(factor, vx, vy)
+    refresh_view()
+
+def zoom_in(event=None):
+    zoom_view(Config.ZOOM_STEP)
+
+def zoom_out(event=None):
+    zoom_view(1 / Config.ZOOM_STEP)
+
+def zoom_actual_size(event=None):
+    view.zoom = 1.0
+    view.clamp()
+    refresh_view()
+
+def on_mouse_wheel(event):
+    # Scroll to pan (Shift for horizontal); Control or Command zooms
+    if event.num == 5 or event.delta < 0:
+        direction = -1
+    else:
+        direction = 1
+    if event.state & 0x000C:
+        zoom_view(Config.ZOOM_STEP ** direction, event.x, event.y)
+    elif event.state & 0x0001:
+        view.pan(-direction * 40, 0)
+        refresh_view()
+    else:
+        view.pan(0, -direction * 40)
+        refresh_view()
+
+pan_anchor = None
+
+def start_pan(event):
+    global pan_anchor
+    pan_anchor = (event.x, event.y)
+
+def pan_view(event):
+    global pan_anchor
+    if pan_anchor:
+        view.pan(pan_anchor[0] - event.x, pan_anchor[1] - event.y)
+        pan_anchor = (event.x, event.y)
+        refresh_view()
 
 # Function to change the color using the color picker
 def choose_color(event=None):
+    from tkinter import colorchooser
     global current_color
     color = colorchooser.askcolor(title="Pick a color")
     if color[1] is not None:
@@ -217,7 +554,10 @@ def select_preset_color(color):
 # Function to select the drawing tool
 def select_tool(tool):
     global current_tool
+    settle_selection()
     current_tool = tool
+    if tool != "fill":
+        hide_fill_preview()
     update_tool_status()
     update_button_states()
 
@@ -235,193 +575,570 @@ def update_button_states():
 
 # Function to start drawing shapes or freehand
 def start_draw(event):
-    global start_x, start_y, prev_x, prev_y
-    start_x, start_y = event.x, event.y
-    prev_x, prev_y = event.x, event.y
-
-    # For brush and eraser, we'll capture the state after releasing
-    if current_tool not in ("brush", "eraser"):
-        actions_stack.append(image.copy())
-        redo_stack.clear()
+    global start_x, start_y, stroke_bbox, stroke_points, gesture_ignored
+    gesture_ignored = render_worker.busy()
+    if gesture_ignored:
+        root.bell()
+        return
+    # Tools work in document coordinates
+    x, y = view.to_doc(event.x, event.y)
+    start_x, start_y = x, y
+    stroke_bbox = None
+    stroke_points = [x, y]
+    if current_tool in ("brush", "eraser"):
+        begin_stroke(x, y)
+    elif current_tool in ("select", "lasso"):
+        if current_selection and current_selection.contains(x, y):
+            lift_selection()
+        else:
+            deselect()
+
+# Queue pointer samples; the actual work happens once per frame
+def on_motion(event):
+    global pointer_position
+    pointer_position = view.to_doc(event.x, event.y)
+    schedule_frame()
+
+def on_drag(event):
+    pending_samples.append(view.to_doc(event.x, event.y))
+    on_motion(event)
+
+def schedule_frame():
+    global frame_job
+    if frame_job is None:
+        frame_job = root.after(Config.CANVAS_UPDATE_DELAY, process_frame)
+
+@metrics.timed("frame")
+def process_frame():
+    # Handle every sample queued since the last frame in one batch
+    global frame_job, last_update_time
+    if frame_job is not None:
+        root.after_cancel(frame_job)
+        frame_job = None
+    last_update_time = time.perf_counter()
+
+    if pending_samples:
+        samples = pending_samples[:]
+        pending_samples.clear()
+        paint(samples)
+    if pointer_position:
+        update_position_status(*pointer_position)
+        if current_tool == "fill":
+            preview_fill(*pointer_position)
+
+def stroke_color():
+    # The eraser clears to the layer's own background: white on the
+    # background layer, transparency on the others
+    if current_tool == "brush":
+        return current_color
+    return layers.active_layer.fill
 
 # Function to draw on the canvas based on the selected tool
-def paint(event):
-    global prev_x, prev_y, current_batch
-    
+@metrics.timed("paint")
+def paint(samples):
+    if gesture_ignored:
+        return
     if current_tool in ("brush", "eraser"):
-        if prev_x and prev_y:
-            color = current_color if current_tool == "brush" else "white"
-            
-            # Optimize based on brush size
-            if brush_size > 20:
-                # For very large brushes, use simpler rendering
-                canvas.create_line(
-                    prev_x, prev_y, event.x, event.y,
-                    fill=color, width=brush_size,
-                    capstyle=tk.ROUND
-                )
-            elif brush_size > 10:
-                # Medium brushes with moderate smoothing
-                canvas.create_line(
-                    prev_x, prev_y, event.x, event.y,
-                    fill=color, width=brush_size,
-                    capstyle=tk.ROUND, smooth=True,
-                    splinesteps=3
-                )
-            else:
-                # Small brushes with full smoothing
-                canvas.create_line(
-                    prev_x, prev_y, event.x, event.y,
-                    fill=color, width=brush_size,
-                    capstyle=tk.ROUND, smooth=True
-                )
-            
-            current_batch.append((prev_x, prev_y, event.x, event.y))
-            
-            if len(current_batch) >= Config.BATCH_SIZE:
-                draw_batch()
-        
-        prev_x, prev_y = event.x, event.y
-    
-    elif current_tool in ("rectangle", "circle", "line"):
-        draw_shape_preview(event)
+        if brush_stroke is None:
+            return
+        # Dabs go straight into the layer and the view shows the layer,
+        # so what is seen while drawing is exactly what gets committed.
+        # The curve up to a kept point is known once the next one is kept;
+        # until then the rest of the stroke is previewed as a line
+        show_stroke_tail()
+        if continue_stroke(samples):
+            flush_canvas_update()
 
-def draw_batch():
-    global current_batch
-    if not current_batch:
+    elif current_tool in ("rectangle", "circle", "line"):
+        draw_shape_preview(*samples[-1])
+
+    elif current_tool in ("select", "lasso"):
+        x, y = samples[-1]
+        if floating is not None:
+            move_floating(x - start_x, y - start_y)
+        elif current_tool == "select":
+            previews.show_marquee(
+                "marquee", view.to_view(start_x, start_y) + view.to_view(x, y),
+                handles=False
+            )
+        else:
+            for x, y in samples:
+                stroke_points.extend((x, y))
+            previews.show(
+                "marquee:path", "line", view_coords(stroke_points),
+                fill="black", width=1
+            )
+
+def stamp_span(index):
+    # Stamp the curve from stroke point ``index`` to the next one, as
+    # replay will (see strokes.span); returns the changed box
+    color = stroke_color()
+    path = strokes.span(stroke_points, index)
+    bbox = None
+    for i in range(0, len(path), 2):
+        bbox = raster.union_bbox(
+            bbox, brush_stroke.to(image, color, *path[i:i + 2], doc_size)
+        )
+    return bbox
+
+def show_stroke_tail():
+    # The part of the stroke not stamped yet: from the last stamped point
+    # through the kept points after it and the pending samples
+    tail = stroke_points[-4:] + stroke_path.pending
+    if len(tail) < 4:
+        previews.hide("stroke:tail")
         return
+    color = current_color if current_tool == "brush" else "white"
+    previews.show(
+        "stroke:tail", "line", view_coords(tail), fill=color,
+        width=max(1, brush_size * view.zoom), capstyle=tk.ROUND,
+        joinstyle=tk.ROUND
+    )
 
-    # Draw all lines in the batch at once
-    for x1, y1, x2, y2 in current_batch:
-        canvas.create_line(
-            x1, y1, x2, y2,
-            fill=current_color if current_tool == "brush" else "white",
-            width=brush_size,
-            capstyle=tk.ROUND,
-            smooth=True
-        )
-    current_batch.clear()
-
-# Optimize shape preview with caching
-@lru_cache(maxsize=32)
-def get_shape_coordinates(start_x, start_y, end_x, end_y):
-    """Cache frequently used coordinate calculations"""
-    return (start_x, start_y, end_x, end_y)
-
-def draw_shape_preview(event):
-    canvas.delete("preview")  # Remove previous preview
-    
-    if current_tool == "rectangle":
-        canvas.create_rectangle(
-            start_x, start_y, event.x, event.y,
-            outline=current_color,
-            width=brush_size,
-            tags="preview"
-        )
-    elif current_tool == "circle":
-        canvas.create_oval(
-            start_x, start_y, event.x, event.y,
-            outline=current_color,
-            width=brush_size,
-            tags="preview"
-        )
-    elif current_tool == "line":
-        canvas.create_line(
-            start_x, start_y, event.x, event.y,
-            fill=current_color,
-            width=brush_size,
-            tags="preview"
+def draw_shape_preview(x, y):
+    # Move the pooled preview item instead of recreating it; the
+    # preview is drawn in window coordinates
+    x0, y0 = view.to_view(start_x, start_y)
+    x1, y1 = view.to_view(x, y)
+    width = max(1, brush_size * view.zoom)
+
+    if current_tool == "line":
+        previews.show(
+            "shape:line", "line", (x0, y0, x1, y1),
+            fill=current_color, width=width
+        )
+    else:
+        kind = "oval" if current_tool == "circle" else "rectangle"
+        previews.show(
+            f"shape:{kind}", kind, (x0, y0, x1, y1),
+            outline=current_color, width=width
         )
 
 # Function to finalize shape drawing
+@metrics.timed("finalize_shape")
 def finalize_shape(event):
-    global image, draw
-    canvas.delete("preview")  # Remove the preview
+    previews.hide_group("shape:")  # Remove the preview
+    x, y = view.to_doc(event.x, event.y)
     
     if current_tool in ("rectangle", "circle", "line"):
-        x0, y0 = start_x, start_y
-        x1, y1 = event.x, event.y
-        if current_tool == "rectangle":
-            draw.rectangle([x0, y0, x1, y1],
-                         outline=current_color,
-                         width=brush_size)
-        elif current_tool == "circle":
-            draw.ellipse([x0, y0, x1, y1],
-                         outline=current_color,
-                         width=brush_size)
-        elif current_tool == "line":
-            draw.line([x0, y0, x1, y1],
-                      fill=current_color,
-                      width=brush_size)
-        update_canvas()
+        draw_shape(current_tool, start_x, start_y, x, y)
     elif current_tool == "fill":
-        # Implement fill (bucket tool)
-        fill_color = tuple(
-            int(current_color.lstrip('#')[i:i+2], 16)
-            for i in (0, 2, 4)
-        ) + (255,)
-        flood_fill(event.x, event.y, fill_color)
-        update_canvas()
-        # For undo functionality, store the image after fill
-        actions_stack.append(image.copy())
-        redo_stack.clear()
+        # Implement fill (bucket tool); a large region can take a
+        # while, so it runs on the render worker
+        run_in_worker("fill", *prepare_fill(x, y))
+    elif current_tool in ("select", "lasso"):
+        previews.hide("marquee:path")
+        if floating is not None:
+            drop_selection(x - start_x, y - start_y)
+        elif current_tool == "select":
+            if (x, y) != (start_x, start_y):
+                set_selection(selection.Selection.rectangle(
+                    start_x, start_y, x, y, doc_size
+                ))
+        else:
+            set_selection(selection.Selection.lasso(stroke_points, doc_size))
+
+# Document operations, in document coordinates. The mouse handlers
+# drive them; they need no window, so the tests call them directly
+def begin_stroke(x, y):
+    global stroke_path, stroke_points, brush_stroke, stroke_bbox
+    stroke_path = strokes.Simplifier(
+        x, y, Config.STROKE_TOLERANCE, Config.STROKE_MIN_DISTANCE,
+        Config.STROKE_WINDOW
+    )
+    stroke_points = stroke_path.points
+    # A click without motion leaves a single dab
+    brush_stroke = brush.Stroke(
+        brush_size, brush_hardness, brush_shape, Config.BRUSH_SPACING
+    )
+    stroke_bbox = brush_stroke.to(image, stroke_color(), x, y, doc_size)
+    if stroke_bbox:
+        update_canvas(stroke_bbox)
+
+def continue_stroke(samples):
+    # Stamp the curve up to each point the samples add; returns the box
+    # that changed
+    global stroke_bbox
+    frame_bbox = None
+    for x, y in samples:
+        if stroke_path.add(x, y) and len(stroke_points) >= 6:
+            frame_bbox = raster.union_bbox(
+                frame_bbox, stamp_span(len(stroke_points) // 2 - 3)
+            )
+    if frame_bbox:
+        stroke_bbox = raster.union_bbox(stroke_bbox, frame_bbox)
+        update_canvas(frame_bbox)
+    return frame_bbox
+
+def end_stroke():
+    # Keep the last sample and stamp the rest of the curve, which ends
+    # on it; a two-point stroke is a straight line
+    global brush_stroke, stroke_bbox
+    bbox = None
+    if brush_stroke is not None:
+        if stroke_path.finish() and len(stroke_points) >= 6:
+            bbox = stamp_span(len(stroke_points) // 2 - 3)
+        count = len(stroke_points) // 2
+        if count == 2:
+            bbox = brush_stroke.to(
+                image, stroke_color(), *stroke_points[2:], doc_size
+            )
+        elif count > 2:
+            bbox = raster.union_bbox(bbox, stamp_span(count - 2))
+    brush_stroke = None
+    if bbox:
+        stroke_bbox = raster.union_bbox(stroke_bbox, bbox)
+        update_canvas(bbox)
+    if stroke_bbox:
+        journal.record(
+            "stroke", tool=current_tool, color=current_color,
+            size=brush_size, hardness=brush_hardness,
+            shape=brush_shape, spacing=Config.BRUSH_SPACING,
+            points=stroke_points, curve=True
+        )
+        history.commit(image, stroke_bbox, layers.active_layer)
+
+def draw_shape(kind, x0, y0, x1, y1):
+    bbox = raster.draw_shape_on(
+        image, kind, x0, y0, x1, y1, current_color, brush_size, doc_size
+    )
+    journal.record(
+        "shape", shape=kind, box=[x0, y0, x1, y1],
+        color=current_color, size=brush_size
+    )
+    if bbox:
+        history.commit(image, bbox, layers.active_layer)
+        update_canvas(bbox)
+
+def prepare_fill(x, y):
+    # A fill at (x, y) as a job for the render worker and the callback
+    # that commits it on this thread (see run_in_worker)
+    fill_color = raster.hex_to_rgba(current_color)
+    layer, color, size = layers.active_layer, current_color, doc_size
+    index = fill_regions()
+    return (
+        lambda: flood_fill(layer.image, x, y, fill_color, size, index),
+        lambda bbox, error: finish_fill(layer, x, y, color, bbox, error)
+    )
+
+def resize_document(width, height):
+    # The backing store only ever grows, so shrinking the document keeps
+    # the clipped pixels for when it grows again
+    global doc_size
+    if layers.grow(width, height):
+        for layer in layers.layers:
+            history.rebase(layer.image, layer)
+        select_active_layer()
+        pyramid.set_source(layers.composite())
+    doc_size = (width, height)
+    view.doc_size = doc_size
+    journal.record("resize", size=[width, height])
+    # Fills stop at the document's edge, which has moved
+    clear_fill_preview()
+    if regions is not None:
+        regions.reset(image, doc_size)
+
+def new_document(width, height, follows_window):
+    set_document(blank_document(width, height), follows_window)
+    journal.reset("new", size=[width, height], format=pixel_format)
+
+# Selections. The outline is drawn with pooled overlay items; dragging
+# lifts the selected pixels out of the layer and moves them as a single
+# canvas image, so a large selection moves at the cost of a coords call
+def view_coords(points, dx=0, dy=0):
+    # Flat document points, offset by (dx, dy), in window pixels
+    coords = []
+    for i in range(0, len(points), 2):
+        coords.extend(view.to_view(points[i] + dx, points[i + 1] + dy))
+    return coords
+
+def show_selection_outline(dx=0, dy=0):
+    global selection_view
+    selection_view = (view.zoom, view.x, view.y)
+    if previews is None:
+        return
+    if current_selection is None:
+        previews.hide_group("marquee:")
+        return
+    spec = current_selection.spec
+    if spec["shape"] == "rectangle":
+        x0, y0, x1, y1 = current_selection.bbox
+        previews.hide("marquee:lasso", "marquee:lasso-ants")
+        previews.show_marquee(
+            "marquee", view_coords((x0, y0, x1, y1), dx, dy)
+        )
+    else:
+        coords = view_coords(spec["points"], dx, dy)
+        previews.hide("marquee:under", "marquee:over")
+        previews.hide_group("marquee:handle")
+        previews.show(
+            "marquee:lasso", "polygon", coords, outline="black", fill=""
+        )
+        previews.show(
+            "marquee:lasso-ants", "polygon", coords,
+            outline="white", fill="", dash=(4, 4)
+        )
+
+def set_selection(region):
+    global current_selection
+    current_selection = region
+    show_selection_outline()
+
+def selected_region():
+    # The selection clipped to the current document size, as replay
+    # will see it
+    if current_selection is None:
+        return None
+    return selection.Selection.from_spec(current_selection.spec, doc_size)
+
+def deselect(event=None):
+    set_selection(None)
+
+def select_all(event=None):
+    width, height = doc_size
+    set_selection(
+        selection.Selection.rectangle(0, 0, width - 1, height - 1, doc_size)
+    )
+
+def lift_selection():
+    # Cut the selected pixels out of the layer and show them floating
+    from PIL import ImageTk
+    global floating, floating_offset, floating_photo, floating_item
+    region = selected_region()
+    if region is None:
+        return
+    floating = selection.extract(image, region)
+    floating_offset = (0, 0)
+    update_canvas(selection.clear(image, region, layers.active_layer.fill))
+    shown = floating
+    if view.zoom != 1:
+        shown = floating.resize((
+            max(1, round(floating.width * view.zoom)),
+            max(1, round(floating.height * view.zoom))
+        ), Image.NEAREST)
+    floating_photo = ImageTk.PhotoImage(shown)
+    vx, vy = view.to_view(*region.bbox[:2])
+    if floating_item is None:
+        floating_item = canvas.create_image(
+            vx, vy, image=floating_photo, anchor=tk.NW
+        )
+    else:
+        canvas.coords(floating_item, vx, vy)
+        canvas.itemconfig(
+            floating_item, image=floating_photo, state=tk.NORMAL
+        )
+    canvas.tag_raise(floating_item)
+    canvas.tag_raise(previews.tag)
+
+def move_floating(dx, dy):
+    global floating_offset
+    floating_offset = (dx, dy)
+    x0, y0 = current_selection.bbox[:2]
+    canvas.coords(floating_item, *view.to_view(x0 + dx, y0 + dy))
+    show_selection_outline(dx, dy)
+
+def settle_selection():
+    # Put a selection that is being dragged down where it is now, so the
+    # layer and its undo base agree before the tool or the document size
+    # changes; the rest of the drag is ignored
+    global gesture_ignored
+    if floating is not None:
+        drop_selection(*floating_offset)
+        gesture_ignored = True
+
+@metrics.timed("move_selection")
+def drop_selection(dx, dy):
+    global floating, floating_photo
+    region = selected_region()
+    layer = layers.active_layer
+    if (dx, dy) == (0, 0):
+        # A click inside the selection: put the layer back as it was
+        image.paste(history.bases[layer].crop(region.bbox), region.bbox)
+        bbox = region.bbox
+    else:
+        x0, y0 = region.bbox[:2]
+        bbox = raster.union_bbox(region.bbox, selection.paste(
+            image, floating, x0 + dx, y0 + dy, doc_size
+        ))
+        journal.record("move", selection=region.spec, by=[dx, dy])
+        history.commit(image, bbox, layer)
+        set_selection(region.moved(dx, dy, doc_size))
+    update_canvas(bbox)
+    floating = floating_photo = None
+    canvas.itemconfig(floating_item, state=tk.HIDDEN)
+    show_selection_outline()
+
+@document_action
+def copy_selection(event=None):
+    global clipboard
+    region = selected_region()
+    if region is not None:
+        clipboard = (selection.extract(image, region), region)
+        journal.record("copy", selection=region.spec)
+
+@document_action
+def cut_selection(event=None):
+    global clipboard
+    region = selected_region()
+    if region is not None:
+        clipboard = (selection.extract(image, region), region)
+        journal.record("cut", selection=region.spec)
+        clear_selection(region)
+
+@document_action
+def delete_selection(event=None):
+    region = selected_region()
+    if region is not None:
+        journal.record("delete", selection=region.spec)
+        clear_selection(region)
+
+def clear_selection(region):
+    bbox = selection.clear(image, region, layers.active_layer.fill)
+    history.commit(image, bbox, layers.active_layer)
+    update_canvas(bbox)
+
+@document_action
+def paste_selection(event=None):
+    # Paste in place and select the pasted pixels, ready to be dragged
+    if clipboard is None:
+        return
+    pixels, region = clipboard
+    x, y = region.bbox[:2]
+    bbox = selection.paste(image, pixels, x, y, doc_size)
+    if bbox:
+        journal.record("paste", at=[x, y])
+        history.commit(image, bbox, layers.active_layer)
+        update_canvas(bbox)
+        set_selection(selection.Selection.from_spec(region.spec, doc_size))
 
 # Implement flood fill algorithm
-def flood_fill(x, y, fill_color):
-    try:
-        target_color = image.getpixel((x, y))
-    except IndexError:
+def flood_fill(target, x, y, fill_color, size, index):
+    # Returns the bounding box of the filled region, which stays inside
+    # the document ``size``. Exact fills of the selected layer are a
+    # masked assignment over the region ``index``; the span fill gives
+    # the same pixels (and is what replay uses). Runs on the render
+    # worker, so poll_worker times it (as "worker:fill"), not metrics.timed
+    if (Config.FILL_TOLERANCE == 0 and target is index.image
+            and size == index.size):
+        return index.fill(x, y, fill_color)
+    return raster.flood_fill(
+        target, x, y, fill_color,
+        tolerance=Config.FILL_TOLERANCE,
+        connectivity=Config.FILL_CONNECTIVITY, size=size
+    )
+
+def fill_regions():
+    # The region index of the selected layer, built on first use
+    global regions
+    if regions is None:
+        from regions import RegionIndex
+        regions = RegionIndex(Config.FILL_INDEX_TILE_SIZE,
+                              Config.FILL_CONNECTIVITY)
+        regions.reset(image, doc_size)
+    return regions
+
+def finish_fill(layer, x, y, color, bbox, error):
+    from tkinter import messagebox
+    if error is not None:
+        # The fill may have got part of the way; put the layer back as
+        # it was last committed
+        box = (0, 0) + layer.image.size
+        layer.image.copy_from(history.bases[layer], box)
+        update_canvas(box, layer)
+        messagebox.showerror("Fill", f"Could not fill:\n{error}")
         return
-    if target_color == fill_color:
+    if bbox:
+        journal.record(
+            "fill", at=[x, y], color=color,
+            tolerance=Config.FILL_TOLERANCE,
+            connectivity=Config.FILL_CONNECTIVITY
+        )
+        history.commit(layer.image, bbox, layer)
+        update_canvas(bbox, layer)
+
+@metrics.timed("fill_preview")
+def preview_fill(x, y):
+    # Tint the region a click at (x, y) would fill. The region is kept
+    # until the pointer leaves it or the document changes, so moving
+    # within one area costs a single lookup
+    from PIL import ImageTk
+    global fill_preview_region, fill_preview_shown, fill_preview_photo
+    width, height = doc_size
+    if (render_worker.busy() or Config.FILL_TOLERANCE
+            or not (0 <= x < width and 0 <= y < height)):
+        hide_fill_preview()
+        return
+    index = fill_regions()
+    tile, label = index.find(x, y)
+    if label not in (fill_preview_region or {}).get(tile, ()):
+        fill_preview_region = index.component((tile, label))
+        fill_preview_shown = None
+    shown = (view.zoom, view.x, view.y, current_color)
+    if shown == fill_preview_shown:
+        return
+    fill_preview_shown = shown
+
+    # Only the part of the region inside the window is drawn
+    left, top = view.to_doc(0, 0)
+    right, bottom = view.to_doc(view.width, view.height)
+    visible = index.mask(fill_preview_region, (
+        max(0, left), max(0, top),
+        min(width, right + 1), min(height, bottom + 1)
+    ))
+    if visible is None:
+        previews.hide("fill")
         return
+    mask, box = visible
+    stencil = Image.fromarray(mask)
+    tint = Image.new("RGBA", stencil.size)
+    red, green, blue = raster.hex_to_rgba(current_color)[:3]
+    tint.paste((red, green, blue, Config.FILL_PREVIEW_ALPHA), mask=stencil)
+    if view.zoom != 1:
+        tint = tint.resize((
+            max(1, round(tint.width * view.zoom)),
+            max(1, round(tint.height * view.zoom))
+        ), Image.NEAREST)
+    fill_preview_photo = ImageTk.PhotoImage(tint)
+    previews.show(
+        "fill", "image", view.to_view(*box[:2]),
+        image=fill_preview_photo, anchor=tk.NW
+    )
 
-    width, height = image.size
-    pixels = image.load()
-    stack = {(x, y)}  # Use set instead of list for faster lookups
-    seen = set()  # Track visited pixels
+def hide_fill_preview(event=None):
+    # Hide the tint but keep the region for when the pointer returns
+    global fill_preview_shown
+    fill_preview_shown = None
+    if previews is not None:
+        previews.hide("fill")
 
-    while stack:
-        nx, ny = stack.pop()
-        if (nx, ny) in seen:
-            continue
-            
-        if (0 <= nx < width and 0 <= ny < height and 
-            pixels[nx, ny] == target_color):
-            pixels[nx, ny] = fill_color
-            seen.add((nx, ny))
-            
-            # Add adjacent pixels
-            stack.update([
-                (nx + 1, ny), (nx - 1, ny),
-                (nx, ny + 1), (nx, ny - 1)
-            ])
+def clear_fill_preview():
+    # The document changed, so the region under the pointer may have too
+    global fill_preview_region, fill_preview_photo
+    hide_fill_preview()
+    fill_preview_region = fill_preview_photo = None
 
 # Undo function
+@metrics.timed("undo")
+@document_action
 def undo(event=None):
-    global image, draw
-    if actions_stack:
-        redo_stack.append(image.copy())
-        image = actions_stack.pop()
-        draw = ImageDraw.Draw(image)
-        update_canvas()
+    bbox = history.undo()
+    if bbox:
+        journal.record("undo")
+        update_canvas(bbox, history.last_key)
 
 # Redo function
+@metrics.timed("redo")
+@document_action
 def redo(event=None):
-    global image, draw
-    if redo_stack:
-        actions_stack.append(image.copy())
-        image = redo_stack.pop()
-        draw = ImageDraw.Draw(image)
-        update_canvas()
+    bbox = history.redo()
+    if bbox:
+        journal.record("redo")
+        update_canvas(bbox, history.last_key)
 
 # Define the font for emojis
 emoji_font = ("Apple Color Emoji", 36)
 label_font = ("San Francisco", 10)
 
-# Create the toolbar
-toolbar = ttk.Frame(root, padding="5 5")
-toolbar.pack(side=tk.TOP, fill=tk.X)
-
 # Common button settings
 button_size = 60
 circle_radius = 28
@@ -486,282 +1203,465 @@ def create_round_button(parent, emoji, command,
     CreateToolTip(canvas_btn, tooltip_text)
     return canvas_btn
 
-# Group 1: Drawing Tools (Brush and Eraser)
-drawing_tools_frame = ttk.Frame(toolbar)
-drawing_tools_frame.pack(side=tk.LEFT, padx=5)
-
-brush_button = create_round_button(
-    drawing_tools_frame,
-    '🖌️',
-    lambda: select_tool("brush"),
-    "Brush Tool (B)",
-    label_text="Brush",
-    tool_name="brush"
-)
+# Update status functions
+def update_tool_status():
+    tool_status.config(text=f"Tool: {current_tool.capitalize()}")
 
-eraser_button = create_round_button(
-    drawing_tools_frame,
-    '🩹',
-    lambda: select_tool("eraser"),
-    "Eraser Tool (E)",
-    label_text="Eraser",
-    tool_name="eraser"
-)
+def update_position_status(x, y):
+    position_status.config(text=f"Position: {x}, {y}")
 
-# Separator between groups
-ttk.Separator(toolbar, orient=tk.VERTICAL).pack(
-    side=tk.LEFT, fill=tk.Y, padx=5
-)
+def update_color_status():
+    color_status.config(text=f"Color: {current_color}")
 
-# Group 2: Shape Tools (Rectangle, Circle, Line)
-shape_tools_frame = ttk.Frame(toolbar)
-shape_tools_frame.pack(side=tk.LEFT, padx=5)
-
-rectangle_button = create_round_button(
-    shape_tools_frame,
-    '▭',
-    lambda: select_tool("rectangle"),
-    "Rectangle Tool (R)",
-    label_text="Rectangle",
-    tool_name="rectangle"
-)
+def update_zoom_status():
+    zoom_status.config(text=f"Zoom: {view.zoom * 100:.0f}%")
 
-circle_button = create_round_button(
-    shape_tools_frame,
-    '⚪',
-    lambda: select_tool("circle"),
-    "Circle Tool (C)",
-    label_text="Circle",
-    tool_name="circle"
-)
+def update_layer_status():
+    if root is None:
+        return
+    layer = layers.active_layer
+    hidden = "" if layer.visible else ", hidden"
+    layer_status.config(
+        text=f"Layer: {layer.name} ({layers.active + 1}/"
+             f"{len(layers.layers)}{hidden})"
+    )
 
-line_button = create_round_button(
-    shape_tools_frame,
-    '➖',
-    lambda: select_tool("line"),
-    "Line Tool (L)",
-    label_text="Line",
-    tool_name="line"
-)
+def toggle_perf_overlay():
+    global perf_job
+    if perf_job is not None:
+        # Toggling back on must not start a second refresh loop
+        root.after_cancel(perf_job)
+        perf_job = None
+    if show_perf_overlay.get():
+        perf_status.pack(side=tk.RIGHT, padx=5)
+        update_perf_status()
+    else:
+        perf_status.pack_forget()
+
+def update_perf_status():
+    global perf_job
+    perf_job = None
+    if not show_perf_overlay.get():
+        return
+    frame = metrics.histograms.get("frame")
+    frame_p50 = frame.percentile(50) * 1000 if frame else 0.0
+    frame_p95 = frame.percentile(95) * 1000 if frame else 0.0
+    perf_status.config(
+        text=f"Frame: {frame_p50:.1f}/{frame_p95:.1f} ms (p50/p95)"
+             f"  Items: {len(canvas.find_all())}"
+             f"  History: {history.memory_bytes / 1e6:.1f}"
+             f"/{history.nbytes / 1e6:.1f} MB (RAM/total)"
+             f"  Pixels: {document_bytes() / 1e6:.1f} MB"
+    )
+    perf_job = root.after(500, update_perf_status)
 
-# Separator between groups
-ttk.Separator(toolbar, orient=tk.VERTICAL).pack(
-    side=tk.LEFT, fill=tk.Y, padx=5
-)
+def dump_metrics(event=None):
+    from tkinter import filedialog
+    file_path = filedialog.asksaveasfilename(
+        defaultextension=".json",
+        filetypes=[
+            ("JSON files", "*.json"),
+            ("All files", "*.*")
+        ]
+    )
+    if file_path:
+        metrics.dump(file_path, extra={
+            "canvas_items": len(canvas.find_all()),
+            "overlay_items_created": previews.created,
+            "history_bytes": history.nbytes,
+            "history_memory_bytes": history.memory_bytes,
+            "image_size": list(image.size) if image else None,
+            "document_bytes": document_bytes() if image else None,
+        })
 
-# Group 3: Fill Tool
-fill_tools_frame = ttk.Frame(toolbar)
-fill_tools_frame.pack(side=tk.LEFT, padx=5)
-
-fill_button = create_round_button(
-    fill_tools_frame,
-    '🪣',
-    lambda: select_tool("fill"),
-    "Fill Tool (F)",
-    label_text="Fill",
-    tool_name="fill"
-)
+# Add this before your canvas creation code
+def create_optimized_canvas(root):
+    canvas = tk.Canvas(
+        root,
+        bg="white",
+        highlightthickness=0,  # Remove border
+        confine=True,  # Confine drawing to canvas
+        xscrollincrement=1,  # Smooth scrolling
+        yscrollincrement=1
+    )
+    return canvas
 
-# Separator between groups
-ttk.Separator(toolbar, orient=tk.VERTICAL).pack(
-    side=tk.LEFT, fill=tk.Y, padx=5
-)
+# Adjust color button size
+color_button_size = 50
 
-# Group 4: Action Tools (Undo and Redo)
-action_tools_frame = ttk.Frame(toolbar)
-action_tools_frame.pack(side=tk.LEFT, padx=5)
+# Define update_brush_size function
+def update_brush_size(value):
+    global brush_size
+    brush_size = max(1, int(float(value)))
+    brush_size_value_label.config(text=f"{brush_size}")
 
-undo_button = create_round_button(
-    action_tools_frame,
-    '↩️',
-    undo,
-    "Undo (Cmd+Z)",
-    label_text="Undo"
-)
+# Define update_brush_hardness function
+def update_brush_hardness(value):
+    global brush_hardness
+    # Round to whole percent so the cached brush tips get reused
+    brush_hardness = round(float(value)) / 100
+    brush_hardness_label.config(text=f"Hardness {brush_hardness:.0%}")
+
+def build_toolbar():
+    # Tool buttons, color and brush controls, and the color history
+    global color_button, brush_size_value_label, brush_size_slider
+    global brush_hardness_label, history_frame
+    toolbar = ttk.Frame(root, padding="5 5")
+    toolbar.pack(side=tk.TOP, fill=tk.X)
+
+    # Group 1: Drawing Tools (Brush and Eraser)
+    drawing_tools_frame = ttk.Frame(toolbar)
+    drawing_tools_frame.pack(side=tk.LEFT, padx=5)
+
+    brush_button = create_round_button(
+        drawing_tools_frame,
+        '🖌️',
+        lambda: select_tool("brush"),
+        "Brush Tool (B)",
+        label_text="Brush",
+        tool_name="brush"
+    )
 
-redo_button = create_round_button(
-    action_tools_frame,
-    '↪️',
-    redo,
-    "Redo (Shift+Cmd+Z)",
-    label_text="Redo"
-)
+    eraser_button = create_round_button(
+        drawing_tools_frame,
+        '🩹',
+        lambda: select_tool("eraser"),
+        "Eraser Tool (E)",
+        label_text="Eraser",
+        tool_name="eraser"
+    )
 
-# Separator between groups
-ttk.Separator(toolbar, orient=tk.VERTICAL).pack(
-    side=tk.LEFT, fill=tk.Y, padx=5
-)
+    # Separator between groups
+    ttk.Separator(toolbar, orient=tk.VERTICAL).pack(
+        side=tk.LEFT, fill=tk.Y, padx=5
+    )
 
-# Group 5: Color Picker and Brush Size
-other_tools_frame = ttk.Frame(toolbar)
-other_tools_frame.pack(side=tk.LEFT, padx=5)
+    # Group 2: Shape Tools (Rectangle, Circle, Line)
+    shape_tools_frame = ttk.Frame(toolbar)
+    shape_tools_frame.pack(side=tk.LEFT, padx=5)
+
+    rectangle_button = create_round_button(
+        shape_tools_frame,
+        '▭',
+        lambda: select_tool("rectangle"),
+        "Rectangle Tool (R)",
+        label_text="Rectangle",
+        tool_name="rectangle"
+    )
 
-# Adjust color button size
-color_button_size = 50
+    circle_button = create_round_button(
+        shape_tools_frame,
+        '⚪',
+        lambda: select_tool("circle"),
+        "Circle Tool (C)",
+        label_text="Circle",
+        tool_name="circle"
+    )
 
-# Add color button
-color_button_frame = ttk.Frame(other_tools_frame)
-color_button_frame.pack(side=tk.LEFT, padx=5)
+    line_button = create_round_button(
+        shape_tools_frame,
+        '➖',
+        lambda: select_tool("line"),
+        "Line Tool (L)",
+        label_text="Line",
+        tool_name="line"
+    )
 
-color_button = tk.Canvas(
-    color_button_frame, width=color_button_size,
-    height=color_button_size, bd=1, relief='ridge'
-)
-color_button.create_rectangle(
-    0, 0, color_button_size, color_button_size,
-    fill=current_color, outline=''
-)
-color_button.bind("<Button-1>", choose_color)
-color_button.pack()
-color_label = ttk.Label(color_button_frame, text="Color", font=label_font)
-color_label.pack()
-CreateToolTip(color_button, "Choose Color")
-
-# Add brush size label and slider frame
-brush_size_frame = ttk.Frame(other_tools_frame)
-brush_size_frame.pack(side=tk.LEFT, padx=5)
-
-# Add min and max labels for the slider
-min_label = ttk.Label(brush_size_frame, text="1")
-min_label.pack(side=tk.LEFT)
-
-# Add current brush size label
-brush_size_value_label = ttk.Label(
-    brush_size_frame, text=f"{brush_size}"
-)
-brush_size_value_label.pack(side=tk.LEFT, padx=5)
+    # Separator between groups
+    ttk.Separator(toolbar, orient=tk.VERTICAL).pack(
+        side=tk.LEFT, fill=tk.Y, padx=5
+    )
 
-# Define update_brush_size function
-def update_brush_size(value):
-    global brush_size
-    brush_size = max(1, int(float(value)))
-    brush_size_value_label.config(text=f"{brush_size}")
+    # Group 3: Fill Tool
+    fill_tools_frame = ttk.Frame(toolbar)
+    fill_tools_frame.pack(side=tk.LEFT, padx=5)
+
+    fill_button = create_round_button(
+        fill_tools_frame,
+        '🪣',
+        lambda: select_tool("fill"),
+        "Fill Tool (F)",
+        label_text="Fill",
+        tool_name="fill"
+    )
 
-# Add brush size slider
-brush_size_slider = ttk.Scale(
-    brush_size_frame, from_=1, to=100,
-    orient=tk.HORIZONTAL, command=update_brush_size,
-    length=150
-)
-brush_size_slider.set(brush_size)
-brush_size_slider.pack(side=tk.LEFT, padx=2)
-CreateToolTip(brush_size_slider, "Adjust Brush Size")
+    # Separator between groups
+    ttk.Separator(toolbar, orient=tk.VERTICAL).pack(
+        side=tk.LEFT, fill=tk.Y, padx=5
+    )
 
-# Add max label
-max_label = ttk.Label(brush_size_frame, text="100")
-max_label.pack(side=tk.LEFT)
+    # Group 4: Selection Tools
+    selection_tools_frame = ttk.Frame(toolbar)
+    selection_tools_frame.pack(side=tk.LEFT, padx=5)
+
+    select_button = create_round_button(
+        selection_tools_frame,
+        '⬚',
+        lambda: select_tool("select"),
+        "Select Tool (M)",
+        label_text="Select",
+        tool_name="select"
+    )
 
-# Separator between groups
-ttk.Separator(toolbar, orient=tk.VERTICAL).pack(
-    side=tk.LEFT, fill=tk.Y, padx=5
-)
+    lasso_button = create_round_button(
+        selection_tools_frame,
+        '➰',
+        lambda: select_tool("lasso"),
+        "Lasso Tool (O)",
+        label_text="Lasso",
+        tool_name="lasso"
+    )
 
-# Group 6: Color History Feature
-history_frame = ttk.Frame(toolbar)
-history_frame.pack(side=tk.LEFT, padx=5)
-CreateToolTip(history_frame, "Color History")
+    # Separator between groups
+    ttk.Separator(toolbar, orient=tk.VERTICAL).pack(
+        side=tk.LEFT, fill=tk.Y, padx=5
+    )
 
-refresh_color_history()
+    # Group 5: Action Tools (Undo and Redo)
+    action_tools_frame = ttk.Frame(toolbar)
+    action_tools_frame.pack(side=tk.LEFT, padx=5)
 
-# Add status bar
-status_bar = ttk.Frame(root, relief=tk.SUNKEN, padding="5 2")
-status_bar.pack(side=tk.BOTTOM, fill=tk.X)
+    undo_button = create_round_button(
+        action_tools_frame,
+        '↩️',
+        undo,
+        "Undo (Cmd+Z)",
+        label_text="Undo"
+    )
 
-# Labels for status information
-tool_status = ttk.Label(status_bar)
-tool_status.pack(side=tk.LEFT, padx=5)
+    redo_button = create_round_button(
+        action_tools_frame,
+        '↪️',
+        redo,
+        "Redo (Shift+Cmd+Z)",
+        label_text="Redo"
+    )
 
-position_status = ttk.Label(status_bar)
-position_status.pack(side=tk.LEFT, padx=5)
+    # Separator between groups
+    ttk.Separator(toolbar, orient=tk.VERTICAL).pack(
+        side=tk.LEFT, fill=tk.Y, padx=5
+    )
 
-color_status = ttk.Label(status_bar)
-color_status.pack(side=tk.LEFT, padx=5)
+    # Group 5: Color Picker and Brush Size
+    other_tools_frame = ttk.Frame(toolbar)
+    other_tools_frame.pack(side=tk.LEFT, padx=5)
 
-# Update status functions
-def update_tool_status():
-    tool_status.config(text=f"Tool: {current_tool.capitalize()}")
+    # Add color button
+    color_button_frame = ttk.Frame(other_tools_frame)
+    color_button_frame.pack(side=tk.LEFT, padx=5)
 
-def update_position_status(event):
-    position_status.config(text=f"Position: {event.x}, {event.y}")
+    color_button = tk.Canvas(
+        color_button_frame, width=color_button_size,
+        height=color_button_size, bd=1, relief='ridge'
+    )
+    color_button.create_rectangle(
+        0, 0, color_button_size, color_button_size,
+        fill=current_color, outline=''
+    )
+    color_button.bind("<Button-1>", choose_color)
+    color_button.pack()
+    color_label = ttk.Label(color_button_frame, text="Color", font=label_font)
+    color_label.pack()
+    CreateToolTip(color_button, "Choose Color")
+
+    # Add brush size label and slider frame
+    brush_size_frame = ttk.Frame(other_tools_frame)
+    brush_size_frame.pack(side=tk.LEFT, padx=5)
+
+    # Add min and max labels for the slider
+    min_label = ttk.Label(brush_size_frame, text="1")
+    min_label.pack(side=tk.LEFT)
+
+    # Add current brush size label
+    brush_size_value_label = ttk.Label(
+        brush_size_frame, text=f"{brush_size}"
+    )
+    brush_size_value_label.pack(side=tk.LEFT, padx=5)
 
-def update_color_status():
-    color_status.config(text=f"Color: {current_color}")
+    # Add brush size slider
+    brush_size_slider = ttk.Scale(
+        brush_size_frame, from_=1, to=100,
+        orient=tk.HORIZONTAL, command=update_brush_size,
+        length=150
+    )
+    brush_size_slider.set(brush_size)
+    brush_size_slider.pack(side=tk.LEFT, padx=2)
+    CreateToolTip(brush_size_slider, "Adjust Brush Size")
 
-# Call update functions to initialize status bar
-update_tool_status()
-update_color_status()
+    # Add max label
+    max_label = ttk.Label(brush_size_frame, text="100")
+    max_label.pack(side=tk.LEFT)
 
-# Update button states to reflect the initial tool
-update_button_states()
+    # Add brush hardness slider
+    brush_hardness_frame = ttk.Frame(other_tools_frame)
+    brush_hardness_frame.pack(side=tk.LEFT, padx=5)
 
-# Add this before your canvas creation code
-def create_optimized_canvas(root):
-    canvas = tk.Canvas(
-        root,
-        bg="white",
-        highlightthickness=0,  # Remove border
-        confine=True,  # Confine drawing to canvas
-        xscrollincrement=1,  # Smooth scrolling
-        yscrollincrement=1
+    brush_hardness_label = ttk.Label(
+        brush_hardness_frame, text=f"Hardness {brush_hardness:.0%}"
     )
-    return canvas
+    brush_hardness_label.pack(side=tk.LEFT, padx=5)
 
-# Then replace your existing canvas creation with:
-canvas = create_optimized_canvas(root)
-canvas.pack(fill=tk.BOTH, expand=True)
+    brush_hardness_slider = ttk.Scale(
+        brush_hardness_frame, from_=0, to=100,
+        orient=tk.HORIZONTAL, command=update_brush_hardness,
+        length=100
+    )
+    brush_hardness_slider.set(brush_hardness * 100)
+    brush_hardness_slider.pack(side=tk.LEFT, padx=2)
+    CreateToolTip(brush_hardness_slider, "Adjust Brush Hardness")
+
+    # Separator between groups
+    ttk.Separator(toolbar, orient=tk.VERTICAL).pack(
+        side=tk.LEFT, fill=tk.Y, padx=5
+    )
+
+    # Group 6: Color History Feature
+    history_frame = ttk.Frame(toolbar)
+    history_frame.pack(side=tk.LEFT, padx=5)
+    CreateToolTip(history_frame, "Color History")
+
+    refresh_color_history()
+
+def build_status_bar():
+    global tool_status, position_status, color_status, zoom_status
+    global layer_status, save_status, work_status
+    global perf_status, show_perf_overlay
+    # Add status bar
+    status_bar = ttk.Frame(root, relief=tk.SUNKEN, padding="5 2")
+    status_bar.pack(side=tk.BOTTOM, fill=tk.X)
+
+    # Labels for status information
+    tool_status = ttk.Label(status_bar)
+    tool_status.pack(side=tk.LEFT, padx=5)
+
+    position_status = ttk.Label(status_bar)
+    position_status.pack(side=tk.LEFT, padx=5)
+
+    color_status = ttk.Label(status_bar)
+    color_status.pack(side=tk.LEFT, padx=5)
+
+    zoom_status = ttk.Label(status_bar)
+    zoom_status.pack(side=tk.LEFT, padx=5)
+
+    layer_status = ttk.Label(status_bar)
+    layer_status.pack(side=tk.LEFT, padx=5)
+
+    save_status = ttk.Label(status_bar)
+    save_status.pack(side=tk.LEFT, padx=5)
+
+    work_status = ttk.Label(status_bar)
+    work_status.pack(side=tk.LEFT, padx=5)
+
+    # Optional performance overlay on the right of the status bar
+    perf_status = ttk.Label(status_bar)
+    show_perf_overlay = tk.BooleanVar(value=False)
 
 # Initialize the canvas image after the canvas is created and packed
 def initialize_canvas_image(event=None):
-    global image, draw
     if image is None:
         canvas_width = canvas.winfo_width()
         canvas_height = canvas.winfo_height()
-        image = Image.new(
-            "RGBA", (canvas_width, canvas_height), "white"
-        )
-        draw = ImageDraw.Draw(image)
-        update_canvas()
-
-# Bind the initialization to the canvas size change
-canvas.bind("<Configure>", initialize_canvas_image, add="+")
-canvas.bind("<Configure>", resize_canvas, add="+")
-canvas.bind("<Motion>", update_position_status)
-
-# Bind mouse events to the canvas for drawing and shape creation
-canvas.bind("<B1-Motion>", paint)
-canvas.bind("<ButtonPress-1>", start_draw)
-canvas.bind("<ButtonRelease-1>", lambda e: (finalize_shape(e), on_release(e)))
+        view.width, view.height = canvas_width, canvas_height
+        # Check before the new document's first checkpoint replaces it;
+        # a file another running instance holds is not a crashed session,
+        # but those of other instances that crashed are
+        sessions = []
+        if recovery.claim() and recovery.has_session():
+            sessions.append(recovery)
+        sessions += autosave.orphans(Config.AUTOSAVE_PATH)
+        new_document(canvas_width, canvas_height, follows_window=True)
+        if sessions:
+            root.after_idle(offer_restore, sessions)
+        else:
+            root.after(Config.AUTOSAVE_INTERVAL, autosave_checkpoint)
+
+def offer_restore(sessions):
+    # Autosaving starts only once this is answered, so the old session
+    # is not overwritten while the dialog is open. Sessions are offered
+    # in turn until one is restored. Those of other crashed instances are
+    # deleted once restored or declined; any not offered, or that could
+    # not be read, are kept for the next start
+    from tkinter import messagebox
+    restored = None
+    for session in sessions:
+        keep = restored is not None
+        if not keep and messagebox.askyesno(
+            "Restore",
+            "The drawing application did not exit cleanly. Restore the"
+            f" session last saved {last_saved(session.path)}?"
+        ):
+            try:
+                restored, size, ops = autosave.restore(session.path)
+            except (OSError, ValueError) as e:
+                keep = True
+                messagebox.showerror("Restore", f"Could not restore:\n{e}")
+            if restored is not None:
+                set_document(restored, follows_window=False, size=size)
+                journal.ops = ops
+        if session is recovery:
+            continue  # This instance's file, overwritten from now on
+        if keep:
+            session.release()
+        else:
+            session.discard()
+    root.after(Config.AUTOSAVE_INTERVAL, autosave_checkpoint)
 
-# Add this new function to capture the brush strokes when released
+def last_saved(path):
+    try:
+        return time.strftime("%Y-%m-%d %H:%M",
+                             time.localtime(os.path.getmtime(path)))
+    except OSError:
+        return "at an unknown time"
+
+@metrics.timed("autosave")
+def autosave_checkpoint():
+    # Takes the changes here and writes them on the worker, so a large
+    # compaction doesn't hold up the UI. Skipped while the worker owns
+    # the document or is still writing the last one; the next catches up
+    if not render_worker.pending:
+        write = recovery.prepare(layers, doc_size, journal.ops)
+        if write is not None:
+            run_in_worker("autosave", write, autosaved, owns_document=False)
+    root.after(Config.AUTOSAVE_INTERVAL, autosave_checkpoint)
+
+def autosaved(written, error):
+    if error is not None:
+        save_status.config(text=f"Autosave failed: {error}")
+    elif save_status.cget("text").startswith("Autosave failed"):
+        save_status.config(text="")
+
+def bind_canvas_events():
+    # Bind the initialization to the canvas size change
+    canvas.bind("<Configure>", initialize_canvas_image, add="+")
+    canvas.bind("<Configure>", resize_canvas, add="+")
+    canvas.bind("<Motion>", on_motion)
+    canvas.bind("<Leave>", hide_fill_preview)
+
+    # Mouse wheel pans and zooms (Button-4/5 on X11); middle button drags
+    canvas.bind("<MouseWheel>", on_mouse_wheel)
+    canvas.bind("<Button-4>", on_mouse_wheel)
+    canvas.bind("<Button-5>", on_mouse_wheel)
+    canvas.bind("<ButtonPress-2>", start_pan)
+    canvas.bind("<B2-Motion>", pan_view)
+
+    # Bind mouse events to the canvas for drawing and shape creation
+    canvas.bind("<B1-Motion>", on_drag)
+    canvas.bind("<ButtonPress-1>", start_draw)
+    canvas.bind("<ButtonRelease-1>", end_draw)
+
+def end_draw(event):
+    # A press refused because the worker was busy is ignored to the end
+    if not gesture_ignored:
+        process_frame()
+        finalize_shape(event)
+        on_release(event)
+
+# Commit the brush stroke when the mouse is released
+@metrics.timed("on_release")
 def on_release(event):
-    global image, draw
     if current_tool in ("brush", "eraser"):
-        # Draw any remaining batch
-        draw_batch()
-        
-        # Capture the final state more efficiently
-        actions_stack.append(image.copy())
-        redo_stack.clear()
-        
-        def capture_canvas():
-            global image, draw
-            # Get canvas bounds
-            x = root.winfo_rootx() + canvas.winfo_x()
-            y = root.winfo_rooty() + canvas.winfo_y()
-            x1 = x + canvas.winfo_width()
-            y1 = y + canvas.winfo_height()
-            
-            try:
-                # Try to capture with ImageGrab
-                image = ImageGrab.grab(bbox=(x, y, x1, y1))
-                draw = ImageDraw.Draw(image)
-            except Exception as e:
-                print(f"Error capturing canvas: {e}")
-        
-        # Use threading for capture
-        thread = threading.Thread(target=capture_canvas)
-        thread.daemon = True  # Make thread daemon so it doesn't block program exit
-        thread.start()
+        previews.hide("stroke:tail")
+        end_stroke()
 
 # Create macOS-style menus (optional; you can adjust this section)
 def create_macos_menus(root):
@@ -792,6 +1692,7 @@ def create_macos_menus(root):
     file_menu.add_command(
         label="New", command=new_file, accelerator='Cmd+N'
     )
+    file_menu.add_command(label="New Canvas...", command=new_canvas)
     file_menu.add_command(
         label="Open...", command=open_image, accelerator='Cmd+O'
     )
@@ -799,8 +1700,46 @@ def create_macos_menus(root):
         label="Save As...", command=save_image, accelerator='Cmd+S'
     )
 
+    # Encoder settings: trade file size against save time
+    export_menu = tk.Menu(file_menu)
+    file_menu.add_cascade(label="Export Settings", menu=export_menu)
+    for label, level in (("Fastest", 1), ("Default", 6), ("Smallest", 9)):
+        export_menu.add_radiobutton(
+            label=f"PNG Compression: {label}",
+            variable=png_compress_level, value=level
+        )
+    export_menu.add_checkbutton(
+        label="Optimize PNG (slow)", variable=png_optimize
+    )
+    export_menu.add_separator()
+    export_menu.add_checkbutton(
+        label="Lossless WebP", variable=webp_lossless
+    )
+    export_menu.add_command(
+        label="JPEG Quality...", command=set_jpeg_quality
+    )
+
+    # Smaller formats cut the memory of the document and its history
+    format_menu = tk.Menu(file_menu, postcommand=sync_format_choice)
+    file_menu.add_cascade(label="Pixel Format", menu=format_menu)
+    for mode, label in formats.FORMATS.items():
+        format_menu.add_radiobutton(
+            label=label, variable=format_choice, value=mode,
+            command=lambda m=mode: set_pixel_format(m)
+        )
+
+    file_menu.add_separator()
+    file_menu.add_command(
+        label="Open Journal...", command=open_journal
+    )
+    file_menu.add_command(
+        label="Save Journal...", command=save_journal
+    )
+
     # Edit menu
-    edit_menu = tk.Menu(menu_bar)
+    edit_menu = tk.Menu(
+        menu_bar, postcommand=lambda: sync_edit_menu(edit_menu)
+    )
     menu_bar.add_cascade(label="Edit", menu=edit_menu)
     edit_menu.add_command(
         label="Undo", command=undo, accelerator='Cmd+Z'
@@ -808,6 +1747,90 @@ def create_macos_menus(root):
     edit_menu.add_command(
         label="Redo", command=redo, accelerator='Shift+Cmd+Z'
     )
+    edit_menu.add_separator()
+    edit_menu.add_command(
+        label="Cut", command=cut_selection, accelerator='Cmd+X'
+    )
+    edit_menu.add_command(
+        label="Copy", command=copy_selection, accelerator='Cmd+C'
+    )
+    edit_menu.add_command(
+        label="Paste", command=paste_selection, accelerator='Cmd+V'
+    )
+    edit_menu.add_command(
+        label="Delete", command=delete_selection, accelerator='Delete'
+    )
+    edit_menu.add_separator()
+    edit_menu.add_command(
+        label="Select All", command=select_all, accelerator='Cmd+A'
+    )
+    edit_menu.add_command(
+        label="Deselect", command=deselect, accelerator='Cmd+D'
+    )
+
+    # View menu
+    view_menu = tk.Menu(menu_bar)
+    menu_bar.add_cascade(label="View", menu=view_menu)
+    view_menu.add_command(
+        label="Zoom In", command=zoom_in, accelerator='Cmd+='
+    )
+    view_menu.add_command(
+        label="Zoom Out", command=zoom_out, accelerator='Cmd+-'
+    )
+    view_menu.add_command(
+        label="Actual Size", command=zoom_actual_size, accelerator='Cmd+0'
+    )
+    view_menu.add_separator()
+    view_menu.add_checkbutton(
+        label="Performance Overlay", variable=show_perf_overlay,
+        command=toggle_perf_overlay
+    )
+    view_menu.add_command(
+        label="Dump Performance Metrics...", command=dump_metrics
+    )
+
+    # Brush menu
+    brush_menu = tk.Menu(menu_bar)
+    menu_bar.add_cascade(label="Brush", menu=brush_menu)
+    # brush.SHAPES, spelt out so that the menu doesn't load the engine
+    for shape in ("round", "square"):
+        brush_menu.add_radiobutton(
+            label=f"{shape.capitalize()} Tip", variable=brush_shape_choice,
+            value=shape, command=lambda s=shape: set_brush_shape(s)
+        )
+
+    # Layers menu
+    layers_menu = tk.Menu(menu_bar, postcommand=sync_layer_choices)
+    menu_bar.add_cascade(label="Layers", menu=layers_menu)
+    layers_menu.add_command(
+        label="New Layer", command=add_layer, accelerator='Shift+Cmd+N'
+    )
+    layers_menu.add_command(label="Delete Layer", command=delete_layer)
+    layers_menu.add_command(
+        label="Move Layer Up", command=lambda: move_layer(1)
+    )
+    layers_menu.add_command(
+        label="Move Layer Down", command=lambda: move_layer(-1)
+    )
+    layers_menu.add_separator()
+    layers_menu.add_command(
+        label="Show/Hide Layer", command=toggle_layer_visibility
+    )
+    layers_menu.add_command(
+        label="Layer Opacity...", command=set_layer_opacity
+    )
+    blend_menu = tk.Menu(layers_menu)
+    layers_menu.add_cascade(label="Blend Mode", menu=blend_menu)
+    for mode in BLEND_MODES:
+        blend_menu.add_radiobutton(
+            label=mode.capitalize(), variable=blend_choice, value=mode,
+            command=lambda m=mode: set_layer_blend(m)
+        )
+    layers_menu.add_separator()
+    select_menu = tk.Menu(
+        layers_menu, postcommand=lambda: refresh_layer_menu(select_menu)
+    )
+    layers_menu.add_cascade(label="Select Layer", menu=select_menu)
 
     # Help menu
     help_menu = tk.Menu(menu_bar)
@@ -818,31 +1841,228 @@ def create_macos_menus(root):
     )
 
 # Implement show_about and other menu functions
+def reset_view():
+    view.zoom = 1.0
+    view.x = view.y = 0.0
+
+def blank_document(width, height):
+    return tiles.TiledImage(
+        pixel_format, (width, height), "white", Config.DOCUMENT_TILE_SIZE
+    )
+
+def tiled_layer(layer):
+    # A layer's image as sparse tiles; safe to run on the render worker
+    return tiles.tiled(layer.image, layer.fill, Config.DOCUMENT_TILE_SIZE)
+
+@document_action
+def set_pixel_format(mode):
+    # Convert the document; new documents get the same format. Undo
+    # patches hold pixels of the old format, so the history starts over
+    global pixel_format
+    pixel_format = mode
+    if mode == layers.mode:
+        return
+    deselect()
+    # The converted layers are swapped in only once all of them are done
+    run_in_worker(
+        "format", lambda: layers.converted_images(mode),
+        lambda images, error: finish_pixel_format(mode, images, error)
+    )
+
+def finish_pixel_format(mode, images, error):
+    from tkinter import messagebox
+    global pixel_format
+    if error is not None:
+        pixel_format = layers.mode
+        messagebox.showerror(
+            "Pixel Format", f"Could not convert the document:\n{error}"
+        )
+        return
+    converted = iter(images)
+    layers.map_images(lambda layer: next(converted))
+    history.reset(layers.layers[0].image, layers.layers[0])
+    for layer in layers.layers[1:]:
+        history.rebase(layer.image, layer)
+    recovery.reset()  # Every pixel changed
+    journal.record("format", format=mode)
+    select_active_layer()
+    update_canvas()
+
+def set_document(document, follows_window, size=None):
+    # Replace the whole document (an image or a layer stack) and start a
+    # fresh undo history
+    global layers, doc_size, doc_follows_window, pixel_format
+    if not isinstance(document, LayerStack):
+        document = LayerStack(document, Config.LAYER_TILE_SIZE)
+    document.map_images(tiled_layer)
+    layers = document
+    pixel_format = layers.mode
+    doc_size = size or layers.size
+    view.doc_size = doc_size
+    doc_follows_window = follows_window
+    history.reset(layers.layers[0].image, layers.layers[0])
+    for layer in layers.layers[1:]:
+        history.rebase(layer.image, layer)
+    recovery.reset()
+    # Nothing drawn over the old document applies to the new one
+    if previews is not None:
+        previews.hide_all()
+    select_active_layer()
+    reset_view()
+    deselect()
+    update_canvas()
+
+def select_active_layer():
+    # Point the drawing tools at the selected layer
+    global image
+    image = layers.active_layer.image
+    if regions is not None:
+        regions.reset(image, doc_size)
+    update_layer_status()
+
+def document_bytes():
+    # Memory held by painted layer tiles
+    return sum(layer.image.nbytes for layer in layers.layers)
+
+def document_image():
+    # The flattened document, without any spare backing-store capacity
+    return layers.flatten(doc_size)
+
+# Layer actions; each one is journaled so replay rebuilds the same stack
+@document_action
+def add_layer(event=None):
+    layer = layers.add()
+    history.rebase(layer.image, layer)
+    journal.record("layer", action="add")
+    select_active_layer()
+    update_canvas()
+
+@document_action
+def delete_layer(event=None):
+    if layers.active == 0:
+        # A transparent layer in its place would change the document's
+        # mode and flatten its transparency
+        from tkinter import messagebox
+        messagebox.showinfo("Delete Layer",
+                            "The background layer can't be deleted.")
+        return
+    journal.record("layer", action="remove", index=layers.active)
+    history.forget(layers.remove(layers.active))
+    select_active_layer()
+    update_canvas()
+
+@document_action
+def move_layer(offset):
+    to = layers.active + offset
+    if not 0 < to < len(layers.layers) or layers.active == 0:
+        return
+    journal.record("layer", action="move", index=layers.active, to=to)
+    layers.move(layers.active, to)
+    select_active_layer()
+    update_canvas()
+
+@document_action
+def select_layer(index):
+    # Only the cached partial composites change; the view stays as is
+    layers.select(index)
+    journal.record("layer", action="select", index=index)
+    select_active_layer()
+
+@document_action
+def toggle_layer_visibility(event=None):
+    visible = not layers.active_layer.visible
+    layers.set_visible(layers.active, visible)
+    journal.record(
+        "layer", action="visible", index=layers.active, value=visible
+    )
+    update_layer_status()
+    update_canvas()
+
+@document_action
+def set_layer_opacity(event=None):
+    from tkinter import simpledialog
+    percent = simpledialog.askinteger(
+        "Layer Opacity", "Opacity (0-100%):",
+        initialvalue=round(layers.active_layer.opacity * 100),
+        minvalue=0, maxvalue=100
+    )
+    if percent is not None:
+        layers.set_opacity(layers.active, percent / 100)
+        journal.record(
+            "layer", action="opacity", index=layers.active,
+            value=percent / 100
+        )
+        update_canvas()
+
+@document_action
+def set_layer_blend(mode):
+    layers.set_blend(layers.active, mode)
+    journal.record("layer", action="blend", index=layers.active, value=mode)
+    update_canvas()
+
+def refresh_layer_menu(menu):
+    # Rebuild the layer list each time the menu opens, topmost first
+    menu.delete(0, tk.END)
+    for index in reversed(range(len(layers.layers))):
+        menu.add_radiobutton(
+            label=layers.layers[index].name, variable=layer_choice,
+            value=index, command=lambda i=index: select_layer(i)
+        )
+
+def sync_format_choice():
+    format_choice.set(layers.mode)
+
+def sync_layer_choices():
+    layer_choice.set(layers.active)
+    blend_choice.set(layers.active_layer.blend)
+
+def sync_edit_menu(menu):
+    # Grey out Undo and Redo when there is nothing to undo or redo
+    for label, possible in (("Undo", history.can_undo()),
+                            ("Redo", history.can_redo())):
+        menu.entryconfig(label, state=tk.NORMAL if possible else tk.DISABLED)
+
 def show_about():
+    from tkinter import messagebox
     messagebox.showinfo(
         "About",
         "Simple Drawing Application\nCreated with Tkinter and Pillow"
     )
 
+@document_action
 def new_file(event=None):
-    global image, draw, actions_stack, redo_stack
+    from tkinter import messagebox
     if messagebox.askyesno(
         "New File",
         "Are you sure you want to create a new file?"
         " Unsaved changes will be lost."
     ):
-        canvas_width = canvas.winfo_width()
-        canvas_height = canvas.winfo_height()
-        image = Image.new(
-            "RGBA", (canvas_width, canvas_height), "white"
-        )
-        draw = ImageDraw.Draw(image)
-        actions_stack.clear()
-        redo_stack.clear()
-        update_canvas()
+        new_document(canvas.winfo_width(), canvas.winfo_height(),
+                     follows_window=True)
+
+@document_action
+def new_canvas(event=None):
+    # A document of a chosen size, independent of the window; it costs
+    # memory only where it is painted
+    from tkinter import messagebox, simpledialog
+    text = simpledialog.askstring(
+        "New Canvas", "Size in pixels (width x height):",
+        initialvalue=f"{doc_size[0]}x{doc_size[1]}"
+    )
+    if not text:
+        return
+    try:
+        width, height = (int(side) for side in text.lower().split("x"))
+        if width <= 0 or height <= 0:
+            raise ValueError
+    except ValueError:
+        messagebox.showerror("New Canvas", f"Not a size: {text}")
+        return
+    new_document(width, height, follows_window=False)
 
+@document_action
 def open_image(event=None):
-    global image, draw, actions_stack, redo_stack
+    from tkinter import filedialog
     file_path = filedialog.askopenfilename(
         filetypes=[
             ("Image files", "*.png *.jpg *.jpeg *.bmp"),
@@ -850,48 +2070,167 @@ def open_image(event=None):
         ]
     )
     if file_path:
-        opened_image = Image.open(file_path).convert("RGBA")
-        canvas_width = canvas.winfo_width()
-        canvas_height = canvas.winfo_height()
-        opened_image = opened_image.resize(
-            (canvas_width, canvas_height), Image.LANCZOS
+        # Decode on the render worker so a large file does not freeze
+        # the window
+        mode = pixel_format
+        run_in_worker(
+            "open", lambda: tiles.tiled(
+                formats.convert(raster.load_image(file_path), mode), "white",
+                Config.DOCUMENT_TILE_SIZE
+            ),
+            lambda opened, error: finish_open(file_path, opened, error)
         )
-        image = Image.new(
-            "RGBA", (canvas_width, canvas_height), "white"
+
+def finish_open(path, opened, error):
+    from tkinter import messagebox
+    if error is not None:
+        messagebox.showerror(
+            "Open", f"Could not open {os.path.basename(path)}:\n{error}"
         )
-        image.paste(opened_image, (0, 0))
-        draw = ImageDraw.Draw(image)
-        actions_stack.clear()
-        redo_stack.clear()
-        update_canvas()
+        return
+    # Keep the image at its native resolution
+    set_document(opened, follows_window=False)
+    journal.reset("open", path=path, format=opened.mode)
 
+@document_action
 def save_image(event=None):
+    from tkinter import filedialog, messagebox
+    global save_job
+    if save_job is not None:
+        messagebox.showinfo(
+            "Save", f"Still saving {os.path.basename(save_job.path)}."
+        )
+        return
     file_path = filedialog.asksaveasfilename(
         defaultextension=".png",
         filetypes=[
             ("PNG files", "*.png"),
+            ("WebP files", "*.webp"),
+            ("JPEG files", "*.jpg *.jpeg"),
+            ("All files", "*.*")
+        ]
+    )
+    if file_path:
+        # Encode a private copy on a worker thread, so drawing can carry
+        # on without changing what gets written. The copy shares the
+        # document's tiles until they change, and PNGs are written from
+        # it a band of rows at a time
+        snapshot = layers.snapshot(doc_size)
+        save_job = export.SaveJob(
+            snapshot, file_path,
+            png_compress_level=png_compress_level.get(),
+            png_optimize=png_optimize.get(),
+            webp_lossless=webp_lossless.get(),
+            jpeg_quality=jpeg_quality.get()
+        )
+        save_status.config(
+            text=f"Saving {os.path.basename(file_path)}..."
+        )
+        root.after(Config.SAVE_POLL_INTERVAL, poll_save)
+
+def poll_save():
+    from tkinter import messagebox
+    global save_job
+    if not save_job.done():
+        root.after(Config.SAVE_POLL_INTERVAL, poll_save)
+        return
+    job, save_job = save_job, None
+    name = os.path.basename(job.path)
+    if job.error:
+        save_status.config(text="")
+        messagebox.showerror("Save", f"Could not save {name}:\n{job.error}")
+    else:
+        metrics.record("save", job.seconds)
+        save_status.config(text=f"Saved {name} ({job.seconds:.1f} s)")
+
+def set_jpeg_quality():
+    from tkinter import simpledialog
+    quality = simpledialog.askinteger(
+        "JPEG Quality", "Quality (1-95):",
+        initialvalue=jpeg_quality.get(), minvalue=1, maxvalue=95
+    )
+    if quality:
+        jpeg_quality.set(quality)
+
+def save_journal(event=None):
+    from tkinter import filedialog
+    file_path = filedialog.asksaveasfilename(
+        defaultextension=".sdj",
+        filetypes=[
+            ("Drawing journals", "*.sdj"),
             ("All files", "*.*")
         ]
     )
     if file_path:
-        image.save(file_path)
+        journal.save(file_path)
+
+@document_action
+def open_journal(event=None):
+    from tkinter import filedialog
+    file_path = filedialog.askopenfilename(
+        filetypes=[
+            ("Drawing journals", "*.sdj"),
+            ("All files", "*.*")
+        ]
+    )
+    if file_path:
+        # Replaying a long journal takes a while; do it on the worker.
+        # The layers are kept as replayed, so the records appended from
+        # here on refer to the same stack
+        def load():
+            loaded = Journal.load(file_path)
+            replayer = Replayer(tile_size=Config.DOCUMENT_TILE_SIZE)
+            for op in loaded.ops:
+                replayer.apply(op)
+            return loaded, replayer.layers, replayer.size
+        run_in_worker(
+            "open_journal", load,
+            lambda result, error: finish_open_journal(file_path, result, error)
+        )
+
+def finish_open_journal(path, result, error):
+    from tkinter import messagebox
+    global journal
+    if error is not None:
+        messagebox.showerror(
+            "Open Journal",
+            f"Could not replay {os.path.basename(path)}:\n{error}"
+        )
+        return
+    # Rebuild the drawing and keep appending to the loaded journal
+    journal, document, size = result
+    set_document(document, follows_window=False, size=size)
 
 def show_help():
+    from tkinter import messagebox
     messagebox.showinfo(
         "Help",
         "This is a simple drawing application."
     )
 
-# Call the function to create menus
-create_macos_menus(root)
-
-# Update keyboard shortcuts for macOS
-root.bind_all('<Command-n>', new_file)
-root.bind_all('<Command-o>', open_image)
-root.bind_all('<Command-s>', save_image)
-root.bind_all('<Command-z>', undo)
-root.bind_all('<Shift-Command-Z>', redo)
-root.bind_all('<Command-q>', lambda event: root.quit())
+def set_brush_shape(shape):
+    global brush_shape
+    brush_shape = shape
+
+def bind_shortcuts():
+    # Update keyboard shortcuts for macOS
+    root.bind_all('<Command-n>', new_file)
+    root.bind_all('<Shift-Command-N>', add_layer)
+    root.bind_all('<Command-o>', open_image)
+    root.bind_all('<Command-s>', save_image)
+    root.bind_all('<Command-z>', undo)
+    root.bind_all('<Shift-Command-Z>', redo)
+    root.bind_all('<Command-q>', lambda event: root.quit())
+    root.bind_all('<Command-equal>', zoom_in)
+    root.bind_all('<Command-minus>', zoom_out)
+    root.bind_all('<Command-0>', zoom_actual_size)
+    root.bind_all('<Command-x>', cut_selection)
+    root.bind_all('<Command-c>', copy_selection)
+    root.bind_all('<Command-v>', paste_selection)
+    root.bind_all('<Command-a>', select_all)
+    root.bind_all('<Command-d>', deselect)
+    root.bind_all('<Delete>', delete_selection)
+    root.bind_all('<BackSpace>', delete_selection)
 
 # Function to handle keyboard shortcuts for tools
 def bind_tool_shortcuts():
@@ -901,15 +2240,90 @@ def bind_tool_shortcuts():
     root.bind('c', lambda event: select_tool('circle'))
     root.bind('l', lambda event: select_tool('line'))
     root.bind('f', lambda event: select_tool('fill'))
+    root.bind('m', lambda event: select_tool('select'))
+    root.bind('o', lambda event: select_tool('lasso'))
+
+def create_app():
+    # Build the main window and its widgets; returns the Tk root
+    global root, canvas, previews, render_worker
+    global png_compress_level, png_optimize, webp_lossless, jpeg_quality
+    global format_choice
+    global brush_shape_choice, layer_choice, blend_choice
+    # Call this before creating the root window
+    enable_gpu_acceleration()
+    root = tk.Tk()
+    root.title("Simple Drawing Application")
+    root.geometry("1400x1000")
+    root.option_add("*Font", default_font)
+
+    # Encoder settings used by Save As, adjustable from the File menu
+    png_compress_level = tk.IntVar(value=Config.PNG_COMPRESS_LEVEL)
+    png_optimize = tk.BooleanVar(value=Config.PNG_OPTIMIZE)
+    webp_lossless = tk.BooleanVar(value=Config.WEBP_LOSSLESS)
+    jpeg_quality = tk.IntVar(value=Config.JPEG_QUALITY)
+
+    # Pixel format of the document, as shown in the File menu
+    format_choice = tk.StringVar(value=pixel_format)
+
+    # Brush tip shape, as shown in the Brush menu
+    brush_shape_choice = tk.StringVar(value=brush_shape)
+
+    # Selected layer and its blend mode, as shown in the Layers menu
+    layer_choice = tk.IntVar(value=0)
+    blend_choice = tk.StringVar(value="normal")
+
+    build_toolbar()
+    build_status_bar()
+    update_tool_status()
+    update_color_status()
+    update_button_states()
+
+    canvas = create_optimized_canvas(root)
+    canvas.pack(fill=tk.BOTH, expand=True)
+    # Pooled canvas items for shape, selection and fill previews
+    previews = Overlay(canvas)
+    bind_canvas_events()
+
+    create_macos_menus(root)
+    bind_shortcuts()
+    bind_tool_shortcuts()
+    render_worker = RenderWorker()
+    return root
+
+def finish_startup():
+    # Runs once the first frame is on screen and the event loop is idle,
+    # i.e. when the window first responds to input
+    seconds = metrics.process_uptime()
+    if seconds is None:
+        seconds = time.perf_counter() - startup_clock
+    metrics.record("startup", seconds)
+    if measure_startup:
+        print(f"Startup: {seconds * 1000:.0f} ms to first interactive frame")
+        root.quit()
+        return
+    # Load the deferred modules now rather than in the first stroke
+    for name in DEFERRED_MODULES:
+        importlib.import_module(name)
+
+def main(argv=None):
+    global measure_startup
+    parser = argparse.ArgumentParser(description="Simple Drawing Application")
+    parser.add_argument(
+        "--startup-time", action="store_true",
+        help="print the time to the first interactive frame and exit"
+    )
+    args = parser.parse_args(argv)
+    measure_startup = args.startup_time
 
-bind_tool_shortcuts()
+    create_app()
+    root.mainloop()
+    render_worker.close()
 
-# Start the Tkinter main loop
-root.mainloop()
+    # A clean exit leaves nothing to recover
+    if save_job is not None:
+        save_job.wait()
+    if not measure_startup:
+        recovery.discard()
 
-# Add near the start of your program
-try:
-    from ctypes import windll
-    windll.shcore.SetProcessDpiAwareness(1)
-except:
-    pass  # Not on Windows or DPI awareness not available
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""Bitmask selections and the pixel operations on them.
+
+A ``Selection`` is a boolean mask covering only its bounding box. The
+operations work on NumPy arrays of that box, so cutting, filling or
+moving a large selection is a few vectorised array operations rather
+than a loop over pixels, and each one reports the box it changed.
+Nothing in here imports Tkinter.
+"""
+import numpy as np
+from PIL import Image, ImageDraw
+
+import formats
+import raster
+
+
+class Selection:
+    def __init__(self, mask, bbox, spec):
+        self.mask = mask  # bool array, (height, width) of bbox
+        self.bbox = bbox
+        self.spec = spec  # JSON-friendly description, for the journal
+
+    @classmethod
+    def rectangle(cls, x0, y0, x1, y1, size):
+        """Rectangle between two corners, clipped to ``size``."""
+        box = _clip((min(x0, x1), min(y0, y1),
+                     max(x0, x1) + 1, max(y0, y1) + 1), size)
+        if box is None:
+            return None
+        mask = np.ones((box[3] - box[1], box[2] - box[0]), dtype=bool)
+        return cls(mask, box, {"shape": "rectangle",
+                               "box": [x0, y0, x1, y1]})
+
+    @classmethod
+    def lasso(cls, points, size):
+        """Polygon through the flat list of ``points``, clipped."""
+        xs, ys = points[0::2], points[1::2]
+        if len(xs) < 3:
+            return None
+        box = _clip((min(xs), min(ys), max(xs) + 1, max(ys) + 1), size)
+        if box is None:
+            return None
+        stencil = Image.new("1", (box[2] - box[0], box[3] - box[1]))
+        ImageDraw.Draw(stencil).polygon(
+            [(x - box[0], y - box[1]) for x, y in zip(xs, ys)], fill=1
+        )
+        mask = np.asarray(stencil)
+        if not mask.any():
+            return None
+        return cls(mask, box, {"shape": "lasso", "points": list(points)})
+
+    @classmethod
+    def from_spec(cls, spec, size):
+        if spec["shape"] == "rectangle":
+            return cls.rectangle(*spec["box"], size)
+        if spec["shape"] == "lasso":
+            return cls.lasso(spec["points"], size)
+        raise ValueError(f"Unknown selection shape: {spec['shape']}")
+
+    def contains(self, x, y):
+        x0, y0, x1, y1 = self.bbox
+        return x0 <= x < x1 and y0 <= y < y1 and self.mask[y - y0, x - x0]
+
+    def moved(self, dx, dy, size):
+        """The same shape moved by (dx, dy), clipped to ``size``."""
+        spec = dict(self.spec)
+        if spec["shape"] == "rectangle":
+            x0, y0, x1, y1 = spec["box"]
+            spec["box"] = [x0 + dx, y0 + dy, x1 + dx, y1 + dy]
+        else:
+            spec["points"] = [value + (dy if i % 2 else dx)
+                              for i, value in enumerate(spec["points"])]
+        return Selection.from_spec(spec, size)
+
+
+def _clip(box, size):
+    width, height = size
+    box = (max(0, box[0]), max(0, box[1]),
+           min(width, box[2]), min(height, box[3]))
+    if box[0] >= box[2] or box[1] >= box[3]:
+        return None
+    return box
+
+
+def extract(image, selection):
+    """The selected pixels as an RGBA image the size of the bbox.
+
+    Unselected pixels are fully transparent.
+    """
+    pixels = np.array(formats.to_rgba(image.crop(selection.bbox)))
+    pixels[~selection.mask] = 0
+    return Image.fromarray(pixels, "RGBA")
+
+
+def clear(image, selection, fill):
+    """Set the selected pixels to ``fill``; returns the changed box."""
+    fill = formats.pixel(fill, image.mode)
+    region = np.array(image.crop(selection.bbox))
+    region[selection.mask] = fill
+    image.paste(Image.fromarray(region, image.mode), selection.bbox[:2])
+    return selection.bbox
+
+
+def paste(image, floating, x, y, size=None):
+    """Composite the RGBA ``floating`` with its corner at (x, y).
+
+    Only the part inside ``size`` (the whole image if None) is pasted.
+    Returns the changed box, or None if it lies outside.
+    """
+    box = _clip((x, y, x + floating.width, y + floating.height),
+                size or image.size)
+    if box is None:
+        return None
+    floating = floating.crop((box[0] - x, box[1] - y,
+                              box[2] - x, box[3] - y))
+    region = Image.alpha_composite(formats.to_rgba(image.crop(box)), floating)
+    image.paste(formats.convert(region, image.mode), box[:2])
+    return box
+
+
+def move(image, selection, dx, dy, fill, size=None):
+    """Lift the selected pixels, leaving ``fill``, and drop them (dx, dy)
+    away, within ``size``; returns the changed box."""
+    floating = extract(image, selection)
+    bbox = clear(image, selection, fill)
+    x0, y0 = selection.bbox[:2]
+    return raster.union_bbox(
+        bbox, paste(image, floating, x0 + dx, y0 + dy, size)
+    )
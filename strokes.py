@@ -0,0 +1,123 @@
+"""Simplified, smooth brush stroke paths.
+
+A slow stroke produces far more pointer samples than its shape needs.
+``Simplifier`` drops them as they arrive: a sample is only kept once the
+path can no longer be drawn as a straight segment without straying more
+than a tolerance from the samples in between. Kept points never change,
+so a stroke is stamped along ``curve``, a smooth spline through its kept
+points, span by span (``span``) while it is drawn; each span depends
+only on the points either side of it. The journal stores the kept
+points, and replay stamps exactly the same curve. Paths are flat lists
+``[x0, y0, x1, y1, ...]``, as in the journal. Nothing in here imports
+Tkinter.
+"""
+import math
+
+import numpy as np
+
+CURVE_STEP = 2.0  # Max distance between points sampled along a curve
+
+
+def _distance_to_segment(px, py, ax, ay, bx, by):
+    dx, dy = bx - ax, by - ay
+    length = dx * dx + dy * dy
+    t = 0.0
+    if length:
+        t = min(1.0, max(0.0, ((px - ax) * dx + (py - ay) * dy) / length))
+    return math.hypot(px - ax - t * dx, py - ay - t * dy)
+
+
+class Simplifier:
+    """Incremental simplification of a stroke's pointer samples.
+
+    ``points`` holds the kept points, starting with the first sample;
+    ``pending`` the samples after the last kept point, which may still be
+    dropped. Samples closer than ``min_distance`` to the previous one are
+    ignored. The last pending sample is kept once a straight segment from
+    the last kept point to a new sample would pass more than
+    ``tolerance`` pixels from a pending one, or once ``window`` samples
+    are pending, so a long straight stroke still comes through in pieces.
+    """
+
+    def __init__(self, x, y, tolerance=1.0, min_distance=1.0, window=32):
+        self.points = [x, y]
+        self.pending = []
+        self.tolerance = tolerance
+        self.min_distance = min_distance
+        self.window = window
+
+    def add(self, x, y):
+        """Add a sample; returns True if it made a new kept point."""
+        if math.dist((x, y), (self.pending or self.points)[-2:]) < (
+                self.min_distance):
+            return False
+        pending = self.pending
+        ax, ay = self.points[-2:]
+        if len(pending) // 2 < self.window and all(
+            _distance_to_segment(pending[i], pending[i + 1], ax, ay, x, y)
+            <= self.tolerance for i in range(0, len(pending), 2)
+        ):
+            pending.extend((x, y))
+            return False
+        self.points.extend(pending[-2:])
+        self.pending = [x, y]
+        return True
+
+    def finish(self):
+        """Keep the last sample; returns True if it was pending."""
+        if not self.pending:
+            return False
+        self.points.extend(self.pending[-2:])
+        self.pending = []
+        return True
+
+
+def _segment(p0, p1, p2, p3, count):
+    # ``count`` points of the centripetal Catmull-Rom span from p1 to p2,
+    # evaluated with the Barry-Goldman pyramid; p1 itself is excluded
+    t0 = 0.0
+    t1 = t0 + max(math.dist(p0, p1) ** 0.5, 1e-6)
+    t2 = t1 + max(math.dist(p1, p2) ** 0.5, 1e-6)
+    t3 = t2 + max(math.dist(p2, p3) ** 0.5, 1e-6)
+    t = (t1 + (t2 - t1) * np.arange(1, count + 1) / count)[:, None]
+    a1 = ((t1 - t) * p0 + (t - t0) * p1) / (t1 - t0)
+    a2 = ((t2 - t) * p1 + (t - t1) * p2) / (t2 - t1)
+    a3 = ((t3 - t) * p2 + (t - t2) * p3) / (t3 - t2)
+    b1 = ((t2 - t) * a1 + (t - t0) * a2) / (t2 - t0)
+    b2 = ((t3 - t) * a2 + (t - t1) * a3) / (t3 - t1)
+    return ((t2 - t) * b1 + (t - t1) * b2) / (t2 - t1)
+
+
+def span(points, index, step=CURVE_STEP):
+    """The part of ``curve(points)`` from point ``index`` to the next one,
+    without point ``index`` itself, as a flat list.
+
+    Only the points from ``index - 1`` to ``index + 2`` are used; where
+    there are none, the curve is mirrored so that it starts and ends on
+    the path.
+    """
+    first = max(0, index - 1)
+    xy = np.asarray(points[2 * first:2 * index + 6], dtype=float)
+    xy = xy.reshape(-1, 2)
+    i = index - first
+    p1, p2 = xy[i], xy[i + 1]
+    p0 = xy[i - 1] if i > 0 else 2 * p1 - p2
+    p3 = xy[i + 2] if i + 2 < len(xy) else 2 * p2 - p1
+    count = max(1, math.ceil(math.dist(p1, p2) / step))
+    return _segment(p0, p1, p2, p3, count).ravel().tolist()
+
+
+def curve(points, step=CURVE_STEP):
+    """Points along a smooth curve through the flat list ``points``.
+
+    The curve is a centripetal Catmull-Rom spline, which passes through
+    every point without loops or cusps. It is sampled no more than about
+    ``step`` pixels apart and returned as a flat list. Paths of fewer
+    than three points are returned as they are.
+    """
+    if len(points) < 6:
+        return list(points)
+    path = list(points[:2])
+    for index in range(len(points) // 2 - 1):
+        path.extend(span(points, index, step))
+    return path
@@ -0,0 +1,152 @@
+"""Recovery files must restore the document as it was at the last
+complete checkpoint, and a crashed instance's file must be found again.
+"""
+import os
+
+import pytest
+
+import raster
+import tiles
+from autosave import MAGIC, RecoveryStore, orphans, restore
+from layers import LayerStack
+
+
+def document(size=(200, 150)):
+    return LayerStack(tiles.TiledImage("RGBA", size, "white", 64))
+
+
+def paint(store, layers, box, color):
+    layer = layers.active_layer
+    bbox = raster.draw_shape_on(layer.image, "rectangle", *box, color, 4)
+    layers.invalidate(bbox, layer)
+    store.invalidate(bbox, layer)
+
+
+def assert_restores(path, layers, size):
+    restored, restored_size, ops = restore(path)
+    assert restored_size == size
+    assert [layer.props() for layer in restored.layers] == \
+        [layer.props() for layer in layers.layers]
+    assert restored.active == layers.active
+    assert restored.flatten(size).tobytes() == layers.flatten(size).tobytes()
+    return ops
+
+
+def test_checkpoints_restore(tmp_path):
+    path = str(tmp_path / "recovery")
+    store = RecoveryStore(path, tile_size=64)
+    layers = document()
+    ops = [{"op": "new", "size": [200, 150], "format": "RGBA"}]
+    assert store.checkpoint(layers, (200, 150), ops)
+    assert store.checkpoint(layers, (200, 150), ops) == 0  # Nothing new
+
+    paint(store, layers, (10, 10, 90, 90), "red")
+    ops.append({"op": "shape"})
+    appended = store.checkpoint(layers, (200, 150), ops)
+    assert 0 < appended < os.path.getsize(path)
+
+    layers.add()
+    paint(store, layers, (50, 40, 190, 140), "blue")
+    layers.set_opacity(1, 0.5)
+    ops.append({"op": "layer"})
+    store.checkpoint(layers, (200, 150), ops)
+    layers.grow(260, 180)
+    store.checkpoint(layers, (260, 180), ops)
+    assert assert_restores(path, layers, (260, 180)) == ops
+
+
+def test_torn_checkpoint_is_ignored(tmp_path):
+    path = str(tmp_path / "recovery")
+    # Never compacted, so every checkpoint is appended
+    store = RecoveryStore(path, tile_size=64, compact_ratio=1000)
+    layers = document()
+    store.checkpoint(layers, (200, 150), [])
+    paint(store, layers, (10, 10, 90, 90), "red")
+    store.checkpoint(layers, (200, 150), [])
+    good = layers.flatten((200, 150))
+    paint(store, layers, (100, 10, 190, 140), "green")
+    size = os.path.getsize(path)
+    store.checkpoint(layers, (200, 150), [])
+    # A crash in the middle of the last append
+    with open(path, "r+b") as f:
+        f.truncate(size + (os.path.getsize(path) - size) // 2)
+    restored, _, _ = restore(path)
+    assert restored.flatten((200, 150)).tobytes() == good.tobytes()
+
+
+def test_prepared_checkpoint_writes_what_was_taken(tmp_path):
+    path = str(tmp_path / "recovery")
+    store = RecoveryStore(path, tile_size=64)
+    layers = document()
+    store.checkpoint(layers, (200, 150), [])
+    paint(store, layers, (10, 10, 90, 90), "red")
+    taken = layers.flatten((200, 150))
+    write = store.prepare(layers, (200, 150), [])
+    # The document changes before the write gets to run
+    paint(store, layers, (0, 0, 199, 149), "black")
+    assert write()
+    restored, _, _ = restore(path)
+    assert restored.flatten((200, 150)).tobytes() == taken.tobytes()
+    store.checkpoint(layers, (200, 150), [])
+    assert_restores(path, layers, (200, 150))
+
+
+def test_failed_write_takes_a_snapshot_next(tmp_path):
+    path = str(tmp_path / "recovery")
+    store = RecoveryStore(path, tile_size=64)
+    layers = document()
+    store.checkpoint(layers, (200, 150), [])
+    paint(store, layers, (10, 10, 90, 90), "red")
+    store.path = str(tmp_path / "missing" / "recovery")
+    write = store.prepare(layers, (200, 150), [])
+    with pytest.raises(OSError):
+        write()
+    store.path = path
+    assert store.needs_snapshot
+    store.checkpoint(layers, (200, 150), [])
+    assert_restores(path, layers, (200, 150))
+
+
+def test_second_instance_keeps_its_own_file(tmp_path):
+    path = str(tmp_path / "recovery")
+    first = RecoveryStore(path)
+    assert first.claim()
+    second = RecoveryStore(path)
+    assert not second.claim()
+    assert second.path != path
+    second.discard()
+    assert not os.path.exists(second.path + ".lock")
+    first.discard()
+
+
+def test_orphans_of_crashed_instances(tmp_path):
+    path = str(tmp_path / "recovery")
+    layers = document()
+    first = RecoveryStore(path)
+    assert first.claim()
+    # Instances started while the first one runs keep files of their own
+    crashed, empty, running = (RecoveryStore(path) for _ in range(3))
+    for store in (crashed, empty, running):
+        assert not store.claim()
+    for store in (crashed, running):
+        store.checkpoint(layers, (200, 150), [])
+    with open(empty.path, "wb") as f:
+        f.write(MAGIC)  # Nothing written past the header
+    for store in (crashed, empty):
+        store.lock_file.close()  # The process died
+
+    found = orphans(path)
+    assert [store.path for store in found] == [crashed.path]
+    assert not os.path.exists(empty.path)
+    # Claimed by this instance until restored or declined
+    assert orphans(path) == []
+    restored, _, _ = restore(found[0].path)
+    assert restored.flatten((200, 150)).tobytes() == \
+        layers.flatten((200, 150)).tobytes()
+    found[0].discard()
+    assert sorted(os.listdir(tmp_path)) == sorted([
+        "recovery.lock", os.path.basename(running.path),
+        os.path.basename(running.path) + ".lock"
+    ])
+    running.discard()
+    first.discard()
@@ -0,0 +1,62 @@
+"""``export.write_png`` must write what Pillow reads back unchanged, for
+dense and tiled images alike.
+"""
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import export
+import tiles
+
+
+def sample(mode, size=(150, 90)):
+    rng = np.random.default_rng(3)
+    noise = Image.fromarray(
+        rng.integers(0, 256, (size[1], size[0], 3), dtype=np.uint8), "RGB"
+    )
+    # Flat areas next to noise, so every filter gets picked somewhere
+    noise.paste((20, 120, 220), (0, 0, size[0] // 2, size[1]))
+    if mode == "P":
+        return noise.quantize(64)
+    if mode in ("RGBA", "LA"):
+        noise.putalpha(Image.linear_gradient("L").resize(size))
+    return noise.convert(mode)
+
+
+def written(image, **options):
+    out = io.BytesIO()
+    export.write_png(image, out, **options)
+    out.seek(0)
+    return Image.open(out)
+
+
+@pytest.mark.parametrize("mode", ["RGBA", "RGB", "LA", "L", "P"])
+def test_round_trip(mode):
+    image = sample(mode)
+    read = written(image, band=16)
+    assert read.mode == mode and read.size == image.size
+    assert read.tobytes() == image.tobytes()
+    if mode == "P":
+        assert read.getpalette() == image.getpalette()
+
+
+def test_tiled_image_round_trip():
+    image = sample("RGBA", (300, 200))
+    tiled = tiles.tiled(image.copy(), (0, 0, 0, 0), 64)
+    tiled.paste((255, 0, 0, 255), (64, 64, 192, 128))
+    image.paste((255, 0, 0, 255), (64, 64, 192, 128))
+    read = written(tiled, compress_level=1)
+    assert read.tobytes() == image.tobytes()
+
+
+def test_save_writes_the_chosen_format(tmp_path):
+    image = sample("RGB")
+    for name in ("out.png", "out.webp"):
+        path = tmp_path / name
+        export.save(image, str(path))
+        with Image.open(path) as read:
+            assert read.size == image.size
+            if name.endswith(".png"):
+                assert read.convert("RGB").tobytes() == image.tobytes()
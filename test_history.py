@@ -0,0 +1,98 @@
+"""Undo and redo must restore pixels exactly, also for actions whose
+patches were spilled to disk, and across the layers of a document.
+"""
+from PIL import Image
+
+import raster
+import tiles
+from history import TileHistory
+
+
+def draw(history, image, box, color, key=None):
+    bbox = raster.draw_shape_on(image, "rectangle", *box, color, 5)
+    assert history.commit(image, bbox, key)
+
+
+def test_undo_and_redo():
+    image = tiles.TiledImage("RGBA", (200, 150), "white", 64)
+    history = TileHistory(tile_size=32)
+    history.reset(image)
+    states = [image.crop((0, 0, 200, 150)).tobytes()]
+    for i in range(5):
+        draw(history, image, (10 + i * 30, 10, 60 + i * 30, 120),
+             (40 * i, 0, 0))
+        states.append(image.crop((0, 0, 200, 150)).tobytes())
+    for state in reversed(states[:-1]):
+        assert history.undo()
+        assert image.crop((0, 0, 200, 150)).tobytes() == state
+    assert not history.can_undo() and history.undo() is None
+    for state in states[1:]:
+        assert history.redo()
+        assert image.crop((0, 0, 200, 150)).tobytes() == state
+    assert not history.can_redo()
+
+
+def test_commit_drops_redo():
+    image = Image.new("RGB", (64, 64), "white")
+    history = TileHistory(tile_size=16)
+    history.reset(image)
+    draw(history, image, (5, 5, 30, 30), "red")
+    history.undo()
+    draw(history, image, (20, 20, 60, 60), "blue")
+    assert not history.can_redo()
+    assert image.getpixel((5, 5)) == (255, 255, 255)
+
+
+def test_spilled_actions_come_back(tmp_path):
+    image = tiles.TiledImage("RGBA", (256, 256), "white", 64)
+    history = TileHistory(tile_size=32, memory_entries=2,
+                          spill_dir=str(tmp_path))
+    history.reset(image)
+    states = [image.crop((0, 0, 256, 256)).tobytes()]
+    for i in range(12):
+        draw(history, image, (i * 20, i * 20, i * 20 + 40, 250),
+             (i * 20, 255 - i * 20, 0))
+        states.append(image.crop((0, 0, 256, 256)).tobytes())
+    assert history.spill_file is not None
+    assert history.in_memory <= 2
+    # Back and forth, so entries are read back and spilled again
+    for _ in range(2):
+        for state in reversed(states[:-1]):
+            history.undo()
+            assert image.crop((0, 0, 256, 256)).tobytes() == state
+            assert history.in_memory <= 2
+        for state in states[1:]:
+            history.redo()
+            assert image.crop((0, 0, 256, 256)).tobytes() == state
+
+
+def test_budget_keeps_the_latest_action():
+    image = Image.new("RGB", (128, 128), "white")
+    history = TileHistory(tile_size=32, budget=1)
+    history.reset(image)
+    for i in range(4):
+        draw(history, image, (i * 10, 0, i * 10 + 50, 127), "black")
+    assert len(history.undo_stack) == 1
+    assert history.undo()
+    assert not history.can_undo()
+
+
+def test_actions_remember_their_layer():
+    background = tiles.TiledImage("RGBA", (96, 96), "white", 32)
+    layer = tiles.TiledImage("RGBA", (96, 96), (0, 0, 0, 0), 32)
+    history = TileHistory(tile_size=32)
+    history.reset(background, "background")
+    history.rebase(layer, "layer")
+    draw(history, background, (10, 10, 50, 50), "red", "background")
+    draw(history, layer, (30, 30, 90, 90), "blue", "layer")
+    history.undo()
+    assert history.last_key == "layer"
+    assert layer.getpixel((30, 30)) == (0, 0, 0, 0)
+    assert background.getpixel((10, 10)) == (255, 0, 0, 255)
+    history.undo()
+    assert history.last_key == "background"
+    assert background.getpixel((10, 10)) == (255, 255, 255, 255)
+    history.forget("layer")
+    history.redo()
+    assert background.getpixel((10, 10)) == (255, 0, 0, 255)
+    assert not history.can_redo()
@@ -0,0 +1,84 @@
+"""Flood fill: the tile-by-tile fill of a TiledImage must give the same
+pixels as the fill of a dense Pillow image, and keep covered tiles plain.
+"""
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+import raster
+import tiles
+
+
+def maze(width, height, seed, colors=("white", "black")):
+    # Random walls; enough of them that regions cross tile edges in odd
+    # shapes
+    rng = np.random.default_rng(seed)
+    image = Image.new("RGBA", (width, height), colors[0])
+    draw = ImageDraw.Draw(image)
+    for _ in range(40):
+        x0, y0 = rng.integers(0, width), rng.integers(0, height)
+        x1, y1 = rng.integers(0, width), rng.integers(0, height)
+        draw.line((x0, y0, x1, y1), fill=colors[1], width=2)
+    return image
+
+
+@pytest.mark.parametrize("seed", range(4))
+@pytest.mark.parametrize("connectivity", [4, 8])
+def test_tiled_fill_matches_dense(seed, connectivity):
+    dense = maze(150, 110, seed)
+    tiled = tiles.tiled(dense.copy(), "white", 32)
+    rng = np.random.default_rng(100 + seed)
+    for _ in range(5):
+        x, y = int(rng.integers(0, 150)), int(rng.integers(0, 110))
+        color = tuple(int(c) for c in rng.integers(0, 256, 3)) + (255,)
+        expected = raster.flood_fill(dense, x, y, color,
+                                     connectivity=connectivity)
+        assert raster.flood_fill(tiled, x, y, color,
+                                 connectivity=connectivity) == expected
+        assert tiled.crop((0, 0, 150, 110)).tobytes() == dense.tobytes()
+
+
+def test_tiled_fill_with_tolerance_matches_dense():
+    gradient = np.tile(np.arange(128, dtype=np.uint8) * 2, (96, 1))
+    dense = Image.fromarray(gradient, "L").convert("RGB")
+    tiled = tiles.tiled(dense.copy(), "white", 32)
+    for image in (dense, tiled):
+        raster.flood_fill(image, 60, 40, (255, 0, 0), tolerance=30)
+    assert tiled.crop((0, 0, 128, 96)).tobytes() == dense.tobytes()
+    assert dense.getpixel((60, 40)) == (255, 0, 0)
+    assert dense.getpixel((0, 40)) == (0, 0, 0)
+
+
+def test_tiled_mask_matches_dense():
+    dense = maze(100, 100, 7)
+    tiled = tiles.tiled(dense.copy(), "white", 16)
+    mask, bbox = raster.flood_fill_mask(dense, 3, 3)
+    tiled_mask, tiled_bbox = raster.flood_fill_mask(tiled, 3, 3)
+    assert tiled_bbox == bbox
+    assert np.array_equal(tiled_mask, mask)
+
+
+def test_covered_tiles_stay_plain():
+    image = tiles.TiledImage("RGBA", (256, 256), "white", 64)
+    raster.draw_shape_on(image, "rectangle", 70, 70, 180, 180, "black", 3)
+    assert raster.flood_fill(image, 5, 5, (0, 0, 255, 255)) == (0, 0, 256, 256)
+    assert image.tiles[(0, 0)] == (0, 0, 255, 255)
+    assert isinstance(image.tiles[(1, 1)], Image.Image)
+    # Inside the rectangle nothing changed
+    assert image.getpixel((120, 120)) == (255, 255, 255, 255)
+
+
+def test_fill_stays_inside_size():
+    image = tiles.TiledImage("RGBA", (200, 200), "white", 64)
+    bbox = raster.flood_fill(image, 10, 10, (255, 0, 0, 255), size=(90, 70))
+    assert bbox == (0, 0, 90, 70)
+    assert image.getpixel((89, 69)) == (255, 0, 0, 255)
+    assert image.getpixel((90, 10)) == (255, 255, 255, 255)
+    assert image.getpixel((10, 70)) == (255, 255, 255, 255)
+
+
+def test_nothing_to_fill():
+    image = tiles.TiledImage("RGBA", (64, 64), "white", 32)
+    assert raster.flood_fill(image, 1, 1, "white") is None
+    assert raster.flood_fill(image, 64, 1, "black") is None
+    assert image.tiles == {}
@@ -0,0 +1,73 @@
+"""The region index must fill exactly what ``raster.flood_fill`` fills
+with tolerance 0, also after edits have dropped some of its labels.
+"""
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+import raster
+import tiles
+from regions import RegionIndex
+
+
+def line_art(width, height, seed):
+    rng = np.random.default_rng(seed)
+    image = Image.new("RGBA", (width, height), "white")
+    draw = ImageDraw.Draw(image)
+    for _ in range(30):
+        box = sorted(rng.integers(0, width, 2)) + sorted(
+            rng.integers(0, height, 2))
+        draw.ellipse((box[0], box[2], box[1], box[3]), outline="black")
+    return image
+
+
+@pytest.mark.parametrize("connectivity", [4, 8])
+def test_fills_match_raster(connectivity):
+    expected = line_art(180, 130, connectivity)
+    image = tiles.tiled(expected.copy(), "white", 64)
+    index = RegionIndex(32, connectivity)
+    index.reset(image)
+    rng = np.random.default_rng(9)
+    for _ in range(8):
+        x, y = int(rng.integers(0, 180)), int(rng.integers(0, 130))
+        color = tuple(int(c) for c in rng.integers(0, 256, 3)) + (255,)
+        bbox = raster.flood_fill(expected, x, y, color,
+                                 connectivity=connectivity)
+        assert index.fill(x, y, color) == bbox
+        if bbox:
+            index.invalidate(bbox)
+        assert image.crop((0, 0, 180, 130)).tobytes() == expected.tobytes()
+
+
+def test_edit_reopens_a_region():
+    image = tiles.TiledImage("RGBA", (128, 96), "white", 32)
+    raster.draw_shape_on(image, "line", 60, 0, 60, 95, "black", 3)
+    index = RegionIndex(32)
+    index.reset(image)
+    left = index.component(index.find(10, 10))
+    assert index.find(100, 10)[0] not in left
+    # A white gap through the wall joins the two halves
+    image.paste((255, 255, 255, 255), (55, 40, 66, 50))
+    index.invalidate((55, 40, 66, 50))
+    assert index.fill(10, 10, (0, 128, 0, 255)) == (0, 0, 128, 96)
+    assert image.getpixel((100, 10)) == (0, 128, 0, 255)
+
+
+def test_mask_matches_raster():
+    image = line_art(100, 80, 5)
+    index = RegionIndex(32)
+    index.reset(image)
+    mask, bbox = index.mask(index.component(index.find(2, 2)))
+    expected_mask, expected_bbox = raster.flood_fill_mask(image, 2, 2)
+    assert bbox == expected_bbox
+    assert np.array_equal(mask, expected_mask)
+
+
+def test_outside_the_indexed_size():
+    image = tiles.TiledImage("RGBA", (100, 100), "white", 32)
+    index = RegionIndex(32)
+    index.reset(image, (60, 40))
+    assert index.find(70, 10) is None
+    assert index.fill(70, 10, (0, 0, 0, 255)) is None
+    assert index.fill(5, 5, (0, 0, 0, 255)) == (0, 0, 60, 40)
+    assert image.getpixel((60, 5)) == (255, 255, 255, 255)
@@ -0,0 +1,193 @@
+"""Replay must rebuild what the application drew.
+
+The edits go through sda's own document operations (``begin_stroke``,
+``draw_shape``, ``prepare_fill``, the layer and selection actions), the
+ones its mouse handlers drive; without a window they only skip drawing.
+Each test then replays the journal sda recorded and compares the pixels.
+Importing sda doesn't open a window.
+"""
+import math
+
+import pytest
+
+import sda
+from journal import Journal, replay
+
+
+@pytest.fixture(autouse=True)
+def app(monkeypatch):
+    # sda keeps the document and the tool settings in module globals
+    monkeypatch.setattr(sda, "current_tool", "brush")
+    monkeypatch.setattr(sda, "current_color", "#204080")
+    monkeypatch.setattr(sda, "brush_size", 9)
+    monkeypatch.setattr(sda, "pixel_format", "RGBA")
+    monkeypatch.setattr(sda, "regions", None)
+    monkeypatch.setattr(sda, "clipboard", None)
+    monkeypatch.setattr(sda, "current_selection", None)
+
+
+def stroke(points, tool="brush", color="#204080", size=9):
+    # One sample per frame, as the handlers pass them on
+    sda.current_tool, sda.current_color, sda.brush_size = tool, color, size
+    sda.begin_stroke(*points[0])
+    for point in points[1:]:
+        sda.continue_stroke([point])
+    sda.end_stroke()
+
+
+def shape(kind, box, color="#cc3300", size=3):
+    sda.current_color, sda.brush_size = color, size
+    sda.draw_shape(kind, *box)
+
+
+def fill(x, y, color):
+    # The worker's job and its callback, on this thread
+    sda.current_color = color
+    job, done = sda.prepare_fill(x, y)
+    bbox = job()
+    done(bbox, None)
+    return bbox
+
+
+def assert_same(a, b):
+    assert a.size == b.size and a.mode == b.mode
+    assert a.tobytes() == b.tobytes()
+
+
+def assert_replays():
+    assert_same(replay(sda.journal.ops), sda.document_image())
+
+
+def wave(x, y, count=12, step=11):
+    return [(x + step * i, y + (i * 17) % 40) for i in range(count)]
+
+
+def test_strokes_shapes_and_fill():
+    sda.new_document(300, 200, follows_window=False)
+    shape("rectangle", (20, 20, 180, 150))
+    shape("circle", (200, 40, 280, 120))
+    stroke(wave(30, 60))
+    stroke([(100, 170), (160, 190)])  # Two points: a straight dab line
+    stroke([(250, 180)])  # A click
+    assert fill(100, 100, "#ffcc00")
+    assert fill(5, 5, "#88aaff")
+    stroke(wave(40, 30, 6), tool="eraser", size=15)
+    assert_replays()
+
+
+def test_dense_samples_are_simplified():
+    sda.new_document(400, 200, follows_window=False)
+    # A gentle curve, one pixel per sample, as a slow drag delivers it
+    samples = [(10 + i, round(100 + 60 * math.sin(i / 60)))
+               for i in range(370)]
+    stroke(samples, size=5)
+    points = sda.journal.ops[-1]["points"]
+    assert len(points) // 2 < len(samples) // 4
+    assert points[:2] == [10, 100] and points[-2:] == list(samples[-1])
+    assert_replays()
+
+
+def test_layers():
+    sda.new_document(256, 192, follows_window=False)
+    stroke(wave(10, 40))
+    sda.add_layer()
+    shape("circle", (60, 40, 200, 160), size=5)
+    assert fill(130, 100, "#00aa44")  # Inside the circle
+    sda.set_layer_blend("multiply")
+    sda.add_layer()
+    stroke(wave(20, 120), color="#ff0000", size=20)
+    sda.toggle_layer_visibility()
+    sda.toggle_layer_visibility()
+    sda.move_layer(-1)
+    sda.select_layer(0)
+    assert fill(250, 5, "#333366")
+    sda.select_layer(2)
+    stroke(wave(30, 10, 5), tool="eraser")
+    sda.undo()
+    sda.undo()
+    sda.redo()
+    assert_replays()
+
+
+def test_background_layer_stays_at_the_bottom():
+    sda.new_document(64, 48, follows_window=False)
+    sda.add_layer()
+    sda.move_layer(-1)
+    assert sda.layers.active == 1
+    sda.add_layer()
+    sda.delete_layer()
+    assert len(sda.layers.layers) == 2
+    assert sda.document_image().mode == "RGBA"
+    assert_replays()
+
+
+def test_undo_and_redo_restore_the_layer():
+    sda.new_document(120, 90, follows_window=False)
+    before = sda.document_image()
+    shape("rectangle", (10, 10, 100, 80))
+    assert fill(50, 50, "#00ff00")
+    after = sda.document_image()
+    sda.undo()
+    sda.undo()
+    assert_same(sda.document_image(), before)
+    assert not sda.history.can_undo()
+    sda.redo()
+    sda.redo()
+    assert_same(sda.document_image(), after)
+    assert not sda.history.can_redo()
+    assert_replays()
+
+
+def test_selection_edits():
+    sda.new_document(160, 120, follows_window=False)
+    shape("rectangle", (10, 10, 70, 60), size=5)
+    assert fill(30, 30, "#884422")
+    sda.set_selection(sda.selection.Selection.rectangle(5, 5, 80, 70,
+                                                        sda.doc_size))
+    sda.copy_selection()
+    sda.delete_selection()
+    sda.paste_selection()
+    sda.set_selection(sda.selection.Selection.lasso(
+        [90, 20, 150, 30, 120, 110], sda.doc_size
+    ))
+    sda.cut_selection()
+    assert sda.clipboard is not None
+    assert_replays()
+
+
+def test_fill_after_shrink_stays_inside_the_document():
+    sda.new_document(320, 240, follows_window=False)
+    shape("rectangle", (40, 40, 300, 200))
+    sda.resize_document(200, 150)
+    # The rectangle reaches past the new edge; the fill must not
+    bbox = fill(100, 100, "#ff00ff")
+    assert bbox[2] <= 200 and bbox[3] <= 150
+    sda.resize_document(320, 240)
+    # Growing back shows the pixels kept in the backing store unfilled
+    assert sda.document_image().getpixel((250, 180)) == (255, 255, 255, 255)
+    assert_replays()
+
+
+def test_fill_after_grow_and_journal_file(tmp_path):
+    sda.new_document(128, 96, follows_window=False)
+    stroke(wave(0, 20, 14), size=5)
+    sda.resize_document(400, 300)
+    sda.add_layer()
+    shape("line", (0, 0, 399, 299), size=4)
+    assert fill(390, 10, "#123456")
+    sda.select_layer(0)
+    assert fill(300, 250, "#abcdef")
+    path = tmp_path / "drawing.sdj"
+    sda.journal.save(path)
+    assert_same(replay(Journal.load(path).ops), sda.document_image())
+
+
+@pytest.mark.parametrize("mode", ["RGB", "L", "P"])
+def test_other_pixel_formats(mode):
+    sda.pixel_format = mode
+    sda.new_document(96, 64, follows_window=False)
+    shape("circle", (10, 10, 80, 50))
+    assert fill(45, 30, "#3366cc")
+    stroke(wave(5, 5, 8), color="#cc0000", size=4)
+    assert sda.document_image().mode == mode
+    assert_replays()
@@ -0,0 +1,69 @@
+"""TiledImage copies share tiles until one side writes; plain tiles are
+stored as colours and read back like painted ones.
+"""
+from PIL import Image, ImageDraw
+
+import tiles
+
+
+def painted(size=(160, 100), tile_size=32):
+    dense = Image.new("RGBA", size, "white")
+    ImageDraw.Draw(dense).ellipse((20, 10, 140, 90), fill="red",
+                                  outline="black", width=3)
+    return dense, tiles.tiled(dense.copy(), "white", tile_size)
+
+
+def test_from_image_reads_back():
+    dense, tiled = painted((224, 100))
+    assert tiled.crop((0, 0) + dense.size).tobytes() == dense.tobytes()
+    assert tiled.crop((50, 20, 150, 95)).tobytes() == \
+        dense.crop((50, 20, 150, 95)).tobytes()
+    # Tiles of the fill colour are not stored at all
+    assert (6, 0) not in tiled.tiles
+    assert tiled.nbytes < dense.width * dense.height * 4
+
+
+def test_copy_shares_tiles_until_written():
+    _, tiled = painted()
+    before = tiled.crop((0, 0, 160, 100)).tobytes()
+    snapshot = tiled.copy()
+    assert snapshot.tiles[(1, 1)] is tiled.tiles[(1, 1)]
+    tiled.paste((0, 0, 255, 255), (40, 40, 60, 60))
+    assert snapshot.tiles[(1, 1)] is not tiled.tiles[(1, 1)]
+    assert snapshot.crop((0, 0, 160, 100)).tobytes() == before
+    assert tiled.getpixel((50, 50)) == (0, 0, 255, 255)
+    # Writes to the copy leave the original alone too
+    snapshot.paste((0, 255, 0, 255), (100, 40, 120, 60))
+    assert tiled.getpixel((110, 50)) != (0, 255, 0, 255)
+
+
+def test_plain_paste_over_whole_tiles():
+    _, tiled = painted()
+    tiled.paste((9, 9, 9, 255), (32, 32, 96, 64))
+    assert tiled.tiles[(1, 1)] == (9, 9, 9, 255)
+    assert tiled.tiles[(2, 1)] == (9, 9, 9, 255)
+    assert tiled.uniform((32, 32, 96, 64)) == (9, 9, 9, 255)
+    assert tiled.uniform((30, 32, 96, 64)) is None
+
+
+def test_compact_turns_plain_tiles_back_into_colours():
+    tiled = tiles.TiledImage("RGB", (64, 64), "white", 32)
+    tiled.paste(Image.new("RGB", (10, 10), "blue"), (5, 5))
+    tiled.paste(Image.new("RGB", (10, 10), "white"), (5, 5))
+    assert isinstance(tiled.tiles[(0, 0)], Image.Image)
+    assert tiled.compact() > 0
+    assert (0, 0) not in tiled.tiles
+    assert tiled.crop((0, 0, 64, 64)).tobytes() == \
+        Image.new("RGB", (64, 64), "white").tobytes()
+
+
+def test_resized_fills_new_area():
+    _, tiled = painted()
+    tiled.paste((0, 0, 0, 255), (150, 90, 160, 100))
+    grown = tiled.resized((200, 130))
+    assert grown.size == (200, 130)
+    assert grown.getpixel((155, 95)) == (0, 0, 0, 255)
+    assert grown.getpixel((170, 95)) == (255, 255, 255, 255)
+    shrunk = tiled.resized((100, 50)).resized((160, 100))
+    # Pixels past a shrunk edge are gone once it grows again
+    assert shrunk.getpixel((155, 95)) == (255, 255, 255, 255)
@@ -0,0 +1,342 @@
+"""Sparse tiled images for large documents.
+
+A ``TiledImage`` is a grid of square tiles. A tile that has never been
+painted holds no pixels and reads as the image's fill colour, and a tile
+that turns out to be a single colour is kept as just that colour. Only
+tiles with real detail hold a Pillow image. A blank 16K x 16K canvas
+therefore costs a small dict rather than a gigabyte.
+
+The class offers the subset of the Pillow ``Image`` interface the drawing
+code uses: ``size``, ``mode``, ``crop``, ``paste`` and ``getpixel``.
+Brushes, fills, selections, the undo history and the layer compositor
+all work on it unchanged. ``copy`` shares tiles until either side writes
+to one, so undo bases and save snapshots are nearly free. Nothing in
+here imports Tkinter.
+"""
+from PIL import Image
+
+import formats
+
+TILE_SIZE = 256
+
+
+def _uniform(image):
+    # The single colour of ``image``, or None if it has more than one
+    extrema = image.getextrema()
+    if isinstance(extrema[0], tuple):
+        if all(low == high for low, high in extrema):
+            return tuple(low for low, _ in extrema)
+        return None
+    return extrema[0] if extrema[0] == extrema[1] else None
+
+
+class TiledImage:
+    """A sparse image of ``mode`` and ``size``; unpainted area is ``fill``."""
+
+    def __init__(self, mode, size, fill=0, tile_size=TILE_SIZE):
+        self.mode = mode
+        self.size = tuple(size)
+        self.fill = formats.pixel(fill, mode)
+        self.tile_size = tile_size
+        self.tiles = {}  # (tx, ty) -> Image, or a colour for a plain tile
+        self._owned = set()  # Tiles no copy shares, safe to write in place
+
+    @classmethod
+    def from_image(cls, image, fill=0, tile_size=TILE_SIZE):
+        """Split a Pillow image into tiles, keeping single-colour ones as
+        colours."""
+        tiled = cls(image.mode, image.size, fill, tile_size)
+        tiled.paste(image, (0, 0))
+        return tiled
+
+    @property
+    def width(self):
+        return self.size[0]
+
+    @property
+    def height(self):
+        return self.size[1]
+
+    @property
+    def nbytes(self):
+        # Memory held by painted tiles
+        bands = Image.getmodebands(self.mode)
+        return sum(tile.width * tile.height * bands
+                   for tile in self.tiles.values()
+                   if isinstance(tile, Image.Image))
+
+    def copy(self):
+        """A copy sharing every tile until one side writes to it."""
+        clone = TiledImage(self.mode, self.size, self.fill, self.tile_size)
+        clone.tiles = dict(self.tiles)
+        self._owned.clear()
+        return clone
+
+    def resized(self, size):
+        """A copy of ``size``; new area is the fill, as with a bigger
+        ``Image.new`` pasted over."""
+        clone = self.copy()
+        width, height = self.size
+        clone.size = tuple(size)
+        step = self.tile_size
+        for key in list(clone.tiles):
+            if key[0] * step >= size[0] or key[1] * step >= size[1]:
+                del clone.tiles[key]
+        # Edge tiles may hold stale pixels past the old edge
+        if size[0] > width:
+            clone.paste(clone.fill, (width, 0, size[0], min(height, size[1])))
+        if size[1] > height:
+            clone.paste(clone.fill, (0, height, size[0], size[1]))
+        return clone
+
+    def converted(self, mode):
+        """A copy in ``mode`` (see ``formats.convert``); each painted tile
+        is converted once and plain tiles stay colours."""
+        if mode == self.mode:
+            return self.copy()
+        clone = TiledImage(
+            mode, self.size,
+            formats.convert_pixel(self.fill, self.mode, mode), self.tile_size
+        )
+        for key, tile in self.tiles.items():
+            if isinstance(tile, Image.Image):
+                clone.tiles[key] = formats.convert(tile, mode)
+                clone._owned.add(key)
+            else:
+                clone._set_color(
+                    key, formats.convert_pixel(tile, self.mode, mode)
+                )
+        return clone
+
+    def _keys(self, box):
+        # Tiles overlapping box, which is already clipped to the image
+        step = self.tile_size
+        x0, y0, x1, y1 = box
+        return [(tx, ty)
+                for ty in range(y0 // step, -(-y1 // step))
+                for tx in range(x0 // step, -(-x1 // step))]
+
+    def _clip(self, box):
+        width, height = self.size
+        x0, y0, x1, y1 = (int(value) for value in box)
+        box = (max(0, x0), max(0, y0), min(width, x1), min(height, y1))
+        if box[0] >= box[2] or box[1] >= box[3]:
+            return None
+        return box
+
+    def _tile_area(self, key):
+        # The part of a tile inside the image
+        step = self.tile_size
+        return (key[0] * step, key[1] * step,
+                min(self.size[0], (key[0] + 1) * step),
+                min(self.size[1], (key[1] + 1) * step))
+
+    def _writable(self, key):
+        tile = self.tiles.get(key, self.fill)
+        if isinstance(tile, Image.Image):
+            if key in self._owned:
+                return tile
+            tile = tile.copy()
+        else:
+            tile = formats.new(self.mode, (self.tile_size,) * 2, tile)
+        self.tiles[key] = tile
+        self._owned.add(key)
+        return tile
+
+    def _set_color(self, key, color):
+        if color == self.fill:
+            self.tiles.pop(key, None)
+        else:
+            self.tiles[key] = color
+        self._owned.discard(key)
+
+    def uniform(self, box):
+        """The colour of ``box`` if it lies in plain tiles of a single
+        colour, else None."""
+        box = self._clip(box)
+        if box is None:
+            return None
+        colors = set()
+        for key in self._keys(box):
+            tile = self.tiles.get(key, self.fill)
+            if isinstance(tile, Image.Image):
+                return None
+            colors.add(tile)
+        return colors.pop() if len(colors) == 1 else None
+
+    def getpixel(self, xy):
+        x, y = (int(value) for value in xy)
+        step = self.tile_size
+        tile = self.tiles.get((x // step, y // step), self.fill)
+        if isinstance(tile, Image.Image):
+            return tile.getpixel((x % step, y % step))
+        return tile
+
+    def crop(self, box):
+        """A Pillow image of ``box``; area outside the image is zero, as
+        with ``Image.crop``."""
+        x0, y0, x1, y1 = (int(value) for value in box)
+        size = (x1 - x0, y1 - y0)
+        clipped = self._clip(box)
+        step = self.tile_size
+        if clipped == (x0, y0, x1, y1):
+            keys = self._keys(clipped)
+            if len(keys) == 1:
+                # Inside one tile: a single crop or a plain colour
+                tile = self.tiles.get(keys[0], self.fill)
+                if not isinstance(tile, Image.Image):
+                    return formats.new(self.mode, size, tile)
+                tx, ty = keys[0][0] * step, keys[0][1] * step
+                return tile.crop((x0 - tx, y0 - ty, x1 - tx, y1 - ty))
+            color = self.uniform(clipped)
+            if color is not None:
+                return formats.new(self.mode, size, color)
+        out = formats.new(self.mode, size)
+        if clipped is None:
+            return out
+        for key in self._keys(clipped):
+            tile = self.tiles.get(key, self.fill)
+            area = self._tile_area(key)
+            part = (max(area[0], clipped[0]), max(area[1], clipped[1]),
+                    min(area[2], clipped[2]), min(area[3], clipped[3]))
+            target = (part[0] - x0, part[1] - y0, part[2] - x0, part[3] - y0)
+            if isinstance(tile, Image.Image):
+                tx, ty = key[0] * step, key[1] * step
+                out.paste(tile.crop((part[0] - tx, part[1] - ty,
+                                     part[2] - tx, part[3] - ty)), target)
+            else:
+                out.paste(tile, target)
+        return out
+
+    def paste(self, im, box=None, mask=None):
+        """Paste a Pillow image or a colour, as ``Image.paste`` does.
+
+        A tile that a paste covers entirely becomes a plain colour again
+        when what was pasted is one.
+        """
+        if box is None:
+            box = (0, 0)
+        if len(box) == 2:
+            box = (box[0], box[1], box[0] + im.width, box[1] + im.height)
+        x0, y0 = int(box[0]), int(box[1])
+        if not isinstance(im, Image.Image):
+            im = formats.pixel(im, self.mode)
+        clipped = self._clip(box)
+        if clipped is None:
+            return
+        step = self.tile_size
+        for key in self._keys(clipped):
+            area = self._tile_area(key)
+            part = (max(area[0], clipped[0]), max(area[1], clipped[1]),
+                    min(area[2], clipped[2]), min(area[3], clipped[3]))
+            source = (part[0] - x0, part[1] - y0, part[2] - x0, part[3] - y0)
+            piece = im.crop(source) if isinstance(im, Image.Image) else im
+            piece_mask = mask.crop(source) if mask is not None else None
+            tile = self.tiles.get(key, self.fill)
+            if piece_mask is None and not isinstance(piece, Image.Image) \
+                    and tile == piece:
+                continue  # Already that colour
+            if part == area and piece_mask is None:
+                color = _uniform(piece) if isinstance(piece, Image.Image) \
+                    else piece
+                if color is not None:
+                    self._set_color(key, color)
+                    continue
+            tx, ty = key[0] * step, key[1] * step
+            local = (part[0] - tx, part[1] - ty, part[2] - tx, part[3] - ty)
+            tile = self._writable(key)
+            if isinstance(piece, Image.Image):
+                tile.paste(piece, local[:2], piece_mask)
+            else:
+                tile.paste(piece, local, piece_mask)
+
+    def copy_from(self, source, box):
+        """Make ``box`` match the TiledImage ``source``; whole tiles are
+        shared with it rather than copied."""
+        box = self._clip(box)
+        if box is None:
+            return
+        if source.tile_size != self.tile_size:
+            self.paste(source.crop(box), box)
+            return
+        for key in self._keys(box):
+            area = self._tile_area(key)
+            part = (max(area[0], box[0]), max(area[1], box[1]),
+                    min(area[2], box[2]), min(area[3], box[3]))
+            if part != area:
+                self.paste(source.crop(part), part)
+                continue
+            tile = source.tiles.get(key, source.fill)
+            if isinstance(tile, Image.Image):
+                self.tiles[key] = tile
+                self._owned.discard(key)
+                source._owned.discard(key)
+            else:
+                self._set_color(key, tile)
+
+    def compact(self, box=None):
+        """Turn painted tiles under ``box`` that hold a single colour back
+        into plain ones; returns the bytes freed."""
+        box = self._clip(box or (0, 0) + self.size)
+        freed = 0
+        if box is None:
+            return freed
+        for key in self._keys(box):
+            tile = self.tiles.get(key)
+            if not isinstance(tile, Image.Image):
+                continue
+            x0, y0, x1, y1 = self._tile_area(key)
+            color = _uniform(tile.crop((0, 0, x1 - x0, y1 - y0)))
+            if color is not None:
+                freed += tile.width * tile.height * \
+                    Image.getmodebands(self.mode)
+                self._set_color(key, color)
+        return freed
+
+
+def tiled(image, fill=0, tile_size=TILE_SIZE):
+    """``image`` as a TiledImage; one already tiled is returned as is."""
+    if isinstance(image, TiledImage):
+        return image
+    return TiledImage.from_image(image, fill, tile_size)
+
+
+def new_like(image, fill, mode=None):
+    """A blank image of the same kind and size as ``image``, in ``mode``
+    (by default the same one)."""
+    mode = mode or image.mode
+    if isinstance(image, TiledImage):
+        return TiledImage(mode, image.size, fill, image.tile_size)
+    return formats.new(mode, image.size, fill)
+
+
+def converted(image, mode):
+    """``image`` in ``mode``; the image itself if it already is."""
+    if image.mode == mode:
+        return image
+    if isinstance(image, TiledImage):
+        return image.converted(mode)
+    return formats.convert(image, mode)
+
+
+def grown(image, width, height, fill):
+    """``image`` with room for width x height; new area is ``fill``.
+
+    Dense images double their capacity (see ``raster.grow_canvas``);
+    tiled ones just get bigger, since unpainted area costs nothing.
+    """
+    if width <= image.size[0] and height <= image.size[1]:
+        return image
+    if isinstance(image, TiledImage):
+        return image.resized((max(width, image.size[0]),
+                              max(height, image.size[1])))
+    import raster  # NumPy; not needed until an image grows
+    return raster.grow_canvas(image, width, height, fill)
+
+
+def uniform(image, box):
+    """The single colour of ``box`` in a tiled image, if it is plain;
+    always None for dense images, whose tiles are not tracked."""
+    if isinstance(image, TiledImage):
+        return image.uniform(box)
+    return None
@@ -0,0 +1,220 @@
+"""Zoomable, pannable view of a document image.
+
+The document stays at its native resolution. ``TilePyramid`` caches
+downsampled tiles of it (level 1 is half size, level 2 a quarter, ...) so a
+zoomed-out view only touches a handful of small tiles, and ``Viewport``
+renders any rectangle of the window from the right pyramid level.
+"""
+import math
+from collections import OrderedDict
+
+from PIL import Image
+
+import formats
+import tiles
+
+
+class TilePyramid:
+    """Lazily built, LRU-cached multi-resolution tiles of an image."""
+
+    def __init__(self, tile_size=256, max_tiles=256):
+        self.tile_size = tile_size
+        self.max_tiles = max_tiles
+        self.source = None
+        self.cache = OrderedDict()  # (level, tx, ty) -> Image
+
+    def set_source(self, image):
+        self.source = image
+        self.cache.clear()
+
+    def level_size(self, level):
+        width, height = self.source.size
+        for _ in range(level):
+            width, height = -(-width // 2), -(-height // 2)
+        return width, height
+
+    def level_mode(self):
+        # Palette images cannot be averaged, so the downsampled levels
+        # of one are kept in RGB
+        return "RGB" if self.source.mode == "P" else self.source.mode
+
+    def invalidate(self, bbox):
+        # Drop cached tiles overlapping bbox (document coordinates) on
+        # every level; they are rebuilt on demand
+        x0, y0, x1, y1 = bbox
+        step = self.tile_size
+        for key in [key for key in self.cache
+                    if key[1] * step << key[0] < x1
+                    and (key[1] + 1) * step << key[0] > x0
+                    and key[2] * step << key[0] < y1
+                    and (key[2] + 1) * step << key[0] > y0]:
+            del self.cache[key]
+
+    def tile(self, level, tx, ty):
+        step = self.tile_size
+        if level == 0:
+            # Full resolution tiles are plain crops of the source
+            return self.source.crop((tx * step, ty * step,
+                                     (tx + 1) * step, (ty + 1) * step))
+        key = (level, tx, ty)
+        tile = self.cache.get(key)
+        if tile is not None:
+            self.cache.move_to_end(key)
+            return tile
+
+        # A plain area of a sparse source needs no downsampling
+        mode = self.level_mode()
+        span = step << level
+        color = tiles.uniform(self.source, (tx * span, ty * span,
+                                            (tx + 1) * span, (ty + 1) * span))
+        if color is not None:
+            width, height = self.level_size(level)
+            tile = Image.new(mode, (
+                min(step, width - tx * step), min(step, height - ty * step)
+            ), formats.convert_pixel(color, self.source.mode, mode))
+        else:
+            # Downsample the four tiles of the level below
+            below_width, below_height = self.level_size(level - 1)
+            width = min(2 * step, below_width - 2 * tx * step)
+            height = min(2 * step, below_height - 2 * ty * step)
+            mosaic = Image.new(mode, (width, height))
+            for dy in (0, 1):
+                for dx in (0, 1):
+                    if dx * step < width and dy * step < height:
+                        mosaic.paste(
+                            self.tile(level - 1, 2 * tx + dx, 2 * ty + dy),
+                            (dx * step, dy * step)
+                        )
+            tile = mosaic.reduce(2)
+
+        self.cache[key] = tile
+        if len(self.cache) > self.max_tiles:
+            self.cache.popitem(last=False)
+        return tile
+
+    def region(self, level, box):
+        """Assemble the integer box (level coordinates) from tiles."""
+        x0, y0, x1, y1 = box
+        if level == 0:
+            return self.source.crop(box)
+        step = self.tile_size
+        region = Image.new(self.level_mode(), (x1 - x0, y1 - y0))
+        for ty in range(y0 // step, -(-y1 // step)):
+            for tx in range(x0 // step, -(-x1 // step)):
+                region.paste(self.tile(level, tx, ty),
+                             (tx * step - x0, ty * step - y0))
+        return region
+
+
+class Viewport:
+    """Maps between window (view) and document coordinates and renders."""
+
+    MIN_ZOOM = 1 / 64
+    MAX_ZOOM = 32
+
+    def __init__(self, pyramid, background="#a0a0a0"):
+        self.pyramid = pyramid
+        self.background = background
+        self.zoom = 1.0
+        self.x = 0.0  # Document coordinates of the view's top-left corner
+        self.y = 0.0
+        self.width = 1  # View size in window pixels
+        self.height = 1
+        # Visible document size when the source image is a larger backing
+        # store; None means the whole source
+        self.doc_size = None
+
+    def bounds(self):
+        return self.doc_size or self.pyramid.source.size
+
+    def to_doc(self, vx, vy):
+        return (math.floor(self.x + vx / self.zoom),
+                math.floor(self.y + vy / self.zoom))
+
+    def to_view(self, x, y):
+        return ((x - self.x) * self.zoom, (y - self.y) * self.zoom)
+
+    def doc_box_to_view(self, bbox):
+        """View box covering a document box, clipped to the view."""
+        vx0, vy0 = self.to_view(bbox[0], bbox[1])
+        vx1, vy1 = self.to_view(bbox[2], bbox[3])
+        box = (max(0, math.floor(vx0)), max(0, math.floor(vy0)),
+               min(self.width, math.ceil(vx1)),
+               min(self.height, math.ceil(vy1)))
+        if box[0] >= box[2] or box[1] >= box[3]:
+            return None
+        return box
+
+    def clamp(self):
+        # Keep the document on screen; smaller documents stay top-left
+        doc_width, doc_height = self.bounds()
+        self.x = min(max(0.0, self.x),
+                     max(0.0, doc_width - self.width / self.zoom))
+        self.y = min(max(0.0, self.y),
+                     max(0.0, doc_height - self.height / self.zoom))
+
+    def pan(self, dx, dy):
+        # dx, dy in window pixels
+        self.x += dx / self.zoom
+        self.y += dy / self.zoom
+        self.clamp()
+
+    def zoom_at(self, factor, vx, vy):
+        # Zoom keeping the document point under (vx, vy) fixed
+        zoom = min(self.MAX_ZOOM, max(self.MIN_ZOOM, self.zoom * factor))
+        doc_x = self.x + vx / self.zoom
+        doc_y = self.y + vy / self.zoom
+        self.zoom = zoom
+        self.x = doc_x - vx / zoom
+        self.y = doc_y - vy / zoom
+        self.clamp()
+
+    def render(self, box):
+        """Render the view box (window pixels) as an RGB image."""
+        vx0, vy0, vx1, vy1 = box
+        out = Image.new("RGB", (vx1 - vx0, vy1 - vy0), self.background)
+        doc_width, doc_height = self.bounds()
+
+        # Output pixels lying entirely on the document. Source coordinates
+        # are derived from these, so every patch uses the same pixel grid
+        left, top = self.to_view(0, 0)
+        right, bottom = self.to_view(doc_width, doc_height)
+        ox0, oy0 = max(vx0, math.ceil(left)), max(vy0, math.ceil(top))
+        ox1, oy1 = min(vx1, math.floor(right)), min(vy1, math.floor(bottom))
+        if ox0 >= ox1 or oy0 >= oy1:
+            return out
+        dx0 = max(0.0, self.x + ox0 / self.zoom)
+        dy0 = max(0.0, self.y + oy0 / self.zoom)
+        dx1 = min(doc_width, self.x + ox1 / self.zoom)
+        dy1 = min(doc_height, self.y + oy1 / self.zoom)
+
+        # Use the smallest pyramid level that is still at least as
+        # detailed as the zoom needs
+        level = 0
+        if self.zoom < 1:
+            level = math.floor(math.log2(1 / self.zoom))
+        scale = 2 ** level
+        lx0, ly0, lx1, ly1 = dx0 / scale, dy0 / scale, dx1 / scale, dy1 / scale
+        level_width, level_height = self.pyramid.level_size(level)
+        # Fetch a small margin so the resampling filter sees the same
+        # neighbours whether the whole view or a dirty patch is rendered
+        margin = 0 if self.zoom >= 1 else 3
+        fetch = (max(0, math.floor(lx0) - margin),
+                 max(0, math.floor(ly0) - margin),
+                 min(level_width, math.ceil(lx1) + margin),
+                 min(level_height, math.ceil(ly1) + margin))
+        region = self.pyramid.region(level, fetch)
+        if region.mode != "RGB":
+            region = region.convert("RGB")
+
+        size = (ox1 - ox0, oy1 - oy0)
+        ox0, oy0 = ox0 - vx0, oy0 - vy0
+        source_box = (lx0 - fetch[0], ly0 - fetch[1],
+                      lx1 - fetch[0], ly1 - fetch[1])
+        if size == region.size and source_box == (0, 0) + region.size:
+            view = region
+        else:
+            resample = Image.NEAREST if self.zoom >= 1 else Image.BILINEAR
+            view = region.resize(size, resample, box=source_box)
+        out.paste(view, (ox0, oy0))
+        return out
@@ -0,0 +1,81 @@
+"""A single background thread for long document operations.
+
+Jobs run one at a time, in the order they were submitted, on a thread
+that owns the document while a job is in flight: the UI thread hands the
+document over by submitting a job and leaves it alone until ``busy()``
+is false again, so the two threads never touch the same pixels at once.
+A job submitted with ``owns_document=False`` works on copies it was
+given (an autosave checkpoint, say) and leaves ``busy()`` alone.
+Results go into an outbox that the UI thread drains with ``poll`` (from a
+Tk ``after`` loop); nothing in here imports Tkinter.
+"""
+import queue
+import threading
+import time
+
+
+class RenderWorker:
+    """Runs jobs on one dedicated thread and queues their results."""
+
+    def __init__(self):
+        self.inbox = queue.Queue()
+        self.outbox = queue.Queue()
+        self.pending = 0  # Jobs submitted whose callbacks have not run
+        self.owning = 0  # Those of them that own the document
+        # A daemon, so an unexpected exit is not held up by a job whose
+        # result nobody would collect
+        self._thread = threading.Thread(
+            target=self._run, name="render", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, job, done, name="job", owns_document=True):
+        """Run ``job()`` on the worker, then ``done(result, error)`` on the
+        thread that calls ``poll``."""
+        self.pending += 1
+        self.owning += owns_document
+        self.inbox.put((job, done, name, owns_document))
+
+    def busy(self):
+        # The document belongs to the worker
+        return self.owning > 0
+
+    def poll(self):
+        """Run the callbacks of finished jobs; returns (name, seconds) of
+        each."""
+        finished = []
+        while True:
+            try:
+                (done, name, owns_document, result, error,
+                 seconds) = self.outbox.get_nowait()
+            except queue.Empty:
+                return finished
+            try:
+                done(result, error)
+            finally:
+                # A failing callback still ends its job, or busy() would
+                # never turn false again
+                self.pending -= 1
+                self.owning -= owns_document
+            finished.append((name, seconds))
+
+    def close(self):
+        # Let queued jobs finish, then stop the thread
+        self.inbox.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self.inbox.get()
+            if item is None:
+                return
+            job, done, name, owns_document = item
+            start = time.perf_counter()
+            try:
+                result, error = job(), None
+            except Exception as e:
+                result, error = None, e
+            self.outbox.put(
+                (done, name, owns_document, result, error,
+                 time.perf_counter() - start)
+            )